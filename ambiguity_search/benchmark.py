@@ -0,0 +1,810 @@
+"""
+End-to-end benchmark of the MaxQuant ambiguity search on synthetic data.
+
+For each scale (number of PSMs) a dataset is generated once and reused by
+later runs with the same parameters:
+
+    maxquant/folder_<n>/msms.txt
+                synthetic MaxQuant results, a fraction of the sequences
+                with I or L belongs to groups of I/L siblings, sampled from
+                the sibling groups of a proteome (.siblings file of
+                find_siblings.digest_find_siblings) and, once they are used
+                up, from copies of them with the other residues replaced
+    mzml/<raw file>.mzML
+                small indexed mzML files with random spectra for the scans
+                of the PSMs of sibling sequences, the only scans the
+                search reads
+
+The search then runs stage by stage and the wall time, calls, items and peak
+RSS of each stage are written to JSON: index_build (reading msms.txt),
+ambiguity_matching (grouping the siblings), spectrum_extraction (one pass
+over the mzML files), spectrum_lookup and output_writing (Parquet), the last
+two batch by batch as in MaxQuantAmbiguitySearch.write_results. The peak RSS is measured per stage on
+Linux (reset through /proc/self/clear_refs) and is the peak of the process so
+far elsewhere; spectra are read by worker processes, whose peak is reported
+separately.
+
+Run from the project root, optionally comparing with an earlier result:
+    python -m ambiguity_search.benchmark benchmark.json --work-dir /tmp/benchmark \\
+        --psms 10000 100000 1000000 10000000 --baseline benchmark_before.json
+"""
+
+import argparse
+import ast
+import base64
+import gc
+import hashlib
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import ClassVar, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from ambiguity_search.maxquant import MaxQuantAmbiguitySearch
+from seq_utils.mass import PROTON, RESIDUE_MASSES, WATER
+
+
+SIBLINGS_FILE = Path(__file__).resolve().parents[1] / "find_siblings" / "UP000005640_9606.siblings"
+"""
+Sibling groups of the human reference proteome.
+"""
+
+DEFAULT_SIBLING_RATE = 0.012
+"""
+Fraction of the I/L containing sequences with siblings. Estimate for the
+human reference proteome (5481 sibling peptides of roughly 450,000 tryptic
+peptides with I or L), use --fasta to compute it for the proteome of a
+.siblings file.
+"""
+
+
+def read_sibling_groups(siblings_file: Path) -> List[List[str]]:
+    """
+    Sibling groups of a .siblings file (one Python set literal per line).
+    """
+    groups = []
+    with open(siblings_file) as f:
+        for line in f:
+            if line.startswith("{"):
+                groups.append(sorted(ast.literal_eval(line)))
+    return groups
+
+
+def proteome_sibling_rate(groups: List[List[str]], fasta_file: Path) -> float:
+    """
+    Fraction of the I/L containing tryptic peptides of a proteome in sibling groups.
+    """
+    from find_siblings.digest_find_siblings import digest_fasta_keep_with_leucines
+
+    peps_by_length = digest_fasta_keep_with_leucines(str(fasta_file))
+    n_peptides = sum(len(group) for peps in peps_by_length.values() for group in peps.values())
+    return sum(len(group) for group in groups) / n_peptides
+
+
+_RESIDUES = np.frombuffer(b"ACDEFGHMNPQSTVWY", dtype=np.uint8)
+_CLEAVAGE_RESIDUES = np.frombuffer(b"KR", dtype=np.uint8)
+_MASS_TABLE = np.zeros(256)
+for _aa, _mass in RESIDUE_MASSES.items():
+    if len(_aa) == 1:
+        _MASS_TABLE[ord(_aa)] = _mass
+
+
+def _sequence_codes(sequences: np.ndarray) -> np.ndarray:
+    width = max((len(s) for s in sequences), default=1)
+    return np.array(sequences, dtype=f"S{width}").view(np.uint8).reshape(len(sequences), width)
+
+
+def _strings(codes: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(codes).view(f"S{codes.shape[1]}").ravel().astype(str).astype(object)
+
+
+def plain_masses(sequences: np.ndarray) -> np.ndarray:
+    """
+    Monoisotopic masses of unmodified sequences, vectorized over all sequences.
+    """
+    return _MASS_TABLE[_sequence_codes(sequences)].sum(axis=1) + WATER
+
+
+def random_peptides(rng: np.random.Generator, n: int, leucines: bool) -> np.ndarray:
+    """
+    Random tryptic peptides of 7 to 40 residues ending with K or R, with 1 to
+    3 L (never I, so that they have no siblings among each other) or without I/L.
+    """
+    lengths = np.minimum(7 + rng.poisson(7, n), 40)
+    width = int(lengths.max()) if n else 1
+    rows = np.arange(n)
+    codes = rng.choice(_RESIDUES, size=(n, width))
+    if leucines:
+        n_leucines = rng.integers(1, 4, n)
+        for k in range(3):
+            selected = rows[n_leucines > k]
+            codes[selected, rng.integers(0, lengths[selected] - 1)] = ord("L")
+    codes[rows, lengths - 1] = rng.choice(_CLEAVAGE_RESIDUES, n)
+    codes[np.arange(width) >= lengths[:, None]] = 0
+    return _strings(codes)
+
+
+class SyntheticMaxQuantData:
+    """
+    Generator of MaxQuant msms.txt folders and matching mzML files.
+    """
+
+    MSMS_COLUMNS: ClassVar[List[str]] = [
+        "Raw file", "Scan number", "Sequence", "Length", "Modifications", "Modified sequence",
+        "Charge", "m/z", "Mass", "Retention time", "PEP", "Score", "id",
+    ]
+    """
+    Columns of the generated msms.txt files.
+    """
+
+    def __init__(
+        self,
+        n_psms: int,
+        sibling_groups: List[List[str]],
+        sibling_rate: float = DEFAULT_SIBLING_RATE,
+        il_fraction: float = 0.7,
+        psms_per_sequence: float = 4.0,
+        psms_per_raw_file: int = 20_000,
+        psms_per_folder: int = 1_000_000,
+        n_peaks: int = 60,
+        seed: int = 0,
+    ):
+        """
+        Parameters
+        ----------
+        n_psms : int
+            Number of PSMs.
+        sibling_groups : List[List[str]]
+            Sibling groups the sibling sequences are sampled from.
+        sibling_rate : float
+            Fraction of the sequences with I or L which belong to a sibling group.
+        il_fraction : float
+            Fraction of the sequences with I or L.
+        psms_per_sequence : float
+            Mean number of PSMs per sequence (geometric distribution).
+        psms_per_raw_file : int
+            Number of PSMs per raw file.
+        psms_per_folder : int
+            Number of PSMs per MaxQuant folder, whole raw files per folder.
+        n_peaks : int
+            Mean number of peaks per spectrum.
+        seed : int
+            Seed of the random generator.
+        """
+        self.n_psms = n_psms
+        self.sibling_groups = sibling_groups
+        self.sibling_rate = sibling_rate
+        self.il_fraction = il_fraction
+        self.psms_per_sequence = psms_per_sequence
+        self.psms_per_raw_file = psms_per_raw_file
+        self.psms_per_folder = psms_per_folder
+        self.n_peaks = n_peaks
+        self.seed = seed
+
+    def parameters(self) -> Dict:
+        return {
+            "n_psms": self.n_psms,
+            "sibling_groups": len(self.sibling_groups),
+            "sibling_rate": self.sibling_rate,
+            "il_fraction": self.il_fraction,
+            "psms_per_sequence": self.psms_per_sequence,
+            "psms_per_raw_file": self.psms_per_raw_file,
+            "psms_per_folder": self.psms_per_folder,
+            "n_peaks": self.n_peaks,
+            "seed": self.seed,
+        }
+
+    def sibling_sequences(self, rng: np.random.Generator, n: int) -> List[List[str]]:
+        """
+        Sibling groups with at least n sequences in total: the given groups in
+        random order, then copies of them with all residues besides I/L and
+        the C-terminus replaced at random (the same in all members).
+        """
+        groups = []
+        n_sequences = 0
+        while n_sequences < n:
+            for idx in rng.permutation(len(self.sibling_groups)):
+                if n_sequences >= n:
+                    break
+                group = self.sibling_groups[idx]
+                if groups and len(groups) >= len(self.sibling_groups):
+                    template = np.array([list(s) for s in group])
+                    replace = ~np.isin(template[0], ["I", "L"])
+                    replace[-1] = False
+                    template[:, replace] = rng.choice(list("ACDEFGHMNPQSTVWY"), replace.sum())
+                    group = ["".join(row) for row in template]
+                groups.append(group)
+                n_sequences += len(group)
+        return groups
+
+    def write(self, out_dir: Path) -> Dict:
+        """
+        Write the maxquant folders and mzML files to out_dir.
+
+        Returns
+        -------
+        Dict
+            Statistics of the dataset.
+        """
+        rng = np.random.default_rng(self.seed)
+        out_dir = Path(out_dir)
+
+        # sequences: siblings, other sequences with I/L, sequences without I/L
+        n_sequences = max(1, round(self.n_psms / self.psms_per_sequence))
+        n_il = round(n_sequences * self.il_fraction)
+        groups = self.sibling_sequences(rng, round(n_il * self.sibling_rate))
+        siblings = [s for group in groups for s in group]
+        sequences = np.concatenate([
+            np.array(siblings, dtype=object),
+            random_peptides(rng, max(n_il - len(siblings), 0), leucines=True),
+            random_peptides(rng, n_sequences - n_il, leucines=False),
+        ])
+        is_sibling = np.arange(len(sequences)) < len(siblings)
+        masses = plain_masses(sequences)
+
+        # PSMs: geometric number per sequence, in consecutive raw files of shuffled PSMs
+        psm_sequences = np.repeat(
+            np.arange(len(sequences)), rng.geometric(1 / self.psms_per_sequence, len(sequences))
+        )
+        if len(psm_sequences) < self.n_psms:
+            psm_sequences = np.append(
+                psm_sequences, rng.integers(0, len(sequences), self.n_psms - len(psm_sequences))
+            )
+        psm_sequences = rng.permutation(psm_sequences)[:self.n_psms]
+
+        n_raw_files = -(-self.n_psms // self.psms_per_raw_file)
+        raw_file_codes = np.arange(self.n_psms) * n_raw_files // self.n_psms
+        file_starts = np.searchsorted(raw_file_codes, np.arange(n_raw_files))
+        ranks = np.arange(self.n_psms) - file_starts[raw_file_codes]
+        scan_numbers = 1 + 3 * ranks + rng.integers(0, 3, self.n_psms)
+        file_sizes = np.diff(np.append(file_starts, self.n_psms))
+        retention_times = 120.0 * ranks / file_sizes[raw_file_codes]
+        charges = rng.choice([2, 3, 4], self.n_psms, p=[0.6, 0.3, 0.1])
+        psm_masses = masses[psm_sequences]
+        scores = rng.gamma(4.0, 25.0, self.n_psms)
+        raw_file_names = np.array([f"run_{code:05d}" for code in range(n_raw_files)], dtype=object)
+
+        maxquant_dir = out_dir / "maxquant"
+        n_folders = -(-n_raw_files // max(1, self.psms_per_folder // self.psms_per_raw_file))
+        folder_starts = file_starts[np.arange(n_folders) * n_raw_files // n_folders]
+        folder_stops = np.append(folder_starts[1:], self.n_psms)
+        msms_bytes = 0
+        for idx, (start, stop) in enumerate(tqdm(
+            list(zip(folder_starts, folder_stops)), desc="Writing msms.txt", unit="folder"
+        )):
+            folder_sequences = sequences[psm_sequences[start:stop]]
+            table = pa.table({
+                "Raw file": raw_file_names[raw_file_codes[start:stop]],
+                "Scan number": scan_numbers[start:stop],
+                "Sequence": folder_sequences,
+                "Length": np.array([len(s) for s in folder_sequences]),
+                "Modifications": np.full(stop - start, "Unmodified", dtype=object),
+                "Modified sequence": np.char.add(np.char.add("_", folder_sequences.astype(str)), "_"),
+                "Charge": charges[start:stop],
+                "m/z": np.round((psm_masses[start:stop] + charges[start:stop] * PROTON) / charges[start:stop], 5),
+                "Mass": np.round(psm_masses[start:stop], 5),
+                "Retention time": np.round(retention_times[start:stop], 4),
+                "PEP": np.exp(-scores[start:stop] / 10),
+                "Score": np.round(scores[start:stop], 3),
+                "id": np.arange(start, stop),
+            })
+            folder = maxquant_dir / f"folder_{idx:04d}"
+            folder.mkdir(parents=True, exist_ok=True)
+            with open(folder / "msms.txt", "wb") as f:
+                # header without the quotes of write_csv, like MaxQuant
+                f.write(("\t".join(self.MSMS_COLUMNS) + "\n").encode())
+                pyarrow.csv.write_csv(
+                    table.select(self.MSMS_COLUMNS),
+                    f,
+                    pyarrow.csv.WriteOptions(include_header=False, delimiter="\t", quoting_style="none"),
+                )
+            msms_bytes += (folder / "msms.txt").stat().st_size
+
+        # spectra of all PSMs of sibling sequences
+        mzml_dir = out_dir / "mzml"
+        mzml_dir.mkdir(parents=True, exist_ok=True)
+        selected = np.flatnonzero(is_sibling[psm_sequences])
+        selected = selected[np.lexsort((scan_numbers[selected], raw_file_codes[selected]))]
+        mzml_bytes = 0
+        for code in tqdm(np.unique(raw_file_codes[selected]), desc="Writing mzML", unit="file"):
+            psms = selected[raw_file_codes[selected] == code]
+            peak_counts = rng.integers(self.n_peaks // 2, self.n_peaks * 3 // 2 + 1, len(psms))
+            mzs = [np.sort(rng.uniform(100.0, 2000.0, n)) for n in peak_counts]
+            intensities = [rng.exponential(1e4, n).astype(np.float32) for n in peak_counts]
+            mzml_path = mzml_dir / f"{raw_file_names[code]}.mzML"
+            write_indexed_mzml(
+                mzml_path,
+                raw_file_names[code],
+                scan_numbers[psms],
+                (psm_masses[psms] + charges[psms] * PROTON) / charges[psms],
+                charges[psms],
+                retention_times[psms],
+                mzs,
+                intensities,
+            )
+            mzml_bytes += mzml_path.stat().st_size
+
+        return {
+            "n_psms": self.n_psms,
+            "n_sequences": len(np.unique(psm_sequences)),
+            "n_sibling_sequences": int(np.unique(psm_sequences[is_sibling[psm_sequences]]).size),
+            "n_sibling_groups": len(groups),
+            "n_raw_files": n_raw_files,
+            "n_folders": n_folders,
+            "n_spectra": len(selected),
+            "msms_bytes": msms_bytes,
+            "mzml_bytes": mzml_bytes,
+        }
+
+
+_MZML_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<indexedmzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd">
+  <mzML xmlns="http://psi.hupo.org/ms/mzml" id="{run}" version="1.1.0">
+    <cvList count="2">
+      <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+      <cv id="UO" fullName="Unit Ontology" URI="http://ontologies.berkeleybop.org/uo.obo"/>
+    </cvList>
+    <fileDescription>
+      <fileContent>
+        <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>
+      </fileContent>
+    </fileDescription>
+    <softwareList count="1">
+      <software id="spectral_similarity" version="0">
+        <cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool" value="spectral_similarity"/>
+      </software>
+    </softwareList>
+    <instrumentConfigurationList count="1">
+      <instrumentConfiguration id="IC1">
+        <cvParam cvRef="MS" accession="MS:1000031" name="instrument model" value=""/>
+      </instrumentConfiguration>
+    </instrumentConfigurationList>
+    <dataProcessingList count="1">
+      <dataProcessing id="synthetic">
+        <processingMethod order="0" softwareRef="spectral_similarity">
+          <cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML" value=""/>
+        </processingMethod>
+      </dataProcessing>
+    </dataProcessingList>
+    <run id="{run}" defaultInstrumentConfigurationRef="IC1">
+      <spectrumList count="{count}" defaultDataProcessingRef="synthetic">
+"""
+
+_MZML_SPECTRUM = """        <spectrum index="{index}" id="{id}" defaultArrayLength="{length}">
+          <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>
+          <cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>
+          <cvParam cvRef="MS" accession="MS:1000127" name="centroid spectrum" value=""/>
+          <scanList count="1">
+            <cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>
+            <scan>
+              <cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{retention_time}" unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/>
+            </scan>
+          </scanList>
+          <precursorList count="1">
+            <precursor>
+              <selectedIonList count="1">
+                <selectedIon>
+                  <cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{precursor_mz}" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+                  <cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="{charge}"/>
+                </selectedIon>
+              </selectedIonList>
+              <activation>
+                <cvParam cvRef="MS" accession="MS:1000422" name="beam-type collision-induced dissociation" value=""/>
+                <cvParam cvRef="MS" accession="MS:1000045" name="collision energy" value="28" unitCvRef="UO" unitAccession="UO:0000266" unitName="electronvolt"/>
+              </activation>
+            </precursor>
+          </precursorList>
+          <binaryDataArrayList count="2">
+            <binaryDataArray encodedLength="{mz_length}">
+              <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+              <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+              <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value="" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
+              <binary>{mz}</binary>
+            </binaryDataArray>
+            <binaryDataArray encodedLength="{intensity_length}">
+              <cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>
+              <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+              <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value="" unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"/>
+              <binary>{intensity}</binary>
+            </binaryDataArray>
+          </binaryDataArrayList>
+        </spectrum>
+"""
+
+
+def write_indexed_mzml(
+    path: Path,
+    run_id: str,
+    scan_numbers: np.ndarray,
+    precursor_mzs: np.ndarray,
+    charges: np.ndarray,
+    retention_times: np.ndarray,
+    mzs: List[np.ndarray],
+    intensities: List[np.ndarray],
+):
+    """
+    Write MS2 spectra to an indexed mzML file with Thermo style native IDs
+    (controllerType=0 controllerNumber=1 scan=N), uncompressed 64-bit m/z and
+    32-bit intensity arrays, the spectrum offset index and the SHA-1 checksum.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".part")
+    offsets = []
+    sha1 = hashlib.sha1()
+    with open(tmp_path, "wb") as f:
+
+        def write(text: str):
+            data = text.encode()
+            sha1.update(data)
+            f.write(data)
+
+        write(_MZML_HEADER.format(run=run_id, count=len(scan_numbers)))
+        for index, scan_number in enumerate(scan_numbers):
+            native_id = f"controllerType=0 controllerNumber=1 scan={scan_number}"
+            mz = base64.b64encode(np.asarray(mzs[index], dtype="<f8").tobytes()).decode()
+            intensity = base64.b64encode(np.asarray(intensities[index], dtype="<f4").tobytes()).decode()
+            offsets.append((native_id, f.tell()))
+            write(_MZML_SPECTRUM.format(
+                index=index,
+                id=native_id,
+                length=len(mzs[index]),
+                retention_time=f"{retention_times[index]:.4f}",
+                precursor_mz=f"{precursor_mzs[index]:.5f}",
+                charge=charges[index],
+                mz_length=len(mz),
+                mz=mz,
+                intensity_length=len(intensity),
+                intensity=intensity,
+            ))
+        write("      </spectrumList>\n    </run>\n  </mzML>\n")
+
+        index_offset = f.tell()
+        write('  <indexList count="1">\n    <index name="spectrum">\n')
+        for native_id, offset in offsets:
+            write(f'      <offset idRef="{native_id}">{offset}</offset>\n')
+        write(f"    </index>\n  </indexList>\n  <indexListOffset>{index_offset}</indexListOffset>\n")
+        write("  <fileChecksum>")
+        f.write(f"{sha1.hexdigest()}</fileChecksum>\n</indexedmzML>\n".encode())
+    os.replace(tmp_path, path)
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> float:
+    """
+    Peak resident set size in MB, since the last reset on Linux.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if platform.system() == "Linux" else peak / 1024 ** 2
+
+
+def _children_peak_rss() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 1024 if platform.system() == "Linux" else peak / 1024 ** 2
+
+
+class StageStats:
+    """
+    Wall time, calls, items and peak RSS per stage.
+    """
+
+    def __init__(self, stages: List[str]):
+        self.stages = {
+            name: {"seconds": 0.0, "calls": 0, "items": 0, "peak_rss_mb": 0.0, "children_peak_rss_mb": 0.0}
+            for name in stages
+        }
+        self.rss_scope = "stage" if _reset_peak_rss() else "process"
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0):
+        """
+        Time a block, the yielded dict's items can be updated inside the block.
+        """
+        stats = self.stages.setdefault(
+            name, {"seconds": 0.0, "calls": 0, "items": 0, "peak_rss_mb": 0.0, "children_peak_rss_mb": 0.0}
+        )
+        measurement = {"items": items}
+        _reset_peak_rss()
+        start = time.perf_counter()
+        yield measurement
+        stats["seconds"] += time.perf_counter() - start
+        stats["calls"] += 1
+        stats["items"] += measurement["items"]
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], _peak_rss())
+        stats["children_peak_rss_mb"] = max(stats["children_peak_rss_mb"], _children_peak_rss())
+
+
+STAGES = ["index_build", "ambiguity_matching", "spectrum_extraction", "spectrum_lookup", "output_writing"]
+"""
+Benchmarked stages of the search, in order.
+"""
+
+
+def benchmark_search(dataset_dir: Path, outfile: Path, workers: Optional[int] = None, consensus: bool = False) -> Dict:
+    """
+    Run the ambiguity search on a dataset stage by stage.
+
+    Returns
+    -------
+    Dict
+        Number of pairs, total seconds and the statistics of each stage.
+    """
+    dataset_dir = Path(dataset_dir)
+    searcher = MaxQuantAmbiguitySearch(
+        sorted(dataset_dir.joinpath("maxquant").iterdir()),
+        dataset_dir / "mzml",
+        workers=workers,
+        consensus=consensus,
+    )
+    stats = StageStats(STAGES)
+    start = time.perf_counter()
+
+    with stats.stage("index_build") as measurement:
+        peptide_index = searcher.build_peptide_index()
+        measurement["items"] = int(peptide_index.offsets[-1])
+
+    with stats.stage("ambiguity_matching", items=len(peptide_index)):
+        pairs = searcher.find_ambiguity_pairs(peptide_index)
+
+    with stats.stage("spectrum_extraction") as measurement:
+        positions = sorted({p for pair in pairs for p in pair})
+        store = searcher.extract_spectra(
+            (r for p in positions for r in searcher.spectrum_raw_files(peptide_index, p)),
+            Path(outfile).with_name("extracted_spectra"),
+        )
+        measurement["items"] = len(store)
+
+    with stats.stage("output_writing"):
+        writer = pq.ParquetWriter(outfile, searcher.result_schema())
+    for batch_start in range(0, len(pairs), searcher.RESULT_BATCH_SIZE):
+        batch_pairs = pairs[batch_start:batch_start + searcher.RESULT_BATCH_SIZE]
+        positions = sorted({p for pair in batch_pairs for p in pair})
+        with stats.stage("spectrum_lookup", items=len(positions)):
+            spectra = searcher.load_spectra(peptide_index, positions, [store])
+        with stats.stage("output_writing", items=len(batch_pairs)):
+            writer.write_batch(searcher.result_batch(peptide_index, batch_pairs, spectra))
+    with stats.stage("output_writing"):
+        writer.close()
+
+    return {
+        "n_pairs": len(pairs),
+        "total_seconds": time.perf_counter() - start,
+        "peak_rss_scope": stats.rss_scope,
+        "stages": stats.stages,
+    }
+
+
+def prepare_dataset(generator: SyntheticMaxQuantData, dataset_dir: Path, regenerate: bool = False) -> Dict:
+    """
+    Generate a dataset unless dataset_dir has one with the same parameters.
+
+    Returns
+    -------
+    Dict
+        Parameters, statistics and generation time of the dataset.
+    """
+    dataset_dir = Path(dataset_dir)
+    meta_file = dataset_dir / "dataset.json"
+    if meta_file.exists() and not regenerate:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["parameters"] == generator.parameters():
+            return meta
+
+    meta_file.unlink(missing_ok=True)
+    for old_file in [*dataset_dir.glob("maxquant/*/msms.txt"), *dataset_dir.glob("mzml/*.mzML")]:
+        old_file.unlink()
+    start = time.perf_counter()
+    statistics = generator.write(dataset_dir)
+    meta = {
+        "parameters": generator.parameters(),
+        "statistics": statistics,
+        "generation_seconds": time.perf_counter() - start,
+    }
+    # written last, marks the dataset as complete
+    with open(meta_file, "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def find_regressions(baseline: Dict, results: Dict, tolerance: float = 0.2, min_seconds: float = 0.5) -> List[str]:
+    """
+    Stages of runs with the same number of PSMs which are more than tolerance
+    (relative) and min_seconds (absolute) slower than in the baseline.
+    """
+    baseline_runs = {run["dataset"]["parameters"]["n_psms"]: run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        n_psms = run["dataset"]["parameters"]["n_psms"]
+        if n_psms not in baseline_runs:
+            continue
+        for name, stats in run["stages"].items():
+            before = baseline_runs[n_psms]["stages"].get(name, {}).get("seconds")
+            if before is None:
+                continue
+            if stats["seconds"] > before * (1 + tolerance) and stats["seconds"] - before > min_seconds:
+                regressions.append(
+                    f"{name} with {n_psms} PSMs: {stats['seconds']:.2f} s, was {before:.2f} s"
+                )
+    return regressions
+
+
+def get_cli():
+    """
+    Command line interface for the ambiguity search benchmark
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the MaxQuant ambiguity search on synthetic MaxQuant and mzML data."
+    )
+    parser.add_argument(
+        "outfile",
+        type=Path,
+        help="JSON file with the statistics of each stage and scale."
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=Path("benchmark"),
+        help="Directory of the generated datasets and search results, datasets are reused."
+    )
+    parser.add_argument(
+        "--psms",
+        nargs="+",
+        type=int,
+        default=[10_000, 100_000, 1_000_000, 10_000_000],
+        help="Numbers of PSMs to benchmark."
+    )
+    parser.add_argument(
+        "--siblings",
+        type=Path,
+        default=SIBLINGS_FILE,
+        help="Sibling groups (.siblings file of find_siblings.digest_find_siblings)."
+    )
+    parser.add_argument(
+        "--sibling-rate",
+        type=float,
+        default=None,
+        help=f"Fraction of the I/L sequences with siblings (default: from --fasta, or {DEFAULT_SIBLING_RATE})."
+    )
+    parser.add_argument(
+        "--fasta",
+        type=Path,
+        default=None,
+        help="Proteome of the siblings file, to compute the sibling rate."
+    )
+    parser.add_argument(
+        "--psms-per-sequence",
+        type=float,
+        default=4.0,
+        help="Mean number of PSMs per sequence."
+    )
+    parser.add_argument(
+        "--psms-per-raw-file",
+        type=int,
+        default=20_000,
+        help="Number of PSMs per raw file (mzML file)."
+    )
+    parser.add_argument(
+        "--psms-per-folder",
+        type=int,
+        default=1_000_000,
+        help="Number of PSMs per MaxQuant folder."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the data generation."
+    )
+    parser.add_argument(
+        "--regenerate",
+        action="store_true",
+        help="Generate the datasets even if they exist."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes reading mzML files in parallel (default: number of CPUs)."
+    )
+    parser.add_argument(
+        "--consensus",
+        action="store_true",
+        help="Benchmark the search with consensus spectra."
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Earlier benchmark JSON, exit with status 1 if a stage got slower."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown of a stage compared to the baseline counted as regression."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+
+    sibling_groups = read_sibling_groups(args.siblings)
+    sibling_rate = args.sibling_rate
+    if sibling_rate is None:
+        sibling_rate = (
+            proteome_sibling_rate(sibling_groups, args.fasta) if args.fasta is not None else DEFAULT_SIBLING_RATE
+        )
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workers": args.workers,
+        "consensus": args.consensus,
+        "runs": [],
+    }
+    for n_psms in args.psms:
+        generator = SyntheticMaxQuantData(
+            n_psms,
+            sibling_groups,
+            sibling_rate=sibling_rate,
+            psms_per_sequence=args.psms_per_sequence,
+            psms_per_raw_file=args.psms_per_raw_file,
+            psms_per_folder=args.psms_per_folder,
+            seed=args.seed,
+        )
+        dataset_dir = args.work_dir / f"psms_{n_psms}_seed_{args.seed}"
+        dataset = prepare_dataset(generator, dataset_dir, args.regenerate)
+
+        gc.collect()
+        run = benchmark_search(dataset_dir, dataset_dir / "pairs.parquet", args.workers, args.consensus)
+        results["runs"].append({"dataset": dataset, **run})
+        print(
+            f"{n_psms} PSMs: {run['n_pairs']} pairs in {run['total_seconds']:.2f} s ("
+            + ", ".join(f"{name} {stats['seconds']:.2f} s" for name, stats in run["stages"].items())
+            + ")"
+        )
+
+        # written after every scale, so that the finished scales are kept if a larger one fails
+        tmp_path = args.outfile.with_name(args.outfile.name + ".part")
+        with open(tmp_path, "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(tmp_path, args.outfile)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
@@ -1,12 +1,63 @@
 import argparse
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations, islice
 from pathlib import Path
-from typing import ClassVar, Dict, List, Set
+from typing import ClassVar, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pyteomics.mzml
 from tqdm import tqdm
 
+from ambiguity_search.peptide_index import PeptideIndex, PeptideIndexBuilder
+from ambiguity_search.search_state import SearchState, psm_signature
+from pipeline.instrumentation import count, timer
+from spectra.consensus import consensus_spectra
+from spectra.store import SpectrumStore, convert_spectra
+
+
+def read_mzml_scans(mzml_path: Path, scan_numbers: List[int]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the given scans from one indexed mzML file. The scans are read in
+    ascending order and the file is closed afterwards.
+
+    Parameters
+    ----------
+    mzml_path : Path
+        Path to the mzML file.
+    scan_numbers : List[int]
+        Scan numbers to read.
+
+    Returns
+    -------
+    Dict[int, Tuple[np.ndarray, np.ndarray]]
+        m/z and intensity arrays by scan number. Scans missing in the file are left out.
+    """
+    spectra = {}
+    with pyteomics.mzml.MzML(str(mzml_path), use_index=True) as mzml:
+        for scan_number in sorted(scan_numbers):
+            try:
+                spectrum = mzml.get_by_id(
+                    f"controllerType=0 controllerNumber=1 scan={scan_number}"
+                )
+            except KeyError:
+                continue
+            spectra[scan_number] = (spectrum["m/z array"], spectrum["intensity array"])
+    return spectra
+
+
+def list_array(arrays: List[np.ndarray], dtype) -> pa.ListArray:
+    """
+    Arrow list array from a list of NumPy arrays, without converting the values to Python objects.
+    """
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int32)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    values = np.concatenate([np.asarray(a, dtype=dtype) for a in arrays]) if arrays else np.array([], dtype=dtype)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
 
 
 class MaxQuantAmbiguitySearch:
@@ -19,20 +70,38 @@ class MaxQuantAmbiguitySearch:
     Ambiguities of interes
     """
 
-    AMBIGUOUS_AA_REPL: ClassVar[Dict[str, str]] = {
-        "I": "L",
-        "L": "I"
-    }
+    COLLAPSED_AA: ClassVar[str] = "J"
+    """
+    Replacement for all ambiguous amino acids in the key sequences are grouped by.
+    """
+
+    MAX_PAIRS_PER_GROUP: ClassVar[Optional[int]] = None
     """
-    Replacements for ambiguous amino acids.
+    Default number of pairs emitted per group of ambiguous sequences. None means all pairs.
     """
 
-    FIRST_N: ClassVar[int] = 1
+    CONSENSUS_CHUNK_SIZE: ClassVar[int] = 1000
     """
-    Number of ambiguities to consider for each peptide. 1 means only the first ambiguity is considered.
+    Number of sequences whose consensus spectra are computed at once.
     """
 
-    def __init__(self, maxquant_folders: List[Path], mzml_folders: Path):
+    RESULT_BATCH_SIZE: ClassVar[int] = 10000
+    """
+    Number of pairs whose spectra are loaded at once, one Parquet row group each.
+    """
+
+    def __init__(
+        self,
+        maxquant_folders: List[Path],
+        mzml_folders: Path,
+        workers: Optional[int] = None,
+        block_size: int = 64 << 20,
+        max_pairs_per_group: Optional[int] = None,
+        consensus: bool = False,
+        consensus_top_n: Optional[int] = None,
+        consensus_tolerance: float = 20.0,
+        state_dir: Optional[Path] = None,
+    ):
         """
         Initialize the MaxQuantAmbiguitySearch with a list of MaxQuant results.
         
@@ -40,16 +109,49 @@ class MaxQuantAmbiguitySearch:
         ----------
         maxquant_folders : List[Path]
             A list of paths to MaxQuant results containing the 'msms.txt' files.
+        mzml_folders : Path
+            Folder containing the mzML files named after the raw files, or a
+            spectrum store (see spectra.store) converted from them.
+        workers : Optional[int]
+            Number of processes reading mzML files in parallel (default: number of CPUs).
+        block_size : int
+            Number of bytes of each msms.txt parsed at once.
+        max_pairs_per_group : Optional[int]
+            Number of pairs emitted per group of ambiguous sequences, pairs of the
+            sequences with the most PSMs come first. Defaults to MAX_PAIRS_PER_GROUP.
+        consensus : bool
+            Merge the spectra of all PSMs of a sequence into a consensus spectrum
+            instead of using the spectrum of its best scoring PSM.
+        consensus_top_n : Optional[int]
+            Only merge the N best scoring PSMs of each sequence (default: all).
+        consensus_tolerance : float
+            Peak clustering tolerance of the consensus spectra in ppm.
+        state_dir : Optional[Path]
+            Directory persisting the PSMs of each folder and the pairs emitted
+            so far (see search_state). If given, only folders whose msms.txt
+            changed are read and only new or changed pairs are returned.
         """
         self.maxquant_folders = maxquant_folders
         self.mzml_folders = mzml_folders
-        self.mzmls = {}
+        self.spectrum_store = SpectrumStore(mzml_folders) if SpectrumStore.is_store(mzml_folders) else None
+        self.workers = workers
+        self.block_size = block_size
+        self.max_pairs_per_group = (
+            self.MAX_PAIRS_PER_GROUP if max_pairs_per_group is None else max_pairs_per_group
+        )
+        self.consensus = consensus
+        self.consensus_top_n = consensus_top_n
+        self.consensus_tolerance = consensus_tolerance
+        self.state = SearchState(state_dir) if state_dir is not None else None
 
-    def search(self) -> pd.DataFrame:
+    def build_peptide_index(self) -> PeptideIndex:
         """
-        Search for peptides with I/L substitutions
+        Index the PSMs of all sequences containing ambiguous amino acids.
         """
-        peptide_index = defaultdict(set)
+        builder = PeptideIndexBuilder(
+            sequence_pattern=f"[{''.join(sorted(self.AMBIGUOUS_AA))}]",
+            block_size=self.block_size,
+        )
 
         for folder in tqdm(self.maxquant_folders, desc="Builidng peptide index"):
             if not folder.is_dir():
@@ -60,70 +162,396 @@ class MaxQuantAmbiguitySearch:
                 tqdm.write(f"Skipping folder without msms.txt: {folder}")
                 continue
 
-            msms_df = pd.read_csv(
-                msms_file,
-                sep="\t",
-                usecols=["Sequence", "Raw file", "Score", "Scan number"]
-            )
-            msms_df.sort_values(by=["Score"], inplace=True, ascending=False)
+            with timer("msms_loading", nbytes=msms_file.stat().st_size) as measurement:
+                if self.state is None:
+                    measurement.items = builder.add_msms(msms_file)
+                    continue
 
-            for row in msms_df[["Sequence", "Raw file", "Scan number"]].itertuples():
-                for aa in row[1]:
-                    if aa in self.AMBIGUOUS_AA:
-                        peptide_index[row[1]].add(f"{row[2]}:{row[3]}")
-                        break
+                fingerprint = self.state.fingerprint(msms_file, self.state.known_fingerprint(folder))
+                psms_df = self.state.cached_psms(folder, fingerprint)
+                if psms_df is None:
+                    count("psm_cache.misses")
+                    psms_dfs = list(builder.read_msms(msms_file))
+                    psms_df = (
+                        pd.concat(psms_dfs, ignore_index=True) if psms_dfs
+                        else pd.DataFrame(columns=SearchState.PSM_COLUMNS)
+                    )
+                    self.state.store_psms(folder, fingerprint, psms_df)
+                else:
+                    count("psm_cache.hits")
+                builder.add_msms_df(psms_df)
+                measurement.items = len(psms_df)
 
-        ambiguities = []
+        if self.state is not None:
+            self.state.retain_folders(self.maxquant_folders)
 
-        for seq, raw_files in tqdm(peptide_index.items(), desc="Searching for ambiguities and loading spectra"):
-            ambiguity_matches = 0
+        return builder.build()
 
-            for idx, aa in enumerate(seq):
-                if ambiguity_matches == self.FIRST_N:
-                    break
+    def find_ambiguity_pairs(self, peptide_index: PeptideIndex) -> List[Tuple[int, int]]:
+        """
+        Group the sequences by their key with all ambiguous amino acids collapsed
+        (e.g. LPILPR and IPLLPR -> JPJJPJ) and pair the sequences of each group.
+        Sequences differing at any number of positions are paired.
 
-                if aa not in self.AMBIGUOUS_AA:
-                    continue
+        Returns
+        -------
+        List[Tuple[int, int]]
+            Pairs of positions in the peptide index.
+        """
+        collapse = str.maketrans({aa: self.COLLAPSED_AA for aa in self.AMBIGUOUS_AA})
+        keys = pd.Series(peptide_index.sequences, dtype=object).str.translate(collapse)
+        group_codes, _ = pd.factorize(keys)
+
+        # group members next to each other, most PSMs first
+        order = np.lexsort((-peptide_index.psm_counts, group_codes))
+        group_starts = np.flatnonzero(np.diff(group_codes[order], prepend=-1))
+        group_stops = np.append(group_starts[1:], len(order))
+        has_siblings = group_stops - group_starts > 1
+
+        pairs = []
+        for start, stop in zip(group_starts[has_siblings], group_stops[has_siblings]):
+            pairs.extend(
+                islice(combinations(order[start:stop], 2), self.max_pairs_per_group)
+            )
+        return pairs
 
-                ambiguous_seq = list(seq)
-                ambiguous_seq[idx] = self.AMBIGUOUS_AA_REPL[aa]
-                ambiguous_seq = "".join(ambiguous_seq) # type: ignore
-
-                ambiguous_raw_files = peptide_index.get(ambiguous_seq)
-
-                if ambiguous_raw_files is not None:
-                    raw_files = list(raw_files) # type: ignore
-                    ambiguous_raw_files = list(ambiguous_raw_files) # type: ignore
-                    seq_spectrum = self.get_spectrum(raw_files[0])
-                    ambiguous_seq_spectrum = self.get_spectrum(ambiguous_raw_files[0])  # type: ignore
-                    ambiguities.append(
-                        [
-                            seq,
-                            ambiguous_seq,
-                            ", ".join(raw_files),
-                            ", ".join(ambiguous_raw_files),
-                            seq_spectrum[0],
-                            seq_spectrum[1],
-                            ambiguous_seq_spectrum[0],
-                            ambiguous_seq_spectrum[1]
-                        ]
-                    )
-                    ambiguity_matches += 1
-
-        ambiguous_df = pd.DataFrame(
-            ambiguities,
-            columns=[
-                "sequence",
-                "ambigous_sequence",
-                "sequence_raw_files",
-                "ambiguous_sequence_raw_files",
-                "sequence_mz",
-                "sequence_intensity",
-                "ambiguous_sequence_mz",
-                "ambiguous_sequence_intensity"
-            ]
+    @staticmethod
+    def pair_signatures(peptide_index: PeptideIndex, pairs: List[Tuple[int, int]]) -> np.ndarray:
+        """
+        Signature of each pair over the PSMs of both sequences, it changes
+        whenever a PSM of either sequence is added or removed.
+        """
+        positions = sorted({p for pair in pairs for p in pair})
+        signatures = dict(
+            zip(positions, (psm_signature(peptide_index.psm_raw_files(p)) for p in positions))
+        )
+        return np.fromiter(
+            (psm_signature((str(signatures[p]), str(signatures[q]))) for p, q in pairs),
+            dtype=np.int64,
+            count=len(pairs),
         )
-        return ambiguous_df
+
+    def result_schema(self) -> pa.Schema:
+        """
+        Schema of the search results.
+        """
+        fields = [
+            ("sequence", pa.string()),
+            ("ambigous_sequence", pa.string()),
+            ("sequence_raw_files", pa.list_(pa.string())),
+            ("ambiguous_sequence_raw_files", pa.list_(pa.string())),
+            ("sequence_mz", pa.list_(pa.float32())),
+            ("sequence_intensity", pa.list_(pa.float32())),
+            ("ambiguous_sequence_mz", pa.list_(pa.float32())),
+            ("ambiguous_sequence_intensity", pa.list_(pa.float32())),
+        ]
+        if self.consensus:
+            fields += [
+                ("sequence_support", pa.list_(pa.int32())),
+                ("ambiguous_sequence_support", pa.list_(pa.int32())),
+            ]
+        return pa.schema(fields)
+
+    def search_batches(self) -> Iterator[pa.RecordBatch]:
+        """
+        Search for peptides with I/L substitutions and yield the results in
+        batches of RESULT_BATCH_SIZE pairs. The spectra of all pairs are
+        extracted from the mzML files in one pass into a spectrum store (see
+        extract_spectra) and looked up from it per batch.
+        With a state directory only new pairs and pairs whose PSMs changed
+        since the last run are yielded, the extracted spectra are kept for
+        later runs and the state is saved when the generator finishes, fails
+        or is closed, with the batches which were consumed so far.
+        """
+        peptide_index = self.build_peptide_index()
+        with timer("sibling_grouping", items=len(peptide_index)):
+            pairs = self.find_ambiguity_pairs(peptide_index)
+        count("sibling_pairs", len(pairs))
+
+        if self.state is not None:
+            pair_sequences = [
+                (peptide_index.sequences[p], peptide_index.sequences[q]) for p, q in pairs
+            ]
+            signatures = self.pair_signatures(peptide_index, pairs)
+            changed = self.state.changed_pairs(pair_sequences, signatures)
+            tqdm.write(f"{changed.sum()} of {len(pairs)} pairs are new or changed")
+            emitted = ~changed
+            changed_idx = np.flatnonzero(changed)
+            pairs = [pairs[idx] for idx in changed_idx]
+
+        try:
+            with tempfile.TemporaryDirectory(prefix="extracted_spectra_") as tmp_dir:
+                stores = self.spectrum_stores(peptide_index, pairs, Path(tmp_dir))
+
+                for start in tqdm(range(0, len(pairs), self.RESULT_BATCH_SIZE), desc="Writing pairs", unit="batch"):
+                    batch_pairs = pairs[start:start + self.RESULT_BATCH_SIZE]
+                    with timer("pair_batches", items=len(batch_pairs)):
+                        spectra = self.load_spectra(
+                            peptide_index, sorted({p for pair in batch_pairs for p in pair}), stores
+                        )
+                        batch = self.result_batch(peptide_index, batch_pairs, spectra)
+                    yield batch
+                    # the consumer asked for the next batch, so it took this one
+                    if self.state is not None:
+                        emitted[changed_idx[start:start + self.RESULT_BATCH_SIZE]] = True
+        finally:
+            if self.state is not None:
+                self.state.save([pair_sequences[idx] for idx in np.flatnonzero(emitted)], signatures[emitted])
+
+    def spectrum_stores(
+        self, peptide_index: PeptideIndex, pairs: List[Tuple[int, int]], tmp_dir: Path
+    ) -> List[SpectrumStore]:
+        """
+        Stores with the spectra of all sequences of the pairs: the store the
+        search was created with, or the stores of earlier runs in the state
+        directory plus one with the spectra extracted now, which is kept in
+        the state directory or written to tmp_dir without state.
+        """
+        if self.spectrum_store is not None:
+            return [self.spectrum_store]
+
+        stores = self.state.spectrum_stores(self.mzml_folders) if self.state is not None else []
+        positions = sorted({p for pair in pairs for p in pair})
+        raw_files = list(dict.fromkeys(r for p in positions for r in self.spectrum_raw_files(peptide_index, p)))
+        stored = self._get_stored_spectra(raw_files, stores)
+        missing = [raw_file for raw_file in raw_files if raw_file not in stored]
+        if stores:
+            tqdm.write(f"{len(stored)} of {len(raw_files)} spectra were extracted by earlier runs")
+        if not missing:
+            return stores
+
+        if self.state is None:
+            return [self.extract_spectra(missing, tmp_dir)]
+        store = self.extract_spectra(missing, self.state.new_spectrum_store_dir())
+        self.state.add_spectrum_store(store, self.mzml_folders)
+        return stores + [store]
+
+    def result_batch(
+        self, peptide_index: PeptideIndex, pairs: List[Tuple[int, int]], spectra: Dict[int, Tuple]
+    ) -> pa.RecordBatch:
+        """
+        Result rows of pairs, with the spectra loaded by load_spectra for all positions of the pairs.
+        """
+        schema = self.result_schema()
+        positions = [p for p, _ in pairs]
+        ambiguous_positions = [q for _, q in pairs]
+
+        columns = {
+            "sequence": pa.array(peptide_index.sequences[positions], type=pa.string()),
+            "ambigous_sequence": pa.array(peptide_index.sequences[ambiguous_positions], type=pa.string()),
+        }
+        for prefix, side in (("sequence", positions), ("ambiguous_sequence", ambiguous_positions)):
+            columns[f"{prefix}_raw_files"] = pa.array(
+                [peptide_index.psm_raw_files(p) for p in side], type=pa.list_(pa.string())
+            )
+            columns[f"{prefix}_mz"] = list_array([spectra[p][0] for p in side], np.float32)
+            columns[f"{prefix}_intensity"] = list_array([spectra[p][1] for p in side], np.float32)
+            if self.consensus:
+                columns[f"{prefix}_support"] = list_array([spectra[p][2] for p in side], np.int32)
+
+        return pa.RecordBatch.from_arrays([columns[name] for name in schema.names], schema=schema)
+
+    def search(self) -> pd.DataFrame:
+        """
+        Search for peptides with I/L substitutions, see search_batches.
+        The spectra and raw files are lists of NumPy arrays.
+        """
+        return pa.Table.from_batches(list(self.search_batches()), schema=self.result_schema()).to_pandas()
+
+    def write_results(self, outfile: Path) -> int:
+        """
+        Search and stream the results to a Parquet file, one row group per
+        batch, or to a TSV file with comma separated lists.
+
+        Returns
+        -------
+        int
+            Number of written pairs.
+        """
+        n_pairs = 0
+        if outfile.suffix == ".parquet":
+            with pq.ParquetWriter(outfile, self.result_schema()) as writer:
+                for batch in self.search_batches():
+                    writer.write_batch(batch)
+                    n_pairs += batch.num_rows
+            return n_pairs
+
+        with open(outfile, "w") as f:
+            f.write("\t".join(self.result_schema().names) + "\n")
+            for batch in self.search_batches():
+                rows = zip(*(
+                    column.to_pylist() if not pa.types.is_list(column.type)
+                    else [",".join(map(str, values)) for values in column.to_pylist()]
+                    for column in batch.columns
+                ))
+                f.writelines("\t".join(row) + "\n" for row in rows)
+                n_pairs += batch.num_rows
+        return n_pairs
+
+    def spectrum_raw_files(self, peptide_index: PeptideIndex, position: int) -> List[str]:
+        """
+        Raw files and scan numbers (e.g. "file.raw:123") of the PSMs whose
+        spectra make up the spectrum of a sequence in load_spectra.
+        """
+        return peptide_index.psm_raw_files(position, self.consensus_top_n if self.consensus else 1)
+
+    def load_spectra(
+        self, peptide_index: PeptideIndex, positions: List[int], stores: Optional[List[SpectrumStore]] = None
+    ) -> Dict[int, Tuple]:
+        """
+        Load the spectrum of each sequence: the spectrum of its best scoring
+        PSM, or the consensus spectrum of its (top N) PSMs.
+
+        Parameters
+        ----------
+        peptide_index : PeptideIndex
+            The peptide index.
+        positions : List[int]
+            Positions of the sequences in the peptide index.
+        stores : Optional[List[SpectrumStore]]
+            Stores the spectra are looked up in, see get_spectra.
+
+        Returns
+        -------
+        Dict[int, Tuple]
+            m/z and intensity array by position, followed by the support of
+            each peak for consensus spectra.
+        """
+        if not self.consensus:
+            raw_files = {position: self.spectrum_raw_files(peptide_index, position)[0] for position in positions}
+            spectra = self.get_spectra(raw_files.values(), stores)
+            return {position: spectra.get(raw_file, ([], [])) for position, raw_file in raw_files.items()}
+
+        # sequences are merged in chunks to bound the number of spectra in memory,
+        # with stores the chunks are looked up instead of reading the mzML files per chunk
+        consensus_by_position = {}
+        for start in range(0, len(positions), self.CONSENSUS_CHUNK_SIZE):
+            chunk = positions[start:start + self.CONSENSUS_CHUNK_SIZE]
+            raw_files = {position: self.spectrum_raw_files(peptide_index, position) for position in chunk}
+            spectra = self.get_spectra((r for position in chunk for r in raw_files[position]), stores)
+            consensus = consensus_spectra(
+                [[spectra[r] for r in raw_files[position] if r in spectra] for position in chunk],
+                tolerance=self.consensus_tolerance,
+            )
+            for idx, position in enumerate(chunk):
+                consensus_by_position[position] = consensus.spectrum(idx)
+
+        return consensus_by_position
+
+    def _mzml_scans(self, raw_files: Iterable[str]) -> List[Tuple[str, Path, List[int]]]:
+        """
+        Group requested spectra ("file.raw:123") by raw file. Raw files
+        without mzML file are skipped.
+
+        Returns
+        -------
+        List[Tuple[str, Path, List[int]]]
+            Raw file, mzML file and the sorted distinct scan numbers, ordered by raw file.
+        """
+        scans_by_file = defaultdict(set)
+        for raw_file in raw_files:
+            raw_file, scan_number = raw_file.split(":")
+            scans_by_file[raw_file].add(int(scan_number))
+
+        mzml_scans = []
+        for raw_file in sorted(scans_by_file):
+            mzml_path = self.mzml_folders.joinpath(raw_file + ".mzML")
+            if not mzml_path.exists():
+                tqdm.write(f"Skipping missing mzML file: {mzml_path}")
+                continue
+            mzml_scans.append((raw_file, mzml_path, sorted(scans_by_file[raw_file])))
+        return mzml_scans
+
+    def extract_spectra(self, raw_files: Iterable[str], store_dir: Path) -> SpectrumStore:
+        """
+        Extract the spectra of many raw files and scan numbers from the mzML
+        files into a spectrum store. The requested scans are grouped by raw
+        file and every mzML file is read once, in scan order, by one of the
+        worker processes of a single pool, which only decodes the requested scans.
+
+        Parameters
+        ----------
+        raw_files : Iterable[str]
+            The basenames of the raw files and the scan numbers,
+            separated by a colon (e.g., "file.raw:123").
+        store_dir : Path
+            Directory of the store.
+        """
+        mzml_scans = self._mzml_scans(raw_files)
+        mzml_paths = [mzml_path for _, mzml_path, _ in mzml_scans]
+        scan_numbers = [scan_numbers for _, _, scan_numbers in mzml_scans]
+
+        with timer("mzml_store_extraction", nbytes=sum(p.stat().st_size for p in mzml_paths)) as measurement:
+            store = convert_spectra(mzml_paths, store_dir, self.workers, scan_numbers)
+            measurement.items = len(store)
+        return store
+
+    def get_spectra(
+        self, raw_files: Iterable[str], stores: Optional[List[SpectrumStore]] = None
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Get the spectra for many raw files and scan numbers.
+
+        The spectra are looked up in the given stores, or the store the search
+        was created with. Without a store the requested scans are grouped by
+        raw file and every mzML file is read once, in scan order, by a worker
+        process which only decodes the requested scans and closes the file afterwards.
+
+        Parameters
+        ----------
+        raw_files : Iterable[str]
+            The basenames of the raw files and the scan numbers,
+            separated by a colon (e.g., "file.raw:123").
+        stores : Optional[List[SpectrumStore]]
+            Stores with the spectra, e.g. from extract_spectra.
+
+        Returns
+        -------
+        Dict[str, Tuple[np.ndarray, np.ndarray]]
+            m/z and intensity arrays by requested raw file and scan number.
+            Spectra which could not be found are left out.
+        """
+        if stores is None and self.spectrum_store is not None:
+            stores = [self.spectrum_store]
+        if stores is not None:
+            return self._get_stored_spectra(raw_files, stores)
+
+        spectra = {}
+        with timer("mzml_scan_reading") as measurement, ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for raw_file, mzml_path, scan_numbers in self._mzml_scans(raw_files):
+                futures[executor.submit(read_mzml_scans, mzml_path, scan_numbers)] = raw_file
+                measurement.nbytes += mzml_path.stat().st_size
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting spectra"):
+                raw_file = futures[future]
+                for scan_number, spectrum in future.result().items():
+                    spectra[f"{raw_file}:{scan_number}"] = spectrum
+            measurement.items = len(spectra)
+
+        return spectra
+
+    def _get_stored_spectra(
+        self, raw_files: Iterable[str], stores: List[SpectrumStore]
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        get_spectra for spectrum stores, the spectra are views of the mapped
+        arrays of the first store containing them.
+        """
+        missing = list(dict.fromkeys(raw_files))
+        spectra = {}
+        with timer("spectrum_store_lookup", items=len(missing)):
+            for store in stores:
+                if not missing:
+                    break
+                files, scan_numbers = zip(*(raw_file.split(":") for raw_file in missing))
+                rows = store.rows(files, (int(s) for s in scan_numbers))
+                spectra.update(
+                    (raw_file, store.spectrum(row)) for raw_file, row in zip(missing, rows) if row >= 0
+                )
+                missing = [raw_file for raw_file, row in zip(missing, rows) if row < 0]
+
+        return spectra
 
     def get_spectrum(self, raw_file: str):
         """
@@ -140,21 +568,17 @@ class MaxQuantAmbiguitySearch:
         Tupel[List[float], List[float]]
             A tuple containing two lists: m/z values and intensity values of the spectrum.s
         """
+        if self.spectrum_store is not None:
+            return self._get_stored_spectra([raw_file], [self.spectrum_store]).get(raw_file, ([], []))
+
         raw_file, scan_number = raw_file.split(":")
-        mzml_file = raw_file + ".mzML"
+        mzml_path = self.mzml_folders.joinpath(raw_file + ".mzML")
 
-        if mzml_file not in self.mzmls:
-            mzml_path = self.mzml_folders.joinpath(mzml_file)
-            if not mzml_path.exists():
-                tqdm.write(f"Skipping missing mzML file: {mzml_path}")
-                return ([], [])
+        if not mzml_path.exists():
+            tqdm.write(f"Skipping missing mzML file: {mzml_path}")
+            return ([], [])
 
-            self.mzmls[mzml_file] = pyteomics.mzml.MzML(str(mzml_path), use_index=True)
-
-        spectrum = self.mzmls[mzml_file].get_by_id(
-            f"controllerType=0 controllerNumber=1 scan={scan_number}"
-        )
-        return spectrum["m/z array"], spectrum["intensity array"]
+        return read_mzml_scans(mzml_path, [int(scan_number)]).get(int(scan_number), ([], []))
 
 def get_cli():
     """
@@ -167,12 +591,13 @@ def get_cli():
     parser.add_argument(
         "outfile",
         type=Path,
-        help="Path the outfile. (.tsv == tab-separated values, .parquet == Parquet format, unknown: .tsv)"
+        help="Path the outfile. (.parquet == Parquet with list columns, written in row groups, "
+             "other: tab-separated values with comma-separated lists)"
     )
     parser.add_argument(
         "mzml_folder",
         type=Path,
-        help="Path to the folder containing mzML files."
+        help="Path to the folder containing mzML files, or to a spectrum store converted from them."
     )
     parser.add_argument(
         "maxquant_folders",
@@ -180,6 +605,50 @@ def get_cli():
         type=Path,
         help="Paths to MaxQuant result folders containing 'msms.txt' files."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes reading mzML files in parallel (default: number of CPUs)."
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=64 << 20,
+        help="Number of bytes of each msms.txt parsed at once."
+    )
+    parser.add_argument(
+        "--max-pairs-per-group",
+        type=int,
+        default=None,
+        help="Number of pairs emitted per group of ambiguous sequences (default: all pairs)."
+    )
+    parser.add_argument(
+        "--consensus",
+        action="store_true",
+        help="Use consensus spectra of all PSMs of a sequence instead of the spectrum of the best PSM."
+    )
+    parser.add_argument(
+        "--consensus-top-n",
+        type=int,
+        default=None,
+        help="Only merge the N best scoring PSMs of each sequence into the consensus spectrum (default: all)."
+    )
+    parser.add_argument(
+        "--consensus-tolerance",
+        type=float,
+        default=20.0,
+        help="Peak clustering tolerance of the consensus spectra in ppm."
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=Path,
+        default=None,
+        help="Directory keeping the PSMs, emitted pairs and extracted spectra between runs. Only changed "
+             "folders are re-read, only new or changed pairs are written and only spectra "
+             "not extracted before are read from the mzML files. "
+             "Use one state directory per set of options."
+    )
 
 
     return parser
@@ -193,14 +662,19 @@ def main():
     cli = get_cli()
     args = cli.parse_args()
 
-    searcher = MaxQuantAmbiguitySearch(args.maxquant_folders, args.mzml_folder)
-    ambiguous_peptides = searcher.search()
-
-    match args.outfile.suffix:
-        case ".parquet":
-            ambiguous_peptides.to_parquet(args.outfile, index=False)
-        case _:
-            ambiguous_peptides.to_csv(args.outfile, index=False, sep="\t")
+    searcher = MaxQuantAmbiguitySearch(
+        args.maxquant_folders,
+        args.mzml_folder,
+        args.workers,
+        args.block_size,
+        args.max_pairs_per_group,
+        args.consensus,
+        args.consensus_top_n,
+        args.consensus_tolerance,
+        args.state_dir,
+    )
+    n_pairs = searcher.write_results(args.outfile)
+    print(f"Wrote {n_pairs} pairs to {args.outfile}")
         
 if __name__ == "__main__":
     main()
@@ -0,0 +1,221 @@
+from pathlib import Path
+from typing import ClassVar, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+
+
+class PeptideIndex:
+    """
+    Compact index of the PSMs of each peptide sequence.
+
+    Raw file names are interned to integer codes and the PSMs are stored as
+    flat arrays, grouped by sequence and ordered by descending score within
+    each sequence. The PSMs of sequence i are the slice offsets[i]:offsets[i + 1].
+    """
+
+    def __init__(
+        self,
+        sequences: np.ndarray,
+        offsets: np.ndarray,
+        raw_file_codes: np.ndarray,
+        scan_numbers: np.ndarray,
+        scores: np.ndarray,
+        raw_files: List[str],
+    ):
+        """
+        Parameters
+        ----------
+        sequences : np.ndarray
+            Unique peptide sequences.
+        offsets : np.ndarray
+            Start of the PSMs of each sequence, plus the total number of PSMs.
+        raw_file_codes : np.ndarray
+            Code of the raw file of each PSM (position in raw_files).
+        scan_numbers : np.ndarray
+            Scan number of each PSM.
+        scores : np.ndarray
+            Score of each PSM.
+        raw_files : List[str]
+            Raw file names by code.
+        """
+        self.sequences = sequences
+        self.offsets = offsets
+        self.raw_file_codes = raw_file_codes
+        self.scan_numbers = scan_numbers
+        self.scores = scores
+        self.raw_files = raw_files
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @property
+    def psm_counts(self) -> np.ndarray:
+        """
+        Number of PSMs of each sequence.
+        """
+        return np.diff(self.offsets)
+
+    def psm_raw_files(self, position: int, top_n: Optional[int] = None) -> List[str]:
+        """
+        PSMs of the sequence at the given position as "raw:scan" strings,
+        best score first.
+        """
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        if top_n is not None:
+            stop = min(stop, start + top_n)
+        return [
+            f"{self.raw_files[raw_file_code]}:{scan_number}"
+            for raw_file_code, scan_number in zip(
+                self.raw_file_codes[start:stop], self.scan_numbers[start:stop]
+            )
+        ]
+
+
+class PeptideIndexBuilder:
+    """
+    Build a PeptideIndex from MaxQuant msms.txt files, which are streamed in
+    blocks so that only the PSMs of interest are held in memory.
+    """
+
+    COLUMNS: ClassVar[Dict[str, pa.DataType]] = {
+        "Sequence": pa.string(),
+        "Raw file": pa.string(),
+        "Score": pa.float32(),
+        "Scan number": pa.int64(),
+    }
+    """
+    Columns read from msms.txt and their types.
+    """
+
+    def __init__(self, sequence_pattern: str = "[IL]", block_size: int = 64 << 20):
+        """
+        Parameters
+        ----------
+        sequence_pattern : str
+            Regular expression a sequence has to contain to be indexed.
+        block_size : int
+            Number of bytes of msms.txt parsed at once.
+        """
+        self.sequence_pattern = sequence_pattern
+        self.block_size = block_size
+
+        self._sequence_ids: Dict[str, int] = {}
+        self._raw_file_ids: Dict[str, int] = {}
+        self._sequence_codes: List[np.ndarray] = []
+        self._raw_file_codes: List[np.ndarray] = []
+        self._scan_numbers: List[np.ndarray] = []
+        self._scores: List[np.ndarray] = []
+
+    def read_msms(self, msms_file: Path) -> Iterator[pd.DataFrame]:
+        """
+        Read the PSMs with sequences matching sequence_pattern block by block.
+        """
+        reader = pyarrow.csv.open_csv(
+            msms_file,
+            read_options=pyarrow.csv.ReadOptions(block_size=self.block_size),
+            parse_options=pyarrow.csv.ParseOptions(delimiter="\t"),
+            convert_options=pyarrow.csv.ConvertOptions(
+                include_columns=list(self.COLUMNS),
+                column_types=self.COLUMNS,
+            ),
+        )
+        for batch in reader:
+            msms_df = batch.to_pandas()
+            yield msms_df[msms_df["Sequence"].str.contains(self.sequence_pattern, regex=True)]
+
+    def add_msms(self, msms_file: Path) -> int:
+        """
+        Add all PSMs of interest of one msms.txt file.
+
+        Returns
+        -------
+        int
+            Number of added PSMs.
+        """
+        n_psms = 0
+        for msms_df in self.read_msms(msms_file):
+            self.add_msms_df(msms_df)
+            n_psms += len(msms_df)
+        return n_psms
+
+    def add_msms_df(self, msms_df: pd.DataFrame):
+        """
+        Add the PSMs of a DataFrame with the msms.txt columns in COLUMNS.
+        """
+        self.add_psms(
+            msms_df["Sequence"].to_numpy(),
+            msms_df["Raw file"].to_numpy(),
+            msms_df["Scan number"].to_numpy(),
+            msms_df["Score"].to_numpy(),
+        )
+
+    def add_psms(self, sequences, raw_files, scan_numbers, scores):
+        """
+        Add PSMs given as arrays, sequences and raw file names are interned.
+        """
+        self._sequence_codes.append(self._intern(sequences, self._sequence_ids))
+        self._raw_file_codes.append(self._intern(raw_files, self._raw_file_ids))
+        self._scan_numbers.append(np.asarray(scan_numbers, dtype=np.int32))
+        self._scores.append(np.asarray(scores, dtype=np.float32))
+
+    @staticmethod
+    def _intern(values, ids: Dict[str, int]) -> np.ndarray:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        for idx, value in enumerate(uniques):
+            unique_ids[idx] = ids.setdefault(value, len(ids))
+        return unique_ids[codes]
+
+    def build(self) -> PeptideIndex:
+        """
+        Create the index, PSMs reported more than once (e.g. in several
+        folders) are only kept once with their best score.
+        """
+        sequences = np.empty(len(self._sequence_ids), dtype=object)
+        sequences[list(self._sequence_ids.values())] = list(self._sequence_ids.keys())
+        raw_files = [""] * len(self._raw_file_ids)
+        for raw_file, code in self._raw_file_ids.items():
+            raw_files[code] = raw_file
+
+        def concat(arrays, dtype):
+            return np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+
+        sequence_codes = concat(self._sequence_codes, np.int32)
+        raw_file_codes = concat(self._raw_file_codes, np.int32)
+        scan_numbers = concat(self._scan_numbers, np.int32)
+        scores = concat(self._scores, np.float32)
+
+        # drop duplicate PSMs, keeping the best score
+        order = np.lexsort((-scores, scan_numbers, raw_file_codes, sequence_codes))
+        sequence_codes, raw_file_codes, scan_numbers, scores = (
+            a[order] for a in (sequence_codes, raw_file_codes, scan_numbers, scores)
+        )
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (
+            (sequence_codes[1:] != sequence_codes[:-1])
+            | (raw_file_codes[1:] != raw_file_codes[:-1])
+            | (scan_numbers[1:] != scan_numbers[:-1])
+        )
+        sequence_codes, raw_file_codes, scan_numbers, scores = (
+            a[keep] for a in (sequence_codes, raw_file_codes, scan_numbers, scores)
+        )
+
+        # group by sequence, best score first
+        order = np.lexsort((-scores, sequence_codes))
+        sequence_codes, raw_file_codes, scan_numbers, scores = (
+            a[order] for a in (sequence_codes, raw_file_codes, scan_numbers, scores)
+        )
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sequence_codes, minlength=len(sequences)), out=offsets[1:])
+
+        return PeptideIndex(
+            sequences=sequences,
+            offsets=offsets,
+            raw_file_codes=raw_file_codes,
+            scan_numbers=scan_numbers,
+            scores=scores,
+            raw_files=raw_files,
+        )
@@ -0,0 +1,229 @@
+"""
+State of incremental ambiguity searches.
+
+The state directory keeps, for every MaxQuant folder, the PSMs of interest read
+from its msms.txt as a Parquet part together with a fingerprint of the file
+(size, modification time and BLAKE2b hash), a signature of every pair
+emitted so far and the spectra extracted from the mzML files. A run only
+re-reads folders whose msms.txt changed, only emits pairs which are new or
+whose PSMs changed and only extracts spectra (raw file and scan) which no
+earlier run extracted. A spectrum store is dropped when the size or
+modification time of one of its mzML files changed.
+
+Layout:
+    state.json       fingerprints and part file of each folder, mzML
+                     fingerprints of each spectrum store
+    psms/<id>.parquet
+    pairs.parquet    sequence, ambigous_sequence, signature
+    spectra/<n>/     spectrum store (see spectra.store) of run n
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import ClassVar, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from spectra.store import SpectrumStore
+
+
+def file_hash(path: Path, chunk_size: int = 1 << 24) -> str:
+    """
+    BLAKE2b hex digest of a file, read in chunks.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def psm_signature(psm_raw_files: Iterable[str]) -> int:
+    """
+    64 bit signature of the PSMs of a sequence given as "raw:scan" strings.
+    """
+    digest = hashlib.blake2b("\n".join(psm_raw_files).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+class SearchState:
+    """
+    Persisted PSM parts and emitted pairs of an incremental search.
+    """
+
+    PSM_COLUMNS: ClassVar[List[str]] = ["Sequence", "Raw file", "Scan number", "Score"]
+    """
+    Columns of the PSM parts.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Parameters
+        ----------
+        path : Path
+            State directory, created if it does not exist.
+        """
+        self.path = Path(path)
+        self.path.joinpath("psms").mkdir(parents=True, exist_ok=True)
+
+        self.path.joinpath("spectra").mkdir(exist_ok=True)
+
+        state_file = self.path / "state.json"
+        self.folders: Dict[str, Dict] = {}
+        self.spectrum_store_files: Dict[str, Dict[str, Dict]] = {}
+        if state_file.exists():
+            with open(state_file) as f:
+                state = json.load(f)
+            self.folders = state["folders"]
+            self.spectrum_store_files = state.get("spectra", {})
+
+        # stores of runs which ended before saving their state
+        for store_dir in self.path.joinpath("spectra").iterdir():
+            if store_dir.name not in self.spectrum_store_files:
+                shutil.rmtree(store_dir)
+
+        pairs_file = self.path / "pairs.parquet"
+        self.pair_signatures: Dict[Tuple[str, str], int] = {}
+        if pairs_file.exists():
+            pairs_df = pd.read_parquet(pairs_file)
+            self.pair_signatures = dict(
+                zip(
+                    zip(pairs_df["sequence"], pairs_df["ambigous_sequence"]),
+                    pairs_df["signature"].tolist(),
+                )
+            )
+
+    @staticmethod
+    def folder_key(folder: Path) -> str:
+        return str(Path(folder).resolve())
+
+    def fingerprint(self, msms_file: Path, known: Optional[Dict] = None) -> Dict:
+        """
+        Fingerprint of an msms.txt file. The file is only hashed if its size
+        or modification time differ from the known fingerprint.
+        """
+        stat = msms_file.stat()
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if known is not None and all(known.get(k) == v for k, v in fingerprint.items()):
+            fingerprint["hash"] = known["hash"]
+        else:
+            fingerprint["hash"] = file_hash(msms_file)
+        return fingerprint
+
+    def cached_psms(self, folder: Path, fingerprint: Dict) -> Optional[pd.DataFrame]:
+        """
+        PSMs of a folder read in an earlier run, None if msms.txt changed since.
+        """
+        known = self.folders.get(self.folder_key(folder))
+        if known is None or known["hash"] != fingerprint["hash"] or known["size"] != fingerprint["size"]:
+            return None
+        part = self.path / "psms" / known["part"]
+        if not part.exists():
+            return None
+        # a touched but unchanged file only updates its modification time
+        known["mtime_ns"] = fingerprint["mtime_ns"]
+        return pd.read_parquet(part)
+
+    def known_fingerprint(self, folder: Path) -> Optional[Dict]:
+        return self.folders.get(self.folder_key(folder))
+
+    def store_psms(self, folder: Path, fingerprint: Dict, psms_df: pd.DataFrame):
+        """
+        Persist the PSMs of a folder, replacing those of earlier runs.
+        """
+        key = self.folder_key(folder)
+        part = hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + ".parquet"
+        tmp_file = self.path / "psms" / (part + ".part")
+        psms_df[self.PSM_COLUMNS].to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, self.path / "psms" / part)
+        self.folders[key] = {**fingerprint, "part": part}
+
+    def retain_folders(self, folders: Iterable[Path]):
+        """
+        Forget all folders but the given ones.
+        """
+        keep = {self.folder_key(folder) for folder in folders}
+        for key in list(self.folders):
+            if key not in keep:
+                self.path.joinpath("psms", self.folders.pop(key)["part"]).unlink(missing_ok=True)
+
+    @staticmethod
+    def mzml_fingerprint(mzml_file: Path) -> Optional[Dict]:
+        try:
+            stat = mzml_file.stat()
+        except FileNotFoundError:
+            return None
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def spectrum_stores(self, mzml_folder: Path) -> List[SpectrumStore]:
+        """
+        Spectrum stores of earlier runs whose mzML files did not change since,
+        the other stores are removed.
+        """
+        stores = []
+        for name, files in list(self.spectrum_store_files.items()):
+            store_dir = self.path / "spectra" / name
+            unchanged = all(
+                self.mzml_fingerprint(mzml_folder.joinpath(file + ".mzML")) == fingerprint
+                for file, fingerprint in files.items()
+            )
+            if unchanged and SpectrumStore.is_store(store_dir):
+                stores.append(SpectrumStore(store_dir))
+            else:
+                del self.spectrum_store_files[name]
+                shutil.rmtree(store_dir, ignore_errors=True)
+        return stores
+
+    def new_spectrum_store_dir(self) -> Path:
+        """
+        Directory for the spectra extracted in this run, see add_spectrum_store.
+        """
+        names = [int(name) for name in self.spectrum_store_files if name.isdigit()]
+        return self.path / "spectra" / str(max(names, default=0) + 1)
+
+    def add_spectrum_store(self, store: SpectrumStore, mzml_folder: Path):
+        """
+        Keep a store extracted into new_spectrum_store_dir for later runs,
+        together with the fingerprints of its mzML files. Empty stores are removed.
+        """
+        if len(store) == 0:
+            shutil.rmtree(store.path)
+            return
+        self.spectrum_store_files[store.path.name] = {
+            file: self.mzml_fingerprint(mzml_folder.joinpath(file + ".mzML")) for file in store.files
+        }
+
+    def changed_pairs(self, pairs: List[Tuple[str, str]], signatures: np.ndarray) -> np.ndarray:
+        """
+        Mask of the pairs which were not emitted before or whose signature changed.
+        """
+        previous = np.fromiter(
+            (self.pair_signatures.get(pair, 0) for pair in pairs), dtype=np.int64, count=len(pairs)
+        )
+        known = np.fromiter((pair in self.pair_signatures for pair in pairs), dtype=bool, count=len(pairs))
+        return ~known | (previous != signatures)
+
+    def save(self, pairs: List[Tuple[str, str]], signatures: np.ndarray):
+        """
+        Write the folder fingerprints, the spectrum stores and the signatures
+        of the emitted pairs, pairs left out are emitted again by the next run.
+        """
+        pairs_df = pd.DataFrame(
+            {
+                "sequence": [pair[0] for pair in pairs],
+                "ambigous_sequence": [pair[1] for pair in pairs],
+                "signature": np.asarray(signatures, dtype=np.int64),
+            }
+        )
+        pairs_df.to_parquet(self.path / "pairs.parquet.part", index=False)
+        os.replace(self.path / "pairs.parquet.part", self.path / "pairs.parquet")
+
+        with open(self.path / "state.json.part", "w") as f:
+            json.dump({"folders": self.folders, "spectra": self.spectrum_store_files}, f, indent=1)
+        os.replace(self.path / "state.json.part", self.path / "state.json")
+
+        self.pair_signatures = dict(zip(pairs, signatures.tolist()))
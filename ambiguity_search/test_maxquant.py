@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+
+from ambiguity_search import maxquant
+from ambiguity_search.benchmark import SIBLINGS_FILE, SyntheticMaxQuantData, read_sibling_groups
+from ambiguity_search.maxquant import MaxQuantAmbiguitySearch
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    dataset_dir = tmp_path_factory.mktemp("dataset")
+    SyntheticMaxQuantData(
+        4000,
+        read_sibling_groups(SIBLINGS_FILE),
+        sibling_rate=0.3,
+        psms_per_raw_file=500,
+        psms_per_folder=2000,
+        n_peaks=10,
+    ).write(dataset_dir)
+    return dataset_dir
+
+
+def searcher(dataset, **kwargs):
+    return MaxQuantAmbiguitySearch(
+        sorted(dataset.joinpath("maxquant").iterdir()), dataset / "mzml", workers=2, **kwargs
+    )
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """
+    mzML files read by the spectrum extraction.
+    """
+    paths = []
+    original = maxquant.convert_spectra
+
+    def convert_spectra(mzml_paths, *args, **kwargs):
+        paths.extend(mzml_paths)
+        return original(mzml_paths, *args, **kwargs)
+
+    monkeypatch.setattr(maxquant, "convert_spectra", convert_spectra)
+    return paths
+
+
+def pair_keys(table):
+    return list(zip(table["sequence"], table["ambigous_sequence"]))
+
+
+@pytest.mark.parametrize("consensus", [False, True])
+def test_each_mzml_file_is_read_once(dataset, monkeypatch, opened, consensus):
+    monkeypatch.setattr(MaxQuantAmbiguitySearch, "RESULT_BATCH_SIZE", 5)
+    monkeypatch.setattr(MaxQuantAmbiguitySearch, "CONSENSUS_CHUNK_SIZE", 3)
+
+    results = searcher(dataset, consensus=consensus).search()
+    assert len(results) > 10
+    assert len(opened) == len(set(opened)) == len(list(dataset.joinpath("mzml").iterdir()))
+
+
+def test_extracted_spectra_match_mzml(dataset):
+    results = searcher(dataset).search()
+    direct = searcher(dataset)
+    for raw_files, mz, intensity in zip(
+        results["sequence_raw_files"], results["sequence_mz"], results["sequence_intensity"]
+    ):
+        expected_mz, expected_intensity = direct.get_spectrum(raw_files[0])
+        assert len(mz) > 0
+        assert np.allclose(mz, expected_mz)
+        assert np.allclose(intensity, expected_intensity)
+
+
+def test_state_keeps_consumed_batches_and_extracted_spectra(dataset, tmp_path, monkeypatch, opened):
+    monkeypatch.setattr(MaxQuantAmbiguitySearch, "RESULT_BATCH_SIZE", 5)
+    state_dir = tmp_path / "state"
+    all_pairs = searcher(dataset).search().set_index(["sequence", "ambigous_sequence"])
+    opened.clear()
+
+    # the consumer stops after two batches, the second may not have been written
+    batches = searcher(dataset, state_dir=state_dir).search_batches()
+    consumed, interrupted = [set(pair_keys(next(batches).to_pydict())) for _ in range(2)]
+    batches.close()
+    assert len(consumed) == len(interrupted) == 5
+    assert len(opened) == len(list(dataset.joinpath("mzml").iterdir()))
+
+    # the next run emits the rest, with the spectra extracted by the first run
+    opened.clear()
+    rest = searcher(dataset, state_dir=state_dir).search()
+    assert opened == []
+    assert len(rest) == len(all_pairs) - 5
+    assert consumed.isdisjoint(pair_keys(rest))
+    assert interrupted <= set(pair_keys(rest))
+    for pair, mz in zip(pair_keys(rest), rest["sequence_mz"]):
+        assert np.allclose(mz, all_pairs.loc[pair, "sequence_mz"])
+
+    assert len(searcher(dataset, state_dir=state_dir).search()) == 0
+
+
+def test_state_drops_spectra_of_changed_mzml_files(dataset, tmp_path, monkeypatch, opened):
+    state_dir = tmp_path / "state"
+    searcher(dataset, state_dir=state_dir).search()
+    assert [p.name for p in state_dir.joinpath("spectra").iterdir()] == ["1"]
+    opened.clear()
+
+    # all pairs are searched again, and one mzML file was rewritten since
+    monkeypatch.setattr(
+        maxquant.SearchState, "changed_pairs", lambda self, pairs, signatures: np.ones(len(pairs), dtype=bool)
+    )
+    mzml_file = sorted(dataset.joinpath("mzml").iterdir())[0]
+    stat = mzml_file.stat()
+    os.utime(mzml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    try:
+        assert len(searcher(dataset, state_dir=state_dir).search()) > 0
+    finally:
+        os.utime(mzml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    # the store of the first run had the spectra of all files and is dropped as a whole
+    assert len(opened) == len(list(dataset.joinpath("mzml").iterdir()))
+    assert len(list(state_dir.joinpath("spectra").iterdir())) == 1
@@ -9,10 +9,17 @@ import argparse
 minlength = 6
 maxlength = 60
 
-def digest_fasta_keep_with_leucines(file_path):
-    peps_by_length = {}
+def digest_fasta_keep_with_leucines(file_path, peps_by_length=None):
+    """
+    Digest all proteins of a FASTA file (path or open text handle) and group
+    the I/L containing peptides by length and by their I/L collapsed sequence.
+    Pass the result of a previous call as peps_by_length to add another file
+    to the same groups.
+    """
+    if peps_by_length is None:
+        peps_by_length = {}
 
-    for _, sequence in fasta.read(file_path):
+    for _, sequence in fasta.read(file_path, use_index=False):
         peptides = parser.cleave(sequence, parser.expasy_rules['trypsin'])
 
         for peptide in peptides:
@@ -30,6 +37,23 @@ def digest_fasta_keep_with_leucines(file_path):
     return peps_by_length
 
 
+def remove_single_peptides(peps_by_length):
+    """
+    Remove the groups without siblings (in place) and return the number of
+    sibling peptides per length.
+    """
+    count_siblings_per_length = {}
+    for length, peps in peps_by_length.items():
+        count_siblings_per_length[length] = 0
+        for group_pep in list(peps.keys()):
+            if len(peps[group_pep]) == 1:
+                del peps[group_pep]
+            else:
+                count_siblings_per_length[length] += len(peps[group_pep])
+
+    return count_siblings_per_length
+
+
 if __name__ == '__main__':
     arparser = argparse.ArgumentParser(description='Digest FASTA file and find sibling peptides (similar except for I/L exchange).')
     arparser.add_argument('fasta', type=str, help='Path to the input FASTA file')
@@ -38,13 +62,7 @@ if __name__ == '__main__':
 
     peps_by_len = digest_fasta_keep_with_leucines(args.fasta)
 
-    count_siblings = 0
-    for length, peps in peps_by_len.items():
-        for group_pep in list(peps.keys()):
-            if len(peps[group_pep]) == 1:
-                del peps[group_pep]
-            else:
-                count_siblings += len(peps[group_pep])
+    count_siblings = sum(remove_single_peptides(peps_by_len).values())
     
     with open(args.out, 'w') as f:
         f.write(f"Total number of sibling peptides: {count_siblings}\n")
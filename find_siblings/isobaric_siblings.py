@@ -0,0 +1,229 @@
+"""
+Find sibling peptides which are isobaric or nearly isobaric, generalizing the
+I/L exchange of digest_find_siblings.py to substitutions like K/Q, N/GG, Q/AG
+and modified residues.
+
+Peptides are sorted by mass and every peptide is only compared to the peptides
+following it within the ppm tolerance (sort-sweep), candidates are confirmed
+by rewriting both sequences with the substitution rules.
+
+The ppm tolerance is the precursor tolerance for the whole pair, so the nearly
+isobaric rules only find siblings if it covers their mass difference (see
+RULE_MASS_DELTAS): one K/Q exchange (0.0364 Da) needs 39 ppm at 927 Da
+(PEPTIDEK) and 15 ppm at 2500 Da, M[Oxidation]/F (0.0330 Da) slightly less.
+These rules are therefore not part of DEFAULT_RULES.
+
+Run from the project root:
+    python -m find_siblings.isobaric_siblings proteome.fasta siblings.csv --ppm 50 --rules I/L N/GG Q/AG K/Q
+"""
+
+import argparse
+import warnings
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from pipeline.instrumentation import timer
+from seq_utils.fasta_to_peptides import create_tryptic_peptides
+from seq_utils.mass import RESIDUE_MASSES, peptide_mass, peptide_masses, split_proforma
+
+
+SUBSTITUTION_RULES: Dict[str, Dict[str, str]] = {
+    "I/L": {"I": "L"},
+    "K/Q": {"K": "Q"},
+    "N/GG": {"N": "GG"},
+    "Q/AG": {"Q": "AG"},
+    "M[Oxidation]/F": {"M[Oxidation]": "F", "M[UNIMOD:35]": "F"},
+}
+"""
+Substitutions between (nearly) isobaric residues or residue combinations.
+Each rule rewrites a residue token into its canonical replacement.
+"""
+
+RULE_MASS_DELTAS: Dict[str, float] = {
+    name: max(abs(peptide_mass(token) - peptide_mass(replacement)) for token, replacement in substitutions.items())
+    for name, substitutions in SUBSTITUTION_RULES.items()
+}
+"""
+Mass difference in Da of one substitution of each rule, a pair of siblings
+differing in n substitutions is n times as far apart.
+"""
+
+ISOBARIC_DELTA = 1e-5
+"""Rules with a smaller mass difference (rounding of the residue masses) are exactly isobaric."""
+
+DEFAULT_RULES: List[str] = [name for name, delta in RULE_MASS_DELTAS.items() if delta < ISOBARIC_DELTA]
+"""The exactly isobaric rules I/L, N/GG and Q/AG, which find their siblings at any tolerance."""
+
+
+def canonical_tokens(peptide: str, substitutions: Dict[str, str]) -> List[str]:
+    """
+    Rewrite a ProForma sequence with the substitutions until no rule applies
+    anymore (e.g. K -> Q -> AG).
+
+    Returns
+    -------
+    List[str]
+        The canonical residue tokens, terminal modifications are kept as
+        tokens at the start and end.
+    """
+    n_term, tokens, c_term = split_proforma(peptide)
+    canonical = [f"[{n_term}]-"] if n_term else []
+
+    pending = list(reversed(tokens))
+    while pending:
+        token = pending.pop()
+        replacement = substitutions.get(token)
+        if replacement is None:
+            canonical.append(token)
+        else:
+            _, replacement_tokens, _ = split_proforma(replacement)
+            pending.extend(reversed(replacement_tokens))
+
+    if c_term:
+        canonical.append(f"-[{c_term}]")
+    return canonical
+
+
+def canonical_key(peptide: str, substitutions: Dict[str, str], confirm: str = "sequence") -> str:
+    """
+    Key that is equal for two peptides if they are siblings under the
+    substitutions.
+
+    Parameters
+    ----------
+    confirm : str
+        "sequence" requires the rewritten sequences to be identical (edit rules),
+        "composition" only requires the same rewritten composition and also
+        accepts permuted residues.
+    """
+    tokens = canonical_tokens(peptide, substitutions)
+    if confirm == "sequence":
+        return "".join(tokens)
+    if confirm == "composition":
+        return ",".join(f"{t}{n}" for t, n in sorted(Counter(tokens).items()))
+    raise ValueError(f"Unknown confirmation mode: {confirm}")
+
+
+def merge_rules(rules: Iterable[str]) -> Dict[str, str]:
+    substitutions = {}
+    for rule in rules:
+        substitutions.update(SUBSTITUTION_RULES[rule])
+    return substitutions
+
+
+def find_isobaric_siblings(
+    peptides: Iterable[str],
+    ppm: float = 10.0,
+    rules: Optional[Iterable[str]] = None,
+    confirm: str = "sequence",
+    chunk_size: int = 100_000,
+) -> pd.DataFrame:
+    """
+    Find all pairs of peptides with precursor masses within the ppm tolerance
+    which are siblings under the substitution rules.
+
+    Parameters
+    ----------
+    peptides : Iterable[str]
+        ProForma sequences, duplicates are removed.
+    ppm : float
+        Mass tolerance in ppm (relative to the lighter peptide). The nearly
+        isobaric rules need at least RULE_MASS_DELTAS[rule] / mass * 1e6 ppm,
+        a warning is issued for rules that cannot match any of the peptides.
+    rules : Iterable[str], optional
+        Names of the SUBSTITUTION_RULES to apply. Defaults to DEFAULT_RULES.
+    confirm : str
+        "sequence" or "composition", see canonical_key.
+    chunk_size : int
+        Number of peptides whose mass windows are expanded at once.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per sibling pair with the columns Peptide_1, Peptide_2
+        (lighter peptide first), mass_1, mass_2 and ppm.
+    """
+    rules = DEFAULT_RULES if rules is None else list(rules)
+    substitutions = merge_rules(rules)
+
+    peptides = np.array(sorted(set(peptides)), dtype=object)
+    masses = peptide_masses(peptides)
+    order = np.argsort(masses, kind="stable")
+    peptides = peptides[order]
+    masses = masses[order]
+
+    if len(masses):
+        max_tolerance = masses[-1] * ppm * 1e-6
+        for rule in rules:
+            if RULE_MASS_DELTAS[rule] > max_tolerance:
+                warnings.warn(
+                    f"Rule {rule} changes the mass by {RULE_MASS_DELTAS[rule]:.4f} Da, which needs "
+                    f"{RULE_MASS_DELTAS[rule] / masses[-1] * 1e6:.1f} ppm even for the heaviest peptide "
+                    f"({masses[-1]:.1f} Da), no siblings can be found with {ppm} ppm"
+                )
+
+    keys, _ = pd.factorize(
+        pd.Series([canonical_key(p, substitutions, confirm) for p in peptides])
+    )
+
+    # the window of peptide i ends at the first peptide heavier than the tolerance
+    window_end = np.searchsorted(masses, masses * (1 + ppm * 1e-6), side="right")
+
+    pairs_first = []
+    pairs_second = []
+    for start in range(0, len(peptides), chunk_size):
+        first = np.arange(start, min(start + chunk_size, len(peptides)))
+        n_candidates = window_end[first] - first - 1
+        total = int(n_candidates.sum())
+        if total == 0:
+            continue
+
+        first = np.repeat(first, n_candidates)
+        candidate_offsets = np.cumsum(n_candidates) - n_candidates
+        second = first + 1 + np.arange(total) - np.repeat(candidate_offsets, n_candidates)
+
+        confirmed = keys[first] == keys[second]
+        pairs_first.append(first[confirmed])
+        pairs_second.append(second[confirmed])
+
+    if pairs_first:
+        first = np.concatenate(pairs_first)
+        second = np.concatenate(pairs_second)
+    else:
+        first = second = np.array([], dtype=np.int64)
+
+    return pd.DataFrame(
+        {
+            "Peptide_1": peptides[first],
+            "Peptide_2": peptides[second],
+            "mass_1": masses[first],
+            "mass_2": masses[second],
+            "ppm": (masses[second] - masses[first]) / masses[first] * 1e6,
+        }
+    )
+
+
+if __name__ == "__main__":
+    arparser = argparse.ArgumentParser(description="Digest a FASTA file and find (nearly) isobaric sibling peptides.")
+    arparser.add_argument("fasta", type=str, help="Path to the input FASTA file")
+    arparser.add_argument("out", type=str, help="Path to the output CSV file with one sibling pair per line (same format as the RT prediction input)")
+    arparser.add_argument("--ppm", type=float, default=10.0, help="Precursor mass tolerance in ppm")
+    arparser.add_argument("--rules", nargs="+", default=DEFAULT_RULES, choices=list(SUBSTITUTION_RULES), help="Substitution rules to apply, K/Q and M[Oxidation]/F only match if --ppm covers their mass difference")
+    arparser.add_argument("--confirm", choices=["sequence", "composition"], default="sequence", help="Require identical rewritten sequences or only identical compositions")
+    arparser.add_argument("--min-length", type=int, default=6)
+    arparser.add_argument("--max-length", type=int, default=60)
+    args = arparser.parse_args()
+
+    with timer("digestion") as measurement:
+        peptides = create_tryptic_peptides(args.fasta, min_length=args.min_length, max_length=args.max_length)
+        measurement.items = len(peptides)
+    peptides = [p for p in peptides if set(p) <= RESIDUE_MASSES.keys()]
+
+    with timer("sibling_grouping", items=len(peptides)):
+        siblings = find_isobaric_siblings(peptides, ppm=args.ppm, rules=args.rules, confirm=args.confirm)
+    print(f"Total number of sibling pairs: {len(siblings)}")
+
+    siblings[["Peptide_1", "Peptide_2"]].to_csv(args.out, header=False, index=False)
@@ -1,10 +1,27 @@
-#%%
-from ftplib import FTP
+"""
+Download the UniProt reference proteomes and count the I/L sibling peptides
+of each of them.
+
+The proteomes are read from a mirror of the UniProt FTP server, which is either
+an FTP URL (e.g. ftp://ftp.expasy.org/databases/uniprot) or a local directory
+with the same layout. The gzipped FASTA files are decompressed while they are
+streamed into the digestion, nothing is written to disk besides the sibling
+files. Proteomes are processed concurrently and every finished proteome leaves
+its sibling file in the work directory, so an interrupted run only processes
+the missing proteomes when it is started again.
+"""
+
+import argparse
+import gzip
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from ftplib import FTP
+from pathlib import Path
+from urllib.parse import urlparse
+
 import pandas as pd
-import gzip
-import shutil
-from pyteomics import fasta, parser
 import digest_find_siblings as sib
 
 #uniprot_server = "ftp.uniprot.org"
@@ -16,118 +33,230 @@ import digest_find_siblings as sib
 uniprot_server = "ftp.expasy.org"
 uniprot_dir = "databases/uniprot"
 
-#%%
+reference_proteomes_dir = "current_release/knowledgebase/reference_proteomes"
+
+SEPARATOR_LINE = "============================================================\n"
+
+
+class UniProtMirror:
+    """
+    Read-only access to the UniProt FTP server or a local copy of it.
+    """
+
+    def __init__(self, location: str, username: str = 'anonymous', password: str = ''):
+        """
+        Parameters
+        ----------
+        location : str
+            ftp://host/base/dir URL or path of a local directory with the same layout.
+        """
+        self.location = location
+        self.username = username
+        self.password = password
 
-def download_file_ftp(host, remote_path, local_path, username='anonymous', password=''):
-    with FTP(host) as ftp:
-        ftp.login(user=username, passwd=password)
-        with open(local_path, 'wb') as f:
-            ftp.retrbinary(f'RETR {remote_path}', f.write)
+        url = urlparse(location)
+        if url.scheme == 'ftp':
+            self.host = url.hostname
+            self.base = url.path.strip('/')
+            self.local_dir = None
+        else:
+            self.host = None
+            self.base = None
+            self.local_dir = Path(location)
 
-#%% download proteomes README
-os.makedirs('./work', exist_ok=True)
-readme_file = './work/proteomes_README'
+    @contextmanager
+    def open(self, remote_path: str):
+        """
+        Open a file of the mirror as binary stream. Remote files are not
+        downloaded first but read from the FTP data connection.
+        """
+        if self.local_dir is not None:
+            with open(self.local_dir.joinpath(remote_path), 'rb') as f:
+                yield f
+            return
 
-# download the current proteomes README from UniProt FTP server
-download_file_ftp(uniprot_server, f'{uniprot_dir}/current_release/knowledgebase/reference_proteomes/README', readme_file)
+        with FTP(self.host) as ftp:
+            ftp.login(user=self.username, passwd=self.password)
+            conn = ftp.transfercmd(f'RETR {self.base}/{remote_path}')
+            try:
+                with conn.makefile('rb') as f:
+                    yield f
+            finally:
+                conn.close()
+            ftp.voidresp()
 
-# %% read in the information from the README file
-in_rel_info = False
-in_data = False
-release_str = None
-df_proteomes = None
 
-with open(readme_file, 'r') as f:
-    for line in f.readlines():
+def parse_proteomes_readme(lines):
+    """
+    Read the proteome table of the reference proteomes README.
+
+    Returns
+    -------
+    Tuple[str, pd.DataFrame]
+        Release line and one row per proteome.
+    """
+    in_rel_info = False
+    in_data = False
+    release = None
+    headers = None
+    rows = []
+
+    for line in lines:
         if in_data:
             data = line.strip().split('\t')
-            if len(data) == len(df_proteomes.columns):
-                df_proteomes.loc[len(df_proteomes)] = data
-            else:
-                if len(data) <= 1:
-                    in_data = False
-            
+            if len(data) == len(headers):
+                rows.append(data)
+            elif len(data) <= 1:
+                in_data = False
+
         elif in_rel_info:
             if line.startswith('Release '):
-                release = line
+                release = line.strip()
             elif line.startswith('Proteome_ID'):
                 headers = line.strip().split('\t')
-                df_proteomes = pd.DataFrame(columns=headers)
                 in_data = True
         elif line.startswith('========================================================================'):
             in_rel_info = True
 
-df_proteomes['#(1)'] = df_proteomes['#(1)'].astype(int)
-df_proteomes['#(2)'] = df_proteomes['#(2)'].astype(int)
-
-print(f"Found {len(df_proteomes)} proteomes in release {release.strip()}")
-
-# %% cutting for testing
-df_proteomes = df_proteomes[df_proteomes['SUPERREGNUM'] == 'eukaryota'][:5]
-
-# %%
-# go through the proteomes, download them and calculate the sibling information
-
-proteome_count = 0
-for index, row in df_proteomes.iterrows():
-    proteome_id = row['Proteome_ID']
-    superregnum = row['SUPERREGNUM'].capitalize()
-    tax_id = row['Tax_ID']
-    print(f"Downloading proteome {proteome_id}")
-
-    fasta_file = f"./work/{proteome_id}_{tax_id}.fasta"
-    siblings_file = f"./work/{proteome_id}_{tax_id}_siblings.txt"
-
-    if row['#(1)'] > 0:
-        ftp_str = f"{uniprot_dir}/current_release/knowledgebase/reference_proteomes/{superregnum}/{proteome_id}/{proteome_id}_{tax_id}.fasta.gz"
-        proteome_file = f"./work/{proteome_id}_{tax_id}.fasta.gz"
-        print(f"    {row['#(1)']} sequences")
-        download_file_ftp(uniprot_server, ftp_str, proteome_file)
-        with gzip.open(proteome_file, 'rb') as f_in, open(fasta_file, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(proteome_file)
-
-
-    if row['#(2)'] > 0:
-        ftp_str = f"{uniprot_dir}/current_release/knowledgebase/reference_proteomes/{superregnum}/{proteome_id}/{proteome_id}_{tax_id}_additional.fasta.gz"
-        additional_proteome_file = f"./work/{proteome_id}_{tax_id}_additional.fasta.gz"
-        print(f"    {row['#(2)']} additionals")
-        download_file_ftp(uniprot_server, ftp_str, additional_proteome_file)
-        with gzip.open(additional_proteome_file, 'rb') as f_in, open(fasta_file, 'ab') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(additional_proteome_file)
-    
-    peps_by_len = sib.digest_fasta_keep_with_leucines(fasta_file)
-
-    count_siblings = 0
-    count_siblings_per_length = {}
-    for length, peps in peps_by_len.items():
-        count_siblings_per_length[length] = 0
-        for group_pep in list(peps.keys()):
-            if len(peps[group_pep]) == 1:
-                del peps[group_pep]
-            else:
-                count_siblings += len(peps[group_pep])
-                count_siblings_per_length[length] += len(peps[group_pep])
-    
+    if headers is None:
+        raise ValueError("No proteome table found in README")
+
+    df_proteomes = pd.DataFrame(rows, columns=headers)
+    df_proteomes['#(1)'] = df_proteomes['#(1)'].astype(int)
+    df_proteomes['#(2)'] = df_proteomes['#(2)'].astype(int)
+
+    return release, df_proteomes
+
+
+def read_proteomes_readme(mirror):
+    with mirror.open(f'{reference_proteomes_dir}/README') as f:
+        return parse_proteomes_readme(io.TextIOWrapper(f, encoding='utf-8'))
+
+
+def siblings_file_name(work_dir, proteome_id, tax_id):
+    return Path(work_dir).joinpath(f"{proteome_id}_{tax_id}_siblings.txt")
+
+
+def write_siblings_file(siblings_file, peps_by_len, count_siblings_per_length):
+    count_siblings = sum(count_siblings_per_length.values())
+
     with open(siblings_file, 'w') as f:
         f.write(f"Total number of sibling peptides: {count_siblings}\n")
-        print(f"Total number of sibling peptides: {count_siblings}")
 
-        f.write("============================================================\n")
+        f.write(SEPARATOR_LINE)
         for length in sorted(count_siblings_per_length.keys()):
             if (count_siblings_per_length[length] > 0):
                 f.write(f"{length}\t{count_siblings_per_length[length]}\n")
 
-        f.write("============================================================\n")
+        f.write(SEPARATOR_LINE)
         for length in sorted(peps_by_len.keys()):
             for group_pep in peps_by_len[length]:
                 f.write(f"{peps_by_len[length][group_pep]}\n")
-    
-    os.remove(fasta_file)
 
-    proteome_count += 1
-    print(f"Processed proteome {proteome_count} of {len(df_proteomes)}")
+    return count_siblings
+
+
+def read_sibling_count(siblings_file):
+    with open(siblings_file, 'r') as f:
+        return int(f.readline().rsplit(':', 1)[1])
+
+
+def process_proteome(mirror, work_dir, proteome_id, superregnum, tax_id, n_sequences, n_additional):
+    """
+    Digest one proteome (plus its additional sequences) directly from the mirror
+    and write its sibling file.
+
+    The sibling file is written under a temporary name and renamed when it is
+    complete, its existence marks the proteome as done.
+    """
+    siblings_file = siblings_file_name(work_dir, proteome_id, tax_id)
+    proteome_dir = f"{reference_proteomes_dir}/{superregnum.capitalize()}/{proteome_id}"
+
+    fasta_files = []
+    if n_sequences > 0:
+        fasta_files.append(f"{proteome_dir}/{proteome_id}_{tax_id}.fasta.gz")
+    if n_additional > 0:
+        fasta_files.append(f"{proteome_dir}/{proteome_id}_{tax_id}_additional.fasta.gz")
+
+    peps_by_len = {}
+    for fasta_file in fasta_files:
+        with mirror.open(fasta_file) as f_gz, gzip.open(f_gz, 'rt') as f_fasta:
+            sib.digest_fasta_keep_with_leucines(f_fasta, peps_by_len)
+
+    count_siblings_per_length = sib.remove_single_peptides(peps_by_len)
+
+    partial_file = siblings_file.with_name(siblings_file.name + ".part")
+    count_siblings = write_siblings_file(partial_file, peps_by_len, count_siblings_per_length)
+    os.replace(partial_file, siblings_file)
+
+    return proteome_id, count_siblings
+
+
+def process_proteomes(mirror, df_proteomes, work_dir, workers=None):
+    """
+    Process all proteomes of df_proteomes which do not have a sibling file in
+    work_dir yet.
+
+    Returns
+    -------
+    pd.DataFrame
+        df_proteomes with an additional column with the number of sibling peptides.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+
+    counts = {}
+    todo = []
+    for proteome_id, superregnum, tax_id, n_sequences, n_additional in zip(
+        df_proteomes['Proteome_ID'],
+        df_proteomes['SUPERREGNUM'],
+        df_proteomes['Tax_ID'],
+        df_proteomes['#(1)'],
+        df_proteomes['#(2)'],
+    ):
+        siblings_file = siblings_file_name(work_dir, proteome_id, tax_id)
+        if siblings_file.exists():
+            counts[proteome_id] = read_sibling_count(siblings_file)
+        else:
+            todo.append((proteome_id, superregnum, tax_id, n_sequences, n_additional))
+
+    print(f"{len(counts)} proteomes already processed, {len(todo)} to go")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process_proteome, mirror, work_dir, *proteome): proteome[0]
+            for proteome in todo
+        }
+        for proteome_count, future in enumerate(as_completed(futures), 1):
+            try:
+                proteome_id, count_siblings = future.result()
+            except Exception as e:
+                print(f"Failed to process proteome {futures[future]}: {e}")
+                continue
+            counts[proteome_id] = count_siblings
+            print(f"Processed proteome {proteome_id} ({proteome_count} of {len(todo)}): {count_siblings} sibling peptides")
+
+    df_proteomes = df_proteomes.copy()
+    df_proteomes['sibling_peptides'] = df_proteomes['Proteome_ID'].map(counts).astype('Int64')
+    return df_proteomes
+
+
+if __name__ == '__main__':
+    arparser = argparse.ArgumentParser(description='Count sibling peptides (similar except for I/L exchange) in the UniProt reference proteomes.')
+    arparser.add_argument('--mirror', type=str, default=f'ftp://{uniprot_server}/{uniprot_dir}', help='FTP URL or local directory of the UniProt mirror')
+    arparser.add_argument('--work-dir', type=str, default='./work', help='Directory for the sibling files, finished proteomes in it are skipped')
+    arparser.add_argument('--workers', type=int, default=None, help='Number of proteomes processed in parallel (default: number of CPUs)')
+    arparser.add_argument('--superregnum', type=str, default=None, help='Only process proteomes of this superregnum (e.g. eukaryota)')
+    arparser.add_argument('--limit', type=int, default=None, help='Only process the first N proteomes')
+    args = arparser.parse_args()
+
+    mirror = UniProtMirror(args.mirror)
+    release, df_proteomes = read_proteomes_readme(mirror)
+    print(f"Found {len(df_proteomes)} proteomes in {release}")
 
+    if args.superregnum is not None:
+        df_proteomes = df_proteomes[df_proteomes['SUPERREGNUM'] == args.superregnum]
+    if args.limit is not None:
+        df_proteomes = df_proteomes[:args.limit]
 
-# %%
+    df_proteomes = process_proteomes(mirror, df_proteomes, args.work_dir, args.workers)
+    df_proteomes.to_csv(Path(args.work_dir).joinpath('proteomes_siblings.tsv'), sep='\t', index=False)
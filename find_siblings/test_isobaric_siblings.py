@@ -0,0 +1,62 @@
+import warnings
+
+import pytest
+
+from find_siblings.isobaric_siblings import (
+    DEFAULT_RULES,
+    RULE_MASS_DELTAS,
+    SUBSTITUTION_RULES,
+    find_isobaric_siblings,
+)
+
+
+def pair_set(siblings):
+    return {frozenset(pair) for pair in zip(siblings["Peptide_1"], siblings["Peptide_2"])}
+
+
+@pytest.mark.parametrize(
+    "rule, sibling_1, sibling_2, ppm",
+    [
+        ("I/L", "PEPTIDEK", "PEPTLDEK", 0.0),
+        ("N/GG", "PEPTNDEK", "PEPTGGDEK", 0.01),
+        ("Q/AG", "PEPTIDEQ", "PEPTIDEAG", 0.0),
+        ("K/Q", "PEPTIDEK", "PEPTIDEQ", 40.0),
+        ("K/Q", "ACDEFGHKLMNPQRSTVWYAGK", "ACDEFGHQLMNPQRSTVWYAGK", 15.0),
+        ("M[Oxidation]/F", "PEPTM[Oxidation]DEK", "PEPTFDEK", 40.0),
+    ],
+)
+def test_rule_finds_siblings(rule, sibling_1, sibling_2, ppm):
+    decoys = ["PEPTIDER", "PEPTIDEKK", "EDITPEPK"]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        siblings = find_isobaric_siblings([sibling_1, sibling_2] + decoys, ppm=ppm, rules=[rule])
+    assert pair_set(siblings) == {frozenset([sibling_1, sibling_2])}
+    assert (siblings["ppm"] <= ppm).all()
+
+
+@pytest.mark.parametrize("rule", [rule for rule in SUBSTITUTION_RULES if rule not in DEFAULT_RULES])
+def test_nearly_isobaric_rule_warns_below_its_tolerance(rule):
+    with pytest.warns(UserWarning, match="no siblings can be found"):
+        siblings = find_isobaric_siblings(["PEPTIDEK", "PEPTIDEQ", "PEPTM[Oxidation]DEK", "PEPTFDEK"], ppm=10, rules=[rule])
+    assert len(siblings) == 0
+
+
+def test_default_rules_are_exactly_isobaric():
+    assert set(DEFAULT_RULES) == {"I/L", "N/GG", "Q/AG"}
+    assert all(RULE_MASS_DELTAS[rule] < 1e-5 for rule in DEFAULT_RULES)
+    assert RULE_MASS_DELTAS["K/Q"] == pytest.approx(0.0364, abs=1e-4)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        siblings = find_isobaric_siblings(["PEPTIDEK", "PEPTLDEK", "PEPTIDEQ", "PEPTIDEAG", "PEPTIDEN", "PEPTIDEGG"])
+    assert pair_set(siblings) == {
+        frozenset(["PEPTIDEK", "PEPTLDEK"]),
+        frozenset(["PEPTIDEQ", "PEPTIDEAG"]),
+        frozenset(["PEPTIDEN", "PEPTIDEGG"]),
+    }
+
+
+def test_chained_rules():
+    siblings = find_isobaric_siblings(["PEPTIDEK", "PEPTIDEQ", "PEPTIDEAG"], ppm=40, rules=["K/Q", "Q/AG"])
+    assert len(siblings) == 3
+    assert set(siblings["Peptide_1"]) | set(siblings["Peptide_2"]) == {"PEPTIDEK", "PEPTIDEQ", "PEPTIDEAG"}
@@ -0,0 +1,134 @@
+import ast
+import gzip
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+# the scripts of this directory import each other as top level modules
+sys.path.insert(0, str(Path(__file__).parent))
+
+import digest_find_siblings as sib  # noqa: E402
+import siblings_in_uniprot_proteomes as uniprot  # noqa: E402
+
+
+README = """The reference proteomes README.
+
+========================================================================
+Release 2024_01, 24-Jan-2024
+
+Proteome_ID\tTax_ID\tOSCODE\tSUPERREGNUM\t#(1)\t#(2)\t#(3)\tSpecies Name
+UP000000001\t9606\tHUMAN\teukaryota\t2\t1\t3\tHomo sapiens
+UP000000002\t562\tECOLX\tbacteria\t1\t0\t1\tEscherichia coli
+UP000000003\t7227\tDROME\teukaryota\t1\t0\t1\tDrosophila melanogaster
+
+Some text after the table.
+"""
+
+FASTA_FILES = {
+    "Eukaryota/UP000000001/UP000000001_9606.fasta.gz": ">sp|P1|A\nAAPEPTIDEKGGSLLYSAR\n>sp|P2|B\nAAPEPTLDEKNQYVLSSR\n",
+    "Eukaryota/UP000000001/UP000000001_9606_additional.fasta.gz": ">tr|P3|C\nNQYVISSR\n",
+    "Bacteria/UP000000002/UP000000002_562.fasta.gz": ">sp|P4|D\nAAPEPTIDEKGGSLLYSAR\n",
+}
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    proteomes_dir = tmp_path.joinpath("mirror", uniprot.reference_proteomes_dir)
+    proteomes_dir.mkdir(parents=True)
+    proteomes_dir.joinpath("README").write_text(README)
+    for name, content in FASTA_FILES.items():
+        path = proteomes_dir.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "wt") as f:
+            f.write(content)
+    return uniprot.UniProtMirror(str(tmp_path.joinpath("mirror")))
+
+
+def test_read_proteomes_readme(mirror):
+    assert mirror.local_dir is not None
+
+    release, df_proteomes = uniprot.read_proteomes_readme(mirror)
+
+    assert release == "Release 2024_01, 24-Jan-2024"
+    assert list(df_proteomes["Proteome_ID"]) == ["UP000000001", "UP000000002", "UP000000003"]
+    assert list(df_proteomes["SUPERREGNUM"]) == ["eukaryota", "bacteria", "eukaryota"]
+    assert list(df_proteomes["#(1)"]) == [2, 1, 1]
+    assert list(df_proteomes["#(2)"]) == [1, 0, 0]
+
+
+def test_parse_proteomes_readme_without_table():
+    with pytest.raises(ValueError):
+        uniprot.parse_proteomes_readme(["no table\n"])
+
+
+def test_remove_single_peptides():
+    peps_by_length = {
+        8: {"NQYVJSSR": {"NQYVLSSR", "NQYVISSR"}, "JJJJAAAK": {"LLLLAAAK"}},
+        9: {"GGSJJYSAR": {"GGSLLYSAR"}},
+    }
+
+    counts = sib.remove_single_peptides(peps_by_length)
+
+    assert counts == {8: 2, 9: 0}
+    assert peps_by_length == {8: {"NQYVJSSR": {"NQYVLSSR", "NQYVISSR"}}, 9: {}}
+
+
+def test_process_proteome_writes_complete_siblings_file(mirror, tmp_path):
+    work_dir = tmp_path.joinpath("work")
+    work_dir.mkdir()
+
+    proteome_id, count = uniprot.process_proteome(mirror, work_dir, "UP000000001", "eukaryota", "9606", 2, 1)
+
+    # AAPEPTIDEK/AAPEPTLDEK from the main file, NQYVLSSR/NQYVISSR across main and additional file
+    assert (proteome_id, count) == ("UP000000001", 4)
+    assert [p.name for p in work_dir.iterdir()] == ["UP000000001_9606_siblings.txt"]
+
+    siblings_file = uniprot.siblings_file_name(work_dir, "UP000000001", "9606")
+    assert uniprot.read_sibling_count(siblings_file) == 4
+    lines = siblings_file.read_text().splitlines()
+    assert lines[1:5] == [uniprot.SEPARATOR_LINE.strip(), "8\t2", "10\t2", uniprot.SEPARATOR_LINE.strip()]
+    assert {frozenset(ast.literal_eval(line)) for line in lines[5:]} == {
+        frozenset(["NQYVLSSR", "NQYVISSR"]),
+        frozenset(["AAPEPTIDEK", "AAPEPTLDEK"]),
+    }
+
+
+def test_process_proteome_failure_leaves_no_siblings_file(mirror, tmp_path, monkeypatch):
+    work_dir = tmp_path.joinpath("work")
+    work_dir.mkdir()
+
+    def failing_write(siblings_file, peps_by_len, count_siblings_per_length):
+        Path(siblings_file).write_text("Total number of sibling peptides: ")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(uniprot, "write_siblings_file", failing_write)
+    with pytest.raises(OSError):
+        uniprot.process_proteome(mirror, work_dir, "UP000000002", "bacteria", "562", 1, 0)
+
+    assert not uniprot.siblings_file_name(work_dir, "UP000000002", "562").exists()
+
+
+def test_process_proteomes_skips_finished_proteomes(mirror, tmp_path):
+    work_dir = tmp_path.joinpath("work")
+    work_dir.mkdir()
+    # finished in an earlier run, its FASTA file is not on the mirror
+    uniprot.siblings_file_name(work_dir, "UP000000003", "7227").write_text("Total number of sibling peptides: 7\n")
+
+    _, df_proteomes = uniprot.read_proteomes_readme(mirror)
+    df_result = uniprot.process_proteomes(mirror, df_proteomes, work_dir, workers=2)
+
+    assert df_result["sibling_peptides"].tolist() == [4, 0, 7]
+    assert not list(work_dir.glob("*.part"))
+
+
+def test_process_proteomes_reports_failed_proteomes(mirror, tmp_path):
+    work_dir = tmp_path.joinpath("work")
+
+    _, df_proteomes = uniprot.read_proteomes_readme(mirror)
+    df_result = uniprot.process_proteomes(mirror, df_proteomes, work_dir, workers=2)
+
+    assert df_result["sibling_peptides"].iloc[:2].tolist() == [4, 0]
+    assert pd.isna(df_result["sibling_peptides"].iloc[2])
+    assert not uniprot.siblings_file_name(work_dir, "UP000000003", "7227").exists()
@@ -1,7 +1,14 @@
+from pathlib import Path
+from typing import ClassVar, List, NamedTuple, Optional, Sequence, Tuple
+
 import numpy as np
 import pandas as pd
 from koinapy import Koina
 
+from make_predictions.koina_predictor import KoinaPredictor, with_retries
+from pipeline.instrumentation import timer
+from seq_utils.fragments import parse_annotations
+
 
 def obtain_predictions_pairs(
     peptides,
@@ -34,3 +41,177 @@ def obtain_predictions_pairs(
     predictions["non_switched"] = switched
 
     return predictions
+
+
+def safe_obtain_predictions(
+    peptides_batch,
+    switched,
+    max_retries=3,
+    delay=1,
+    model="Prosit_2024_intensity_PTMs_gl",
+    **kwargs,
+):
+    """
+    Attempts to obtain predictions for a batch of peptides, retrying in case of failure.
+
+    Args:
+        peptides_batch (list): List of peptide sequences.
+        switched (bool): Parameter for prediction function.
+        max_retries (int): Maximum number of retries before raising the exception.
+        delay (int): Delay in seconds between retries.
+        model (str): Koina model name.
+        **kwargs: Passed to obtain_predictions_pairs.
+
+    Returns:
+        pd.DataFrame: DataFrame of predictions.
+    """
+    with timer("intensity_request", items=len(peptides_batch)):
+        return with_retries(
+            lambda: obtain_predictions_pairs(peptides_batch, switched=switched, model=model, **kwargs),
+            max_retries,
+            delay,
+        )
+
+
+class PredictedSpectra(NamedTuple):
+    """
+    Predicted spectra of several (peptide, charge) requests, the fragments of
+    request i are the slice offsets[i]:offsets[i + 1]. Fragments are encoded
+    with seq_utils.fragments.encode_ions.
+    """
+
+    codes: np.ndarray
+    mz: np.ndarray
+    intensity: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def spectrum(self, idx: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return self.codes[start:stop], self.mz[start:stop], self.intensity[start:stop]
+
+
+class IntensityPredictor(KoinaPredictor):
+    """
+    Fragment intensity predictions from Koina for many (peptide, charge)
+    pairs, requested in concurrent, cached batches (see KoinaPredictor).
+    """
+
+    KEY_COLUMNS: ClassVar[List[str]] = ["peptide_sequences", "precursor_charges"]
+    CACHE_COLUMNS: ClassVar[List[str]] = ["peptide_sequences", "precursor_charges", "code", "mz", "intensities"]
+    """
+    Columns of the cache parts, one row per predicted fragment.
+    """
+
+    NAME: ClassVar[str] = "intensity"
+    DESCRIPTION: ClassVar[str] = "Predicting intensities"
+
+    def __init__(
+        self,
+        model: str = "Prosit_2024_intensity_PTMs_gl",
+        collision_energy: float = 28,
+        instrument_type: str = "LUMOS",
+        fragmentation_type: str = "HCD",
+        cache_dir: Optional[Path] = None,
+        batch_size: int = 1000,
+        workers: int = 4,
+        max_retries: int = 3,
+        delay: float = 1,
+        server: str = "koina.wilhelmlab.org:443",
+    ):
+        """
+        Parameters
+        ----------
+        model : str
+            Koina model name.
+        collision_energy, instrument_type, fragmentation_type
+            Model inputs, the same for all requests.
+        cache_dir : Optional[Path]
+            Directory of the prediction cache, a subdirectory is used per model and inputs.
+        batch_size, workers, max_retries, delay, server
+            See KoinaPredictor.
+        """
+        self.collision_energy = collision_energy
+        self.instrument_type = instrument_type
+        self.fragmentation_type = fragmentation_type
+        super().__init__(
+            model,
+            f"{model}_{collision_energy}_{instrument_type}_{fragmentation_type}",
+            cache_dir,
+            batch_size,
+            workers,
+            max_retries,
+            delay,
+            server,
+        )
+
+    def _inputs(self, requests: pd.DataFrame) -> pd.DataFrame:
+        n = len(requests)
+        return pd.DataFrame(
+            {
+                "peptide_sequences": requests["peptide_sequences"].to_numpy(),
+                "precursor_charges": requests["precursor_charges"].to_numpy(),
+                "collision_energies": np.full(n, self.collision_energy),
+                "instrument_types": np.full(n, self.instrument_type),
+                "fragmentation_types": np.full(n, self.fragmentation_type),
+            }
+        )
+
+    def _outputs(self, requests: pd.DataFrame, predictions: pd.DataFrame) -> pd.DataFrame:
+        predictions["code"] = parse_annotations(predictions["annotation"])
+        # Koina marks impossible fragments with intensities <= 0
+        predictions = predictions[(predictions["code"] >= 0) & (predictions["intensities"] > 0)]
+
+        # keep requests without fragments so that they are not requested again
+        missing = requests.merge(
+            predictions[self.KEY_COLUMNS].drop_duplicates(), how="left", indicator=True
+        )
+        missing = missing[missing["_merge"] == "left_only"].drop(columns="_merge")
+        missing["code"], missing["mz"], missing["intensities"] = -1, 0.0, 0.0
+
+        return pd.concat([predictions[self.CACHE_COLUMNS], missing[self.CACHE_COLUMNS]], ignore_index=True)
+
+    def _add_to_cache(self, predictions_df: pd.DataFrame):
+        """
+        Code -1 marks requests without any predicted fragment.
+        """
+        predictions_df = predictions_df.sort_values(self.KEY_COLUMNS, kind="stable")
+        peptides = predictions_df["peptide_sequences"].to_numpy()
+        charges = predictions_df["precursor_charges"].to_numpy()
+        codes = predictions_df["code"].to_numpy(dtype=np.int64)
+        mz = predictions_df["mz"].to_numpy(dtype=np.float64)
+        intensity = predictions_df["intensities"].to_numpy(dtype=np.float32)
+
+        starts = np.flatnonzero(
+            np.concatenate(([True], (peptides[1:] != peptides[:-1]) | (charges[1:] != charges[:-1])))
+        )
+        stops = np.append(starts[1:], len(peptides))
+        for start, stop in zip(starts, stops):
+            valid = slice(start, stop) if codes[start] >= 0 else slice(start, start)
+            self._cache[(peptides[start], int(charges[start]))] = (codes[valid], mz[valid], intensity[valid])
+
+    def predict(self, peptides: Sequence[str], charges: Sequence[int]) -> PredictedSpectra:
+        """
+        Predicted spectra of the given (peptide, charge) pairs, in input order.
+        Only pairs which are not cached are requested from Koina.
+        """
+        requests = pd.DataFrame(
+            {
+                "peptide_sequences": np.asarray(peptides, dtype=object),
+                "precursor_charges": np.asarray(charges, dtype=np.int64),
+            }
+        )
+        self._fetch(requests)
+
+        spectra = [self._cache[(p, c)] for p, c in requests.itertuples(index=False)]
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum([len(codes) for codes, _, _ in spectra], out=offsets[1:])
+
+        def concat(idx, dtype):
+            return np.concatenate([s[idx] for s in spectra]) if spectra else np.array([], dtype=dtype)
+
+        return PredictedSpectra(
+            codes=concat(0, np.int64), mz=concat(1, np.float64), intensity=concat(2, np.float32), offsets=offsets
+        )
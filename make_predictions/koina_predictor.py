@@ -0,0 +1,169 @@
+"""
+Batched, cached requests of Koina predictions.
+
+KoinaPredictor requests each distinct input (e.g. a peptide and charge) once:
+inputs which are not cached are requested in batches by several threads, and
+all predictions are kept in memory and, optionally, in a Parquet cache which
+is reused by later runs. The predictors of make_predictions only define the
+Koina inputs of a batch, the conversion of the predictions into the columns
+of the cache and how cached predictions are kept in memory.
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, ClassVar, Dict, List, Optional, Tuple
+
+import pandas as pd
+from koinapy import Koina
+from tqdm import tqdm
+
+from pipeline.instrumentation import count, gauge, timer
+
+
+def with_retries(request, max_retries=3, delay=1):
+    """
+    Call request(), retrying up to max_retries times with delay seconds in between.
+    """
+    for attempt in range(max_retries):
+        try:
+            return request()
+        except Exception as e:
+            if attempt < max_retries - 1:
+                time.sleep(delay)
+            else:
+                raise RuntimeError(
+                    f"Prediction failed after {max_retries} attempts."
+                ) from e
+
+
+class KoinaPredictor:
+    """
+    Base of the predictors requesting a Koina model in concurrent, cached batches.
+    """
+
+    KEY_COLUMNS: ClassVar[List[str]] = []
+    """
+    Columns identifying a request, the cache holds one entry per distinct key.
+    """
+
+    CACHE_COLUMNS: ClassVar[List[str]] = []
+    """
+    Columns of the cache parts, starting with the KEY_COLUMNS.
+    """
+
+    NAME: ClassVar[str] = ""
+    """
+    Prefix of the instrumentation of the requests (NAME_request, NAME_requests.*, NAME_cache.*).
+    """
+
+    DESCRIPTION: ClassVar[str] = "Predicting"
+    """
+    Description of the progress bar of the requests.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        cache_name: str,
+        cache_dir: Optional[Path] = None,
+        batch_size: int = 1000,
+        workers: int = 4,
+        max_retries: int = 3,
+        delay: float = 1,
+        server: str = "koina.wilhelmlab.org:443",
+    ):
+        """
+        Parameters
+        ----------
+        model : str
+            Koina model name.
+        cache_name : str
+            Subdirectory of cache_dir of the predictions, unique per model and
+            the inputs which are the same for all requests.
+        cache_dir : Optional[Path]
+            Directory of the prediction cache.
+        batch_size : int
+            Number of requests per Koina call.
+        workers : int
+            Number of concurrent Koina calls.
+        max_retries, delay
+            Retries of failed calls, see with_retries.
+        server : str
+            Koina server.
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.delay = delay
+        self.server = server
+        self._koina = None
+
+        self._cache: Dict[Tuple, Any] = {}
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir) / cache_name
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            parts = sorted(self.cache_dir.glob("*.parquet"))
+            if parts:
+                self._add_to_cache(pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True))
+
+    def _inputs(self, requests: pd.DataFrame) -> pd.DataFrame:
+        """
+        Koina inputs of a batch of requests (KEY_COLUMNS).
+        """
+        raise NotImplementedError
+
+    def _outputs(self, requests: pd.DataFrame, predictions: pd.DataFrame) -> pd.DataFrame:
+        """
+        Predictions of a batch of requests in the CACHE_COLUMNS layout.
+        """
+        raise NotImplementedError
+
+    def _add_to_cache(self, predictions_df: pd.DataFrame):
+        """
+        Add predictions in the CACHE_COLUMNS layout to the in-memory cache,
+        keyed by the tuples of their KEY_COLUMNS.
+        """
+        raise NotImplementedError
+
+    def _request(self, requests: pd.DataFrame) -> pd.DataFrame:
+        """
+        Request one batch from Koina, in the CACHE_COLUMNS layout.
+        """
+        if self._koina is None:
+            self._koina = Koina(self.model, self.server)
+
+        inputs = self._inputs(requests)
+        gauge(f"{self.NAME}_requests.queued", -1)
+        gauge(f"{self.NAME}_requests.in_flight", 1)
+        try:
+            with timer(f"{self.NAME}_request", items=len(requests)):
+                predictions = with_retries(lambda: self._koina.predict(inputs), self.max_retries, self.delay)
+        finally:
+            gauge(f"{self.NAME}_requests.in_flight", -1)
+        return self._outputs(requests, predictions)
+
+    def _fetch(self, requests: pd.DataFrame):
+        """
+        Request the distinct requests (KEY_COLUMNS) which are not cached and cache them.
+        """
+        unique_requests = requests[self.KEY_COLUMNS].drop_duplicates()
+        is_missing = [key not in self._cache for key in unique_requests.itertuples(index=False, name=None)]
+        missing = unique_requests[is_missing].reset_index(drop=True)
+        count(f"{self.NAME}_cache.hits", len(unique_requests) - len(missing))
+        count(f"{self.NAME}_cache.misses", len(missing))
+        if len(missing) == 0:
+            return
+
+        starts = range(0, len(missing), self.batch_size)
+        gauge(f"{self.NAME}_requests.queued", len(starts))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._request, missing.iloc[start:start + self.batch_size]) for start in starts]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=self.DESCRIPTION):
+                predictions_df = future.result()
+                self._add_to_cache(predictions_df)
+                if self.cache_dir is not None:
+                    predictions_df.to_parquet(self.cache_dir / f"{uuid.uuid4().hex}.parquet", index=False)
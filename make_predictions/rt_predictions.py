@@ -0,0 +1,231 @@
+"""
+Retention time stage for sibling lists.
+
+Sibling pairs (header-less two column CSVs as written by find_siblings) are
+read from any number of files and directories, the peptides of both sides are
+deduplicated and their retention times predicted with Koina in concurrent,
+cached batches. The ΔRT columns are computed for all pairs at once and
+aggregated per peptide length.
+
+Run from the project root with:
+    python -m make_predictions.rt_predictions siblings_dir rt.parquet --aggregates rt_by_length.parquet
+"""
+
+import argparse
+from pathlib import Path
+from typing import ClassVar, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from make_predictions.koina_predictor import KoinaPredictor
+
+
+def read_sibling_pairs(paths: Iterable[Path], pattern: str = "*") -> pd.DataFrame:
+    """
+    Read sibling pairs from header-less two column CSV files. Directories are
+    searched for files matching pattern, empty files are skipped.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns Peptide_1, Peptide_2 and source (file name).
+    """
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(p for p in path.glob(pattern) if p.is_file()) if path.is_dir() else [path])
+
+    dfs = []
+    for file in files:
+        if file.stat().st_size == 0:
+            continue
+        pairs_df = pd.read_csv(file, header=None, names=["Peptide_1", "Peptide_2"], usecols=[0, 1])
+        pairs_df["source"] = file.name
+        dfs.append(pairs_df)
+
+    if not dfs:
+        return pd.DataFrame(columns=["Peptide_1", "Peptide_2", "source"])
+    pairs_df = pd.concat(dfs, ignore_index=True)
+    pairs_df["source"] = pairs_df["source"].astype("category")
+    return pairs_df
+
+
+class RTPredictor(KoinaPredictor):
+    """
+    Retention time predictions from Koina, requested in concurrent, cached
+    batches (see KoinaPredictor).
+    """
+
+    KEY_COLUMNS: ClassVar[List[str]] = ["peptide_sequences"]
+    CACHE_COLUMNS: ClassVar[List[str]] = ["peptide_sequences", "rt"]
+    NAME: ClassVar[str] = "rt"
+    DESCRIPTION: ClassVar[str] = "Predicting retention times"
+
+    def __init__(
+        self,
+        model: str = "Deeplc_hela_hf",
+        output_column: str = "irt",
+        cache_dir: Optional[Path] = None,
+        batch_size: int = 1000,
+        workers: int = 4,
+        max_retries: int = 3,
+        delay: float = 1,
+        server: str = "koina.wilhelmlab.org:443",
+    ):
+        """
+        Parameters
+        ----------
+        model : str
+            Koina model name, e.g. Deeplc_hela_hf, Prosit_2019_irt or AlphaPeptDeep_rt_generic.
+        output_column : str
+            Column of the Koina predictions holding the retention time.
+        cache_dir : Optional[Path]
+            Directory of the prediction cache, a subdirectory is used per model.
+        batch_size, workers, max_retries, delay, server
+            See KoinaPredictor.
+        """
+        self.output_column = output_column
+        super().__init__(model, model, cache_dir, batch_size, workers, max_retries, delay, server)
+
+    def _inputs(self, requests: pd.DataFrame) -> pd.DataFrame:
+        return pd.DataFrame({"peptide_sequences": requests["peptide_sequences"].to_numpy()})
+
+    def _outputs(self, requests: pd.DataFrame, predictions: pd.DataFrame) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "peptide_sequences": predictions["peptide_sequences"].to_numpy(),
+                "rt": predictions[self.output_column].to_numpy(dtype=np.float64),
+            }
+        )
+
+    def _add_to_cache(self, predictions_df: pd.DataFrame):
+        self._cache.update(zip(zip(predictions_df["peptide_sequences"]), predictions_df["rt"]))
+
+    def predict(self, peptides: Iterable[str]) -> np.ndarray:
+        """
+        Predicted retention time of each peptide, in input order. Only
+        peptides which are not cached are requested from Koina.
+        """
+        codes, unique_peptides = pd.factorize(pd.Series(list(peptides), dtype=object))
+        self._fetch(pd.DataFrame({"peptide_sequences": np.asarray(unique_peptides, dtype=object)}))
+
+        unique_rt = np.fromiter(
+            (self._cache.get((p,), np.nan) for p in unique_peptides), dtype=np.float64, count=len(unique_peptides)
+        )
+        return unique_rt[codes]
+
+
+def sibling_rt(pairs_df: pd.DataFrame, predictor: RTPredictor) -> pd.DataFrame:
+    """
+    Predict the retention times of both peptides of all pairs, every distinct
+    peptide is predicted once, and add the ΔRT columns.
+
+    Returns
+    -------
+    pd.DataFrame
+        pairs_df with the columns Peptide_1_RT, Peptide_2_RT, length, delta_RT,
+        absolute_delta_RT, average_RT and delta_RT_normalized
+        (absolute_delta_RT / average_RT).
+    """
+    n = len(pairs_df)
+    rt = predictor.predict(np.concatenate((pairs_df["Peptide_1"].to_numpy(), pairs_df["Peptide_2"].to_numpy())))
+
+    rt_df = pairs_df.copy()
+    rt_df["Peptide_1_RT"] = rt[:n]
+    rt_df["Peptide_2_RT"] = rt[n:]
+    rt_df["length"] = rt_df["Peptide_1"].str.replace(r"\[[^\]]*\]-?", "", regex=True).str.len()
+    rt_df["delta_RT"] = rt_df["Peptide_2_RT"] - rt_df["Peptide_1_RT"]
+    rt_df["absolute_delta_RT"] = rt_df["delta_RT"].abs()
+    rt_df["average_RT"] = (rt_df["Peptide_1_RT"] + rt_df["Peptide_2_RT"]) / 2
+    rt_df["delta_RT_normalized"] = rt_df["absolute_delta_RT"] / rt_df["average_RT"]
+    return rt_df
+
+
+def length_aggregates(rt_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Number of pairs and mean, median, standard deviation and maximum of the
+    absolute and normalized ΔRT per peptide length.
+    """
+    aggregates_df = rt_df.groupby("length")[["absolute_delta_RT", "delta_RT_normalized"]].agg(
+        ["count", "mean", "median", "std", "max"]
+    )
+    aggregates_df.columns = [f"{column}_{statistic}" for column, statistic in aggregates_df.columns]
+    aggregates_df = aggregates_df.rename(columns={"absolute_delta_RT_count": "n_pairs"})
+    return aggregates_df.drop(columns="delta_RT_normalized_count").reset_index()
+
+
+def get_cli():
+    """
+    Command line interface for the retention time stage
+    """
+    parser = argparse.ArgumentParser(
+        description="Predict retention times of sibling pairs and compute their ΔRT."
+    )
+    parser.add_argument(
+        "siblings",
+        nargs="+",
+        type=Path,
+        help="Sibling CSV files or directories containing them."
+    )
+    parser.add_argument(
+        "outfile",
+        type=Path,
+        help="Parquet file with the pairs and their ΔRT."
+    )
+    parser.add_argument(
+        "--aggregates",
+        type=Path,
+        default=None,
+        help="Parquet file with the ΔRT aggregated per peptide length."
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*",
+        help="Glob pattern of the sibling files in directories."
+    )
+    parser.add_argument(
+        "--model",
+        default="Deeplc_hela_hf",
+        help="Koina retention time model."
+    )
+    parser.add_argument(
+        "--output-column",
+        default="irt",
+        help="Column of the model's predictions holding the retention time."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=None,
+        help="Directory caching predictions between runs."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Number of peptides per request."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent requests."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    pairs_df = read_sibling_pairs(args.siblings, args.pattern)
+    predictor = RTPredictor(
+        model=args.model,
+        output_column=args.output_column,
+        cache_dir=args.cache_dir,
+        batch_size=args.batch_size,
+        workers=args.workers,
+    )
+    rt_df = sibling_rt(pairs_df, predictor)
+    rt_df.to_parquet(args.outfile, index=False)
+    if args.aggregates is not None:
+        length_aggregates(rt_df).to_parquet(args.aggregates, index=False)
+    print(f"Predicted {len(rt_df)} sibling pairs")
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("koinapy")
+
+from make_predictions.intensity_predictions import IntensityPredictor  # noqa: E402
+from seq_utils.fragments import fragment_ions, ion_labels  # noqa: E402
+
+
+class FakeKoina:
+    """
+    Predicts the b and y ions of charge 1, with intensity 0 for the ions of
+    number 1, and nothing for peptides with an X.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, inputs):
+        self.batches.append(list(zip(inputs["peptide_sequences"], inputs["precursor_charges"])))
+        assert (inputs["collision_energies"] == 30).all()
+        rows = []
+        for peptide, charge in zip(inputs["peptide_sequences"], inputs["precursor_charges"]):
+            if "X" in peptide:
+                continue
+            ions = fragment_ions([peptide], [1])
+            for label, number, mz in zip(ion_labels(ions.codes), ions.ion_number, ions.mz):
+                rows.append((peptide, charge, label.encode(), mz, 0.0 if number == 1 else float(charge)))
+        return pd.DataFrame(rows, columns=["peptide_sequences", "precursor_charges", "annotation", "mz", "intensities"])
+
+
+def fake_predictor(**params):
+    predictor = IntensityPredictor(collision_energy=30, **params)
+    predictor._koina = FakeKoina()
+    return predictor
+
+
+def test_predict_caches_spectra_of_each_request(tmp_path):
+    predictor = fake_predictor(cache_dir=tmp_path, batch_size=2)
+
+    predicted = predictor.predict(["PEPTIDEK", "AAXK", "PEPTIDEK", "LESLIEK"], [2, 2, 3, 2])
+
+    assert len(predicted) == 4
+    assert sorted(request for batch in predictor._koina.batches for request in batch) == [
+        ("AAXK", 2), ("LESLIEK", 2), ("PEPTIDEK", 2), ("PEPTIDEK", 3)
+    ]
+    codes, mz, intensity = predicted.spectrum(0)
+    ions = fragment_ions(["PEPTIDEK"], [1])
+    expected = dict(zip(ions.codes[ions.ion_number > 1], ions.mz[ions.ion_number > 1]))
+    assert dict(zip(codes, mz)) == expected
+    assert (intensity == 2).all()
+    assert len(predicted.spectrum(1)[0]) == 0
+    assert (predicted.spectrum(2)[2] == 3).all()
+
+    # requests without fragments are cached as well
+    reloaded = fake_predictor(cache_dir=tmp_path)
+    again = reloaded.predict(["LESLIEK", "AAXK", "PEPTIDEK"], [2, 2, 3])
+    assert reloaded._koina.batches == []
+    for idx, original in ((0, 3), (1, 1), (2, 2)):
+        for field, expected_field in zip(again.spectrum(idx), predicted.spectrum(original)):
+            assert np.array_equal(field, expected_field)
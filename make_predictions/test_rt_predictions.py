@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("koinapy")
+
+from make_predictions.rt_predictions import (  # noqa: E402
+    RTPredictor,
+    length_aggregates,
+    read_sibling_pairs,
+    sibling_rt,
+)
+from pipeline.instrumentation import PROFILE  # noqa: E402
+
+
+class FakeKoina:
+    """
+    Predicts the number of residues as retention time and records the requested batches.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, inputs):
+        self.batches.append(inputs["peptide_sequences"].tolist())
+        peptides = inputs["peptide_sequences"]
+        return pd.DataFrame({"peptide_sequences": peptides, "irt": peptides.str.len().astype(float), "other": 0.0})
+
+
+def fake_predictor(**params):
+    predictor = RTPredictor(**params)
+    predictor._koina = FakeKoina()
+    return predictor
+
+
+def test_predict_requests_each_peptide_once(tmp_path):
+    PROFILE.reset()
+    predictor = fake_predictor(cache_dir=tmp_path, batch_size=2, workers=2)
+
+    rt = predictor.predict(["PEPTIDEK", "PEPTLDEK", "PEPTIDEK", "AAK", "LLLLK"])
+
+    assert rt.tolist() == [8, 8, 8, 3, 5]
+    batches = predictor._koina.batches
+    assert sorted(peptide for batch in batches for peptide in batch) == ["AAK", "LLLLK", "PEPTIDEK", "PEPTLDEK"]
+    assert all(len(batch) <= 2 for batch in batches)
+    assert PROFILE.counters["rt_cache.misses"] == 4
+    assert PROFILE.timers["rt_request"].items == 4
+    assert PROFILE.gauges["rt_requests.in_flight"][0] == 0
+
+    # cached in memory
+    assert predictor.predict(["AAK", "PEPTLDEK"]).tolist() == [3, 8]
+    assert len(predictor._koina.batches) == len(batches)
+
+    # and on disk for later runs of the same model
+    reloaded = fake_predictor(cache_dir=tmp_path)
+    assert reloaded.predict(["LLLLK", "PEPTIDEK", "GGK"]).tolist() == [5, 8, 3]
+    assert reloaded._koina.batches == [["GGK"]]
+    assert fake_predictor(cache_dir=tmp_path, model="Prosit_2019_irt")._cache == {}
+
+
+def test_predict_uses_the_output_column():
+    predictor = fake_predictor(output_column="other")
+    assert predictor.predict(["PEPTIDEK"]).tolist() == [0.0]
+
+
+def test_sibling_rt_and_length_aggregates():
+    pairs_df = pd.DataFrame(
+        {
+            "Peptide_1": ["PEPTIDEK", "AAIK", "[Acetyl]-AAIK", "AALK"],
+            "Peptide_2": ["PEPTLDEKK", "AALK", "AALK", "AAIKK"],
+            "source": ["a", "a", "b", "b"],
+        }
+    )
+    predictor = fake_predictor()
+
+    rt_df = sibling_rt(pairs_df, predictor)
+
+    assert sorted(peptide for batch in predictor._koina.batches for peptide in batch) == [
+        "AAIK", "AAIKK", "AALK", "PEPTIDEK", "PEPTLDEKK", "[Acetyl]-AAIK"
+    ]
+    assert rt_df["Peptide_1_RT"].tolist() == [8, 4, 13, 4]
+    assert rt_df["Peptide_2_RT"].tolist() == [9, 4, 4, 5]
+    assert rt_df["length"].tolist() == [8, 4, 4, 4]
+    assert rt_df["delta_RT"].tolist() == [1, 0, -9, 1]
+    assert rt_df["absolute_delta_RT"].tolist() == [1, 0, 9, 1]
+    assert rt_df["average_RT"].tolist() == [8.5, 4, 8.5, 4.5]
+    assert np.allclose(rt_df["delta_RT_normalized"], [1 / 8.5, 0, 9 / 8.5, 1 / 4.5])
+    assert rt_df["source"].tolist() == ["a", "a", "b", "b"]
+
+    aggregates_df = length_aggregates(rt_df)
+
+    assert aggregates_df["length"].tolist() == [4, 8]
+    assert aggregates_df["n_pairs"].tolist() == [3, 1]
+    assert aggregates_df["absolute_delta_RT_mean"].tolist() == pytest.approx([10 / 3, 1])
+    assert aggregates_df["absolute_delta_RT_median"].tolist() == [1, 1]
+    assert aggregates_df["absolute_delta_RT_max"].tolist() == [9, 1]
+    assert aggregates_df["absolute_delta_RT_std"].iloc[0] == pytest.approx(np.std([0, 9, 1], ddof=1))
+    assert np.isnan(aggregates_df["absolute_delta_RT_std"].iloc[1])
+    assert aggregates_df["delta_RT_normalized_max"].tolist() == pytest.approx([9 / 8.5, 1 / 8.5])
+    assert "delta_RT_normalized_count" not in aggregates_df.columns
+
+
+def test_read_sibling_pairs(tmp_path):
+    siblings_dir = tmp_path / "siblings"
+    siblings_dir.mkdir()
+    (siblings_dir / "b.csv").write_text("AAIK,AALK\nPEPTIDEK,PEPTLDEK\n")
+    (siblings_dir / "a.csv").write_text("LLK,ILK,extra\n")
+    (siblings_dir / "empty.csv").write_text("")
+    (siblings_dir / "notes.txt").write_text("not a sibling file\n")
+    (tmp_path / "single.csv").write_text("IIK,LIK\n")
+
+    pairs_df = read_sibling_pairs([siblings_dir, tmp_path / "single.csv"], pattern="*.csv")
+
+    assert pairs_df.columns.tolist() == ["Peptide_1", "Peptide_2", "source"]
+    assert pairs_df["Peptide_1"].tolist() == ["LLK", "AAIK", "PEPTIDEK", "IIK"]
+    assert pairs_df["Peptide_2"].tolist() == ["ILK", "AALK", "PEPTLDEK", "LIK"]
+    assert pairs_df["source"].tolist() == ["a.csv", "b.csv", "b.csv", "single.csv"]
+    assert isinstance(pairs_df["source"].dtype, pd.CategoricalDtype)
+
+    assert read_sibling_pairs([siblings_dir], pattern="empty*").empty
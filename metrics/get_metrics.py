@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import metrics.metrics as M
+from pipeline.instrumentation import timer
 
 metric_keys = [
     m for m in dir(M) if ((m[:2] != "__") & (m != "binarize") & (m != "normalize"))
@@ -27,13 +28,13 @@ metric_keys = [
 ]
 
 
-def add_gaussian_noise(arr, mean=0, std_dev=0.01):
-    noise = np.random.normal(mean, std_dev, arr.shape)
+def add_gaussian_noise(arr, mean=0, std_dev=0.01, rng=None):
+    noise = (rng or np.random).normal(mean, std_dev, arr.shape)
     return arr + noise
 
 
-def swap_two(arr):
-    idx1, idx2 = np.random.choice(len(arr), 2, replace=True)
+def swap_two(arr, rng=None):
+    idx1, idx2 = (rng or np.random).choice(len(arr), 2, replace=True)
     arr[idx1], arr[idx2] = arr[idx2], arr[idx1]
     return arr
 
@@ -47,7 +48,13 @@ def metrics_comparison(
     num_randomizations=1,
     randomize_gaussian=False,
     randomize_switched=False,
+    rng=None,
 ):
+    """
+    Scores of all metrics between the predictions and the switched predictions
+    of each ID. The randomizations draw from rng (a np.random.Generator), or
+    the global NumPy random state if not given.
+    """
     peptide_dict = {}
 
     # Iterate through unique peptide IDs
@@ -90,12 +97,12 @@ def metrics_comparison(
             if randomize_gaussian:
                 # Add Gaussian noise instead of swapping
                 noisy_intensities = add_gaussian_noise(
-                    original_intensities, mean=noise_mean, std_dev=noise_std_dev
+                    original_intensities, mean=noise_mean, std_dev=noise_std_dev, rng=rng
                 )
             if randomize_switched:
                 noisy_intensities = selected_peptide["intensities"].to_numpy()
                 for _ in range(num_randomizations):
-                    noisy_intensities = swap_two(noisy_intensities)
+                    noisy_intensities = swap_two(noisy_intensities, rng)
             noisy_intensities = np.clip(noisy_intensities, 0, None)
 
             for key in metric_keys:
@@ -109,7 +116,8 @@ def metrics_comparison(
                 }
 
                 try:
-                    score = getattr(M, key)(**inp)
+                    with timer(f"metric.{key}", items=1):
+                        score = getattr(M, key)(**inp)
                 except Exception as e:
                     score = np.nan
 
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+from metrics.evaluation import evaluate_discrimination
+
+
+def test_bootstrap_is_independent_of_workers():
+    rng = np.random.default_rng(0)
+    positive_df = pd.DataFrame({"spectral_angle": rng.normal(1, 1, 500), "mse": rng.normal(0, 1, 500)})
+    negative_df = pd.DataFrame({"spectral_angle": rng.normal(0, 1, 400), "mse": rng.normal(1, 1, 400)})
+
+    summaries = [
+        evaluate_discrimination(positive_df, negative_df, n_bootstrap=60, block_size=7, workers=workers)[0]
+        for workers in (1, 3)
+    ]
+
+    pd.testing.assert_frame_equal(*summaries)
+    summary = summaries[0].set_index("metric")
+    assert (summary["auc"] > 0.7).all()
+    assert (summary["auc_ci_low"] < summary["auc"]).all()
+    assert (summary["auc"] < summary["auc_ci_high"]).all()
@@ -0,0 +1,327 @@
+"""
+Low-overhead instrumentation of the hot paths.
+
+Timers, counters and gauges are collected in one process-wide profile:
+
+    with timer("msms_loading", nbytes=size) as t:
+        ...
+        t.items += len(psms_df)
+
+    count("intensity_cache.hits", n_hits)
+    gauge("intensity_requests.in_flight", +1)
+
+A timer records the number of calls and the wall time, minimum and maximum per
+call and the items and bytes processed, from which the report derives
+throughput (items/s, MB/s). Counters named X.hits and X.misses get a hit rate
+X.hit_rate in the report, gauges record their current and peak value. Timers
+of concurrent threads are added up, so the total time of a timer may exceed
+the elapsed time of the run. Work done in worker processes is only recorded
+where the parent process times it.
+
+The report is written as JSON or CSV, and a sampling profiler can record the
+collapsed stacks of all threads (flame graph format). Run any module of the
+project with instrumentation from the project root:
+    python -m pipeline.instrumentation report.json --sample-profile stacks.txt \\
+        ambiguity_search.maxquant results.parquet mzml_dir maxquant_dir ...
+"""
+
+import argparse
+import json
+import runpy
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+
+class Timer:
+    """
+    Accumulated statistics of one timer.
+    """
+
+    __slots__ = ("calls", "seconds", "min_seconds", "max_seconds", "items", "nbytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.min_seconds = float("inf")
+        self.max_seconds = 0.0
+        self.items = 0
+        self.nbytes = 0
+
+
+class _Measurement:
+    """
+    One timed block, items and nbytes can be updated inside the block.
+    """
+
+    __slots__ = ("profile", "name", "items", "nbytes", "start")
+
+    def __init__(self, profile: "Profile", name: str, items: int, nbytes: int):
+        self.profile = profile
+        self.name = name
+        self.items = items
+        self.nbytes = nbytes
+
+    def __enter__(self) -> "_Measurement":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_time(self.name, time.perf_counter() - self.start, self.items, self.nbytes)
+        return False
+
+
+class _NullMeasurement:
+    """
+    Timed block of a disabled profile.
+    """
+
+    __slots__ = ("items", "nbytes")
+
+    def __enter__(self) -> "_NullMeasurement":
+        self.items = 0
+        self.nbytes = 0
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Profile:
+    """
+    Thread-safe collection of timers, counters and gauges.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._start = time.perf_counter()
+            self.timers: Dict[str, Timer] = {}
+            self.counters: Dict[str, float] = {}
+            self.gauges: Dict[str, List[float]] = {}
+
+    def timer(self, name: str, items: int = 0, nbytes: int = 0):
+        """
+        Context manager timing a block, see the module docstring.
+        """
+        if not self.enabled:
+            return _NullMeasurement()
+        return _Measurement(self, name, items, nbytes)
+
+    def add_time(self, name: str, seconds: float, items: int = 0, nbytes: int = 0):
+        with self._lock:
+            stats = self.timers.get(name)
+            if stats is None:
+                stats = self.timers[name] = Timer()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.min_seconds = min(stats.min_seconds, seconds)
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.items += items
+            stats.nbytes += nbytes
+
+    def count(self, name: str, value: float = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, delta: float):
+        """
+        Change a gauge (e.g. requests in flight) by delta and update its peak.
+        """
+        if self.enabled:
+            with self._lock:
+                current, peak = self.gauges.get(name, (0, 0))
+                current += delta
+                self.gauges[name] = [current, max(peak, current)]
+
+    def report(self) -> pd.DataFrame:
+        """
+        One row per timer, counter, hit rate and gauge with the columns kind,
+        name, value (total seconds, count, rate or peak) and for timers the
+        calls, mean/min/max milliseconds, items, items_per_second, bytes and
+        mb_per_second.
+        """
+        return pd.DataFrame(self._report_rows())
+
+    def _report_rows(self) -> List[Dict]:
+        rows = []
+        with self._lock:
+            elapsed = time.perf_counter() - self._start
+            rows.append({"kind": "run", "name": "elapsed_seconds", "value": elapsed})
+            for name, stats in sorted(self.timers.items()):
+                rows.append(
+                    {
+                        "kind": "timer",
+                        "name": name,
+                        "value": stats.seconds,
+                        "calls": stats.calls,
+                        "mean_ms": 1e3 * stats.seconds / stats.calls,
+                        "min_ms": 1e3 * stats.min_seconds,
+                        "max_ms": 1e3 * stats.max_seconds,
+                        "items": stats.items,
+                        "items_per_second": stats.items / stats.seconds if stats.seconds > 0 else None,
+                        "bytes": stats.nbytes,
+                        "mb_per_second": stats.nbytes / stats.seconds / 1e6 if stats.seconds > 0 else None,
+                    }
+                )
+            for name, value in sorted(self.counters.items()):
+                rows.append({"kind": "counter", "name": name, "value": value})
+            for prefix in sorted({name.rsplit(".", 1)[0] for name in self.counters if name.endswith((".hits", ".misses"))}):
+                hits = self.counters.get(f"{prefix}.hits", 0)
+                total = hits + self.counters.get(f"{prefix}.misses", 0)
+                if total > 0:
+                    rows.append({"kind": "rate", "name": f"{prefix}.hit_rate", "value": hits / total})
+            for name, (current, peak) in sorted(self.gauges.items()):
+                rows.append({"kind": "gauge", "name": name, "value": peak, "current": current})
+        return rows
+
+    def write_report(self, path: Path):
+        """
+        Write the report as CSV if the path ends with .csv, JSON otherwise.
+        """
+        path = Path(path)
+        if path.suffix == ".csv":
+            self.report().to_csv(path, index=False)
+        else:
+            with open(path, "w") as f:
+                json.dump({"started": self.started, "entries": self._report_rows()}, f, indent=2)
+
+
+PROFILE = Profile()
+"""
+Profile of this process, used by the module level functions.
+"""
+
+
+def timer(name: str, items: int = 0, nbytes: int = 0):
+    return PROFILE.timer(name, items, nbytes)
+
+
+def count(name: str, value: float = 1):
+    PROFILE.count(name, value)
+
+
+def gauge(name: str, delta: float):
+    PROFILE.gauge(name, delta)
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of all threads in a background thread and count the
+    collapsed stacks ("outer;inner;innermost count" per line, the input of
+    flame graph tools).
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        Parameters
+        ----------
+        interval : float
+            Seconds between samples.
+        """
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "SamplingProfiler":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def write(self, path: Path):
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+
+def get_cli():
+    """
+    Command line interface to run a module with instrumentation
+    """
+    parser = argparse.ArgumentParser(
+        description="Run a module of the project and write the instrumentation report."
+    )
+    parser.add_argument(
+        "report",
+        type=Path,
+        help="Report file, CSV if it ends with .csv, JSON otherwise."
+    )
+    parser.add_argument(
+        "--sample-profile",
+        type=Path,
+        default=None,
+        help="Also sample the stacks of all threads and write them collapsed to this file."
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.01,
+        help="Seconds between stack samples."
+    )
+    parser.add_argument(
+        "module",
+        help="Module to run, e.g. ambiguity_search.maxquant."
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="Arguments of the module."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    # the instrumented modules record into the imported module, not into __main__
+    from pipeline import instrumentation
+
+    args = get_cli().parse_args()
+    sys.argv = [args.module] + args.args
+    profiler = instrumentation.SamplingProfiler(args.interval).start() if args.sample_profile else None
+    instrumentation.PROFILE.reset()
+    try:
+        runpy.run_module(args.module, run_name="__main__", alter_sys=True)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.sample_profile)
+        instrumentation.PROFILE.write_report(args.report)
+        print(f"Wrote instrumentation report to {args.report}", file=sys.stderr)
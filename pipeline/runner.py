@@ -0,0 +1,490 @@
+"""
+Pipeline runner for the I/L workflow.
+
+The workflow is declared as a DAG of stages. Every stage is a function of its
+parameters and of the outputs (DataFrames) of its upstream stages. Its output
+is cached as Parquet under a hash of the stage's code (the function and the
+project modules it imports, see code_digest), its version, its parameters
+(the contents for file parameters) and the hashes of its upstream stages, so only
+stages whose inputs changed are rerun: changing a parameter of the metrics
+stage reruns the metrics but neither the digest nor the predictions. Stages
+whose upstream stages are done run concurrently, e.g. the retention time and
+the intensity predictions. Stages drawing random numbers use their own
+generators seeded by a stage parameter, never the global random state, so
+their outputs do not depend on which stages run at the same time.
+
+Run from the project root with:
+    python -m pipeline.runner proteome.fasta results/ --cache-dir pipeline_cache \\
+        --param metrics_randomized.noise_std_dev=0.2
+"""
+
+import argparse
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import random
+import textwrap
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from pipeline.instrumentation import PROFILE, SamplingProfiler, timer
+
+
+class Stage:
+    """
+    One step of a pipeline.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[..., pd.DataFrame],
+        inputs: Optional[List[str]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        version: str = "",
+    ):
+        """
+        Parameters
+        ----------
+        name : str
+            Unique name of the stage.
+        function : Callable[..., pd.DataFrame]
+            Called with the parameters and the outputs of the input stages as
+            keyword arguments (named after the stages).
+        inputs : Optional[List[str]]
+            Names of the upstream stages.
+        params : Optional[Dict[str, Any]]
+            Parameters, Path values are hashed by content.
+        version : str
+            Part of the cache key, change it to invalidate the cached outputs
+            after changes code_digest does not see (e.g. of installed
+            packages or remote models).
+        """
+        self.name = name
+        self.function = function
+        self.inputs = inputs or []
+        self.params = params or {}
+        self.version = version
+
+
+def _value_digest(value: Any) -> str:
+    """
+    Stable representation of a parameter for hashing.
+    """
+    if isinstance(value, Path):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(value, "rb") as f:
+            while chunk := f.read(1 << 24):
+                digest.update(chunk)
+        return f"file:{digest.hexdigest()}"
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+"""
+Root of the project, imports of modules below it are part of the code digest of a stage.
+"""
+
+
+def _project_module_file(name: str) -> Optional[Path]:
+    """
+    Source file of a module of the project, found without importing it.
+    """
+    path = PROJECT_ROOT.joinpath(*name.split("."))
+    for candidate in (path.with_suffix(".py"), path / "__init__.py"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def _imported_modules(tree: ast.AST, package: Optional[str]) -> Iterator[str]:
+    """
+    Names of all modules imported anywhere in a syntax tree, for "from a import b"
+    both a and a.b (b may be a module).
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            module = node.module or ""
+            if node.level:
+                if not package:
+                    continue
+                module = importlib.util.resolve_name("." * node.level + module, package)
+            yield module
+            yield from (f"{module}.{alias.name}" for alias in node.names)
+
+
+def code_digest(function: Callable) -> str:
+    """
+    Hash of the source of a function and of all project modules it imports,
+    directly or through other project modules. Imports inside functions
+    count, as the stages import their dependencies lazily. Installed
+    packages are not covered, see Stage.version.
+    """
+    source = textwrap.dedent(inspect.getsource(function))
+    module = inspect.getmodule(function)
+    pending = list(_imported_modules(ast.parse(source), getattr(module, "__package__", None)))
+
+    sources = {}
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        path = _project_module_file(name)
+        if path is None or path in sources:
+            continue
+        sources[path] = path.read_text()
+        package = name if path.name == "__init__.py" else name.rpartition(".")[0]
+        pending.extend(_imported_modules(ast.parse(sources[path]), package))
+
+    digest = hashlib.blake2b(source.encode(), digest_size=16)
+    for path in sorted(sources):
+        digest.update(f"{path.relative_to(PROJECT_ROOT).as_posix()}\n".encode())
+        digest.update(sources[path].encode())
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """
+    Run a DAG of stages with content-hashed caching of their outputs.
+    """
+
+    def __init__(self, stages: List[Stage], cache_dir: Path, workers: int = 4):
+        """
+        Parameters
+        ----------
+        stages : List[Stage]
+            Stages of the pipeline, in any order.
+        cache_dir : Path
+            Directory of the cached stage outputs.
+        workers : int
+            Number of stages run concurrently.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        for stage in stages:
+            for upstream in stage.inputs:
+                if upstream not in self.stages:
+                    raise ValueError(f"Unknown input {upstream} of stage {stage.name}")
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self._keys: Dict[str, str] = {}
+
+    def order(self) -> List[str]:
+        """
+        Stage names in topological order.
+        """
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle at stage {name}")
+            visiting.add(name)
+            for upstream in self.stages[name].inputs:
+                visit(upstream)
+            ordered.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return ordered
+
+    def key(self, name: str) -> str:
+        """
+        Cache key of a stage: hash of its code, version, parameters and upstream keys.
+        """
+        if name not in self._keys:
+            stage = self.stages[name]
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(name.encode())
+            digest.update(code_digest(stage.function).encode())
+            digest.update(f"version={stage.version}".encode())
+            for param, value in sorted(stage.params.items()):
+                digest.update(f"{param}={_value_digest(value)}".encode())
+            for upstream in stage.inputs:
+                digest.update(f"{upstream}:{self.key(upstream)}".encode())
+            self._keys[name] = digest.hexdigest()
+        return self._keys[name]
+
+    def output_path(self, name: str) -> Path:
+        return self.cache_dir / f"{name}-{self.key(name)}.parquet"
+
+    def _run_stage(self, name: str, outputs: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+        stage = self.stages[name]
+        with timer(f"stage.{name}") as measurement:
+            output = stage.function(**stage.params, **{upstream: outputs[upstream] for upstream in stage.inputs})
+            measurement.items = len(output)
+        tmp_path = self.output_path(name).with_suffix(".part")
+        output.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.output_path(name))
+        return output
+
+    def run(self, targets: Optional[List[str]] = None, force: Optional[List[str]] = None) -> Dict[str, pd.DataFrame]:
+        """
+        Run the stages needed for the targets (default: all stages) that have
+        no cached output or are forced. Forcing a stage also reruns the
+        needed stages downstream of it: their cache keys do not change, but
+        their cached outputs may be computed from the old output (e.g. after
+        a remote model was updated).
+
+        Returns
+        -------
+        Dict[str, pd.DataFrame]
+            Outputs of the targets, of the stages that ran and of their inputs.
+        """
+        targets = list(targets or self.stages)
+        force = set(force or [])
+        needed = set()
+
+        def require(name):
+            if name not in needed:
+                needed.add(name)
+                for upstream in self.stages[name].inputs:
+                    require(upstream)
+
+        for name in targets:
+            require(name)
+        forced = set()
+        for name in self.order():
+            if name in force or any(upstream in forced for upstream in self.stages[name].inputs):
+                forced.add(name)
+        to_run = {
+            name for name in needed if name in forced or not self.output_path(name).exists()
+        }
+        # a cached output is only read if it is a target or the input of a stage that runs
+        to_load = (set(targets) | {
+            upstream for name in to_run for upstream in self.stages[name].inputs
+        }) - to_run
+        pending = [name for name in self.order() if name in to_run]
+
+        outputs: Dict[str, pd.DataFrame] = {}
+        for name in sorted(to_load):
+            tqdm.write(f"[{name}] cached")
+            outputs[name] = pd.read_parquet(self.output_path(name))
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if all(upstream in outputs for upstream in self.stages[name].inputs):
+                        pending.remove(name)
+                        tqdm.write(f"[{name}] running")
+                        running[executor.submit(self._run_stage, name, outputs)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    outputs[name] = future.result()
+                    tqdm.write(f"[{name}] done")
+
+        return outputs
+
+
+# Stages of the I/L workflow
+
+def digest_stage(fasta_file: Path, min_length: int = 7, max_length: int = 30) -> pd.DataFrame:
+    from seq_utils.fasta_to_peptides import create_tryptic_peptides
+    from seq_utils.peptide import remove_non_il, remove_ux_containing
+
+    with timer("digestion") as measurement:
+        peptides = create_tryptic_peptides(str(fasta_file), min_length, max_length)
+        measurement.items = len(peptides)
+    peptides = remove_ux_containing(remove_non_il(peptides))
+    return pd.DataFrame({"peptide": sorted(peptides)})
+
+
+def swap_stage(digest: pd.DataFrame, seed: int = 42) -> pd.DataFrame:
+    from seq_utils.peptide import switch_random_il
+
+    rng = random.Random(seed)
+    return pd.DataFrame(
+        {
+            "peptide": digest["peptide"],
+            "peptide_switched": [switch_random_il(peptide, rng) for peptide in digest["peptide"]],
+        }
+    )
+
+
+def intensity_stage(
+    swap: pd.DataFrame,
+    model: str = "Prosit_2019_intensity",
+    charge: int = 2,
+    collision_energy: float = 28,
+    batch_size: int = 5000,
+) -> pd.DataFrame:
+    from make_predictions.intensity_predictions import safe_obtain_predictions
+
+    predictions = []
+    for switched, column in ((False, "peptide"), (True, "peptide_switched")):
+        # every sequence is predicted once, the ID of a prediction is its pair
+        peptides = swap[column].unique()
+        batches = [
+            safe_obtain_predictions(
+                peptides[start:start + batch_size],
+                switched=switched,
+                model=model,
+                charges=[charge],
+                collision_energie=collision_energy,
+            )
+            for start in range(0, len(peptides), batch_size)
+        ]
+        pairs_df = pd.DataFrame({"ID": np.arange(len(swap)), "peptide_sequences": swap[column].to_numpy()})
+        predictions.append(pairs_df.merge(pd.concat(batches, ignore_index=True), on="peptide_sequences"))
+    return pd.concat(predictions, ignore_index=True)
+
+
+def rt_stage(swap: pd.DataFrame, model: str = "Deeplc_hela_hf", output_column: str = "irt") -> pd.DataFrame:
+    from make_predictions.rt_predictions import RTPredictor, sibling_rt
+
+    pairs_df = pd.DataFrame({"Peptide_1": swap["peptide"], "Peptide_2": swap["peptide_switched"]})
+    return sibling_rt(pairs_df, RTPredictor(model, output_column))
+
+
+def metrics_stage(intensity: pd.DataFrame, seed: Any = 42, **comparison_params) -> pd.DataFrame:
+    from metrics.get_metrics import metrics_comparison
+
+    predictions = intensity[intensity["non_switched"] == False]
+    switched_predictions = intensity[intensity["non_switched"] == True]
+    score_df = metrics_comparison(
+        predictions, switched_predictions, rng=np.random.default_rng(seed), **comparison_params
+    )
+    return score_df.apply(pd.to_numeric, errors="coerce").rename_axis("pair").reset_index()
+
+
+def evaluation_stage(metrics: pd.DataFrame, metrics_randomized: pd.DataFrame) -> pd.DataFrame:
+    from metrics.evaluation import evaluate_discrimination
+
+    columns = [column for column in metrics.columns if column != "pair"]
+    summary_df, _ = evaluate_discrimination(metrics, metrics_randomized, columns=columns)
+    return summary_df
+
+
+def default_stages(fasta_file: Path) -> List[Stage]:
+    """
+    fasta -> digest -> swap -> intensity/rt predictions -> metrics -> evaluation
+    """
+    return [
+        Stage("digest", digest_stage, params={"fasta_file": Path(fasta_file)}),
+        Stage("swap", swap_stage, ["digest"]),
+        Stage("intensity", intensity_stage, ["swap"]),
+        Stage("rt", rt_stage, ["swap"]),
+        Stage("metrics", metrics_stage, ["intensity"]),
+        Stage(
+            "metrics_randomized",
+            metrics_stage,
+            ["intensity"],
+            {"randomize_gaussian": True, "noise_std_dev": 0.1},
+        ),
+        Stage("evaluation", evaluation_stage, ["metrics", "metrics_randomized"]),
+    ]
+
+
+def _parse_param(assignment: str):
+    name, value = assignment.split("=", 1)
+    stage, param = name.split(".", 1)
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return stage, param, value
+
+
+def get_cli():
+    """
+    Command line interface for the pipeline runner
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the I/L workflow with cached, concurrently running stages."
+    )
+    parser.add_argument(
+        "fasta_file",
+        type=Path,
+        help="Proteome FASTA file."
+    )
+    parser.add_argument(
+        "out_dir",
+        type=Path,
+        help="Directory the outputs of the target stages are written to."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=Path("pipeline_cache"),
+        help="Directory of the cached stage outputs."
+    )
+    parser.add_argument(
+        "--targets",
+        nargs="+",
+        default=None,
+        help="Stages to compute (default: all)."
+    )
+    parser.add_argument(
+        "--force",
+        nargs="+",
+        default=None,
+        help="Stages to rerun even if cached, the stages downstream of them are rerun as well."
+    )
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="Stage parameter as stage.param=value, the value is parsed as JSON if possible."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of stages run concurrently."
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Write the instrumentation report (timers, throughput, cache hit rates) to this JSON or CSV file."
+    )
+    parser.add_argument(
+        "--sample-profile",
+        type=Path,
+        default=None,
+        help="Sample the stacks of all threads and write them collapsed to this file."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    stages = default_stages(args.fasta_file)
+    stages_by_name = {stage.name: stage for stage in stages}
+    for assignment in args.param:
+        stage, param, value = _parse_param(assignment)
+        stages_by_name[stage].params[param] = value
+
+    pipeline = Pipeline(stages, args.cache_dir, args.workers)
+    profiler = SamplingProfiler().start() if args.sample_profile else None
+    try:
+        outputs = pipeline.run(args.targets, args.force)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.sample_profile)
+        if args.report is not None:
+            PROFILE.write_report(args.report)
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    for name in args.targets or [stage.name for stage in stages]:
+        outputs[name].to_parquet(args.out_dir / f"{name}.parquet", index=False)
+    print(f"Wrote {', '.join(args.targets or stages_by_name)} to {args.out_dir}")
@@ -0,0 +1,576 @@
+"""
+Sharded execution of large jobs through a work manifest on shared storage.
+
+A planner splits a job into shards and writes the manifest of the job
+directory. Any number of worker processes, on one or many nodes sharing the
+directory, claim shards and write one Parquet output per shard, and a merge
+step concatenates the outputs in shard order. There is no queue service,
+all coordination uses atomic file operations:
+
+    manifest.json           task, parameters, shards and lease
+    claims/<shard>/<n>      attempt n of a shard, created with O_EXCL so only
+                            one worker gets it; the owner touches the file as
+                            heartbeat while it works on the shard
+    claims/<shard>/<n>.error
+                            traceback of a failed attempt
+    outputs/<shard>.parquet output of a shard, written to a temporary file
+                            and renamed
+
+A shard is claimable if it has no output and no attempt yet, or its latest
+attempt failed or is stale (no heartbeat for lease seconds, e.g. a crashed
+worker), as long as it had less than max_attempts attempts. Reclaiming creates
+the next attempt file, so concurrent reclaims of a stale shard cannot both
+succeed. The clocks of the nodes are assumed to agree within the lease.
+
+Tasks are functions returning a DataFrame, called with the job parameters and
+the arguments of a shard. Built-in tasks are the metric scoring of
+predictions by ID range (metrics), the I/L siblings of proteome FASTA files
+(proteome_siblings) and the extraction of the spectra of mzML/MGF files
+(spectra), other tasks are given as module:function.
+
+Run from the project root, e.g.:
+    python -m pipeline.sharding plan job_dir metrics predictions.parquet --shard-size 5000
+    python -m pipeline.sharding work job_dir --processes 8     # on every node
+    python -m pipeline.sharding status job_dir
+    python -m pipeline.sharding merge job_dir scores.parquet
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pipeline.instrumentation import timer
+
+
+# Tasks
+
+def metrics_shard(
+    predictions: str, id_start: int, id_stop: int, seed: int = 42, **comparison_params
+) -> pd.DataFrame:
+    """
+    Metrics of the pairs with IDs in [id_start, id_stop) of predictions as
+    written by the intensity stage of pipeline.runner. The randomizations of
+    each shard draw from their own generator, seeded by seed and id_start.
+    """
+    from pipeline.runner import metrics_stage
+
+    intensity = pd.read_parquet(predictions, filters=[("ID", ">=", id_start), ("ID", "<", id_stop)])
+    return metrics_stage(intensity, seed=[seed, id_start], **comparison_params)
+
+
+def proteome_siblings_shard(paths: List[str], min_length: int = 6, max_length: int = 60) -> pd.DataFrame:
+    """
+    I/L sibling pairs of the tryptic peptides of each proteome FASTA file.
+    """
+    from find_siblings.isobaric_siblings import find_isobaric_siblings
+    from seq_utils.fasta_to_peptides import create_tryptic_peptides
+    from seq_utils.mass import RESIDUE_MASSES
+    from seq_utils.peptide import remove_non_il
+
+    siblings = []
+    for path in paths:
+        peptides = remove_non_il(create_tryptic_peptides(path, min_length, max_length))
+        peptides = [p for p in peptides if set(p) <= RESIDUE_MASSES.keys()]
+        pairs_df = find_isobaric_siblings(peptides, ppm=0, rules=["I/L"])
+        siblings.append(pairs_df[["Peptide_1", "Peptide_2"]].assign(proteome=Path(path).name))
+    return pd.concat(siblings, ignore_index=True)
+
+
+def spectra_shard(paths: List[str]) -> pd.DataFrame:
+    """
+    MS2 spectra of mzML or MGF files, one row per spectrum with the peaks as lists.
+    """
+    from spectra.store import read_spectra
+
+    columns = ["scan_number", "precursor_mz", "charge", "retention_time", "mz", "intensity"]
+    spectra = []
+    for path in paths:
+        spectra_df = pd.DataFrame(list(read_spectra(Path(path))), columns=columns)
+        spectra.append(spectra_df.assign(raw_file=Path(path).stem))
+    return pd.concat(spectra, ignore_index=True)[["raw_file", *columns]]
+
+
+TASKS: Dict[str, Callable[..., pd.DataFrame]] = {
+    "metrics": metrics_shard,
+    "proteome_siblings": proteome_siblings_shard,
+    "spectra": spectra_shard,
+}
+"""
+Built-in tasks by name.
+"""
+
+
+def resolve_task(task: str) -> Callable[..., pd.DataFrame]:
+    if task in TASKS:
+        return TASKS[task]
+    module, _, function = task.partition(":")
+    if not function:
+        raise ValueError(f"Unknown task {task}, use one of {', '.join(TASKS)} or module:function")
+    return getattr(importlib.import_module(module), function)
+
+
+# Planning
+
+def plan_id_ranges(predictions: Path, shard_size: int) -> List[Dict[str, Any]]:
+    """
+    Shards of shard_size consecutive IDs of a predictions Parquet file.
+    """
+    ids = pd.read_parquet(predictions, columns=["ID"])["ID"]
+    stop = int(ids.max()) + 1 if len(ids) else 0
+    return [
+        {"predictions": str(Path(predictions).resolve()), "id_start": start, "id_stop": min(start + shard_size, stop)}
+        for start in range(0, stop, shard_size)
+    ]
+
+
+def plan_files(paths: List[Path], shard_size: int) -> List[Dict[str, Any]]:
+    """
+    Shards of shard_size files each.
+    """
+    paths = [str(Path(p).resolve()) for p in paths]
+    return [{"paths": paths[start:start + shard_size]} for start in range(0, len(paths), shard_size)]
+
+
+def plan(
+    job_dir: Path,
+    task: str,
+    shards: List[Dict[str, Any]],
+    params: Optional[Dict[str, Any]] = None,
+    lease_seconds: float = 600,
+    max_attempts: int = 3,
+) -> "ShardedJob":
+    """
+    Write the manifest of a new job.
+
+    Parameters
+    ----------
+    job_dir : Path
+        Job directory on storage shared by all workers.
+    task : str
+        Name of a built-in task or module:function.
+    shards : List[Dict[str, Any]]
+        Keyword arguments of the task per shard.
+    params : Optional[Dict[str, Any]]
+        Keyword arguments of the task common to all shards.
+    lease_seconds : float
+        Time without heartbeat after which a claimed shard is reclaimed.
+    max_attempts : int
+        Maximal number of attempts per shard.
+    """
+    resolve_task(task)
+    job_dir = Path(job_dir)
+    if ShardedJob.is_job(job_dir):
+        raise FileExistsError(f"{job_dir} already has a manifest")
+    job_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = {
+        "task": task,
+        "params": params or {},
+        "lease_seconds": lease_seconds,
+        "max_attempts": max_attempts,
+        "shards": {f"{idx:06d}": shard for idx, shard in enumerate(shards)},
+    }
+    tmp_path = job_dir / "manifest.json.part"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, job_dir / "manifest.json")
+    return ShardedJob(job_dir)
+
+
+# Execution
+
+class ShardedJob:
+    """
+    Claims, outputs and merging of a planned job.
+    """
+
+    def __init__(self, job_dir: Path):
+        """
+        Parameters
+        ----------
+        job_dir : Path
+            Job directory with the manifest.
+        """
+        self.job_dir = Path(job_dir)
+        with open(self.job_dir / "manifest.json") as f:
+            manifest = json.load(f)
+        self.task = manifest["task"]
+        self.params = manifest["params"]
+        self.lease_seconds = manifest["lease_seconds"]
+        self.max_attempts = manifest["max_attempts"]
+        self.shards: Dict[str, Dict[str, Any]] = manifest["shards"]
+        self.claims_dir = self.job_dir / "claims"
+        self.outputs_dir = self.job_dir / "outputs"
+        self.claims_dir.mkdir(exist_ok=True)
+        self.outputs_dir.mkdir(exist_ok=True)
+
+    @staticmethod
+    def is_job(job_dir: Path) -> bool:
+        return Path(job_dir).joinpath("manifest.json").exists()
+
+    def output_path(self, shard: str) -> Path:
+        return self.outputs_dir / f"{shard}.parquet"
+
+    def _attempts(self, shard: str) -> List[int]:
+        try:
+            names = os.listdir(self.claims_dir / shard)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def shard_state(self, shard: str) -> str:
+        """
+        done, pending, running, stale (claimable again), retry (last attempt
+        failed) or failed (no attempts left).
+        """
+        return self._state(shard, self._attempts(shard))
+
+    def _state(self, shard: str, attempts: List[int]) -> str:
+        if self.output_path(shard).exists():
+            return "done"
+        if not attempts:
+            return "pending"
+        claim = self.claims_dir / shard / str(attempts[-1])
+        if claim.with_name(f"{claim.name}.error").exists():
+            state = "retry"
+        else:
+            try:
+                idle = time.time() - claim.stat().st_mtime
+            except FileNotFoundError:
+                idle = 0.0
+            if idle <= self.lease_seconds:
+                return "running"
+            state = "stale"
+        return state if attempts[-1] < self.max_attempts else "failed"
+
+    def status(self) -> Dict[str, int]:
+        states = [self.shard_state(shard) for shard in self.shards]
+        return {state: states.count(state) for state in ("done", "running", "pending", "stale", "retry", "failed")}
+
+    def claim(self, shard: str, worker_id: str) -> Optional[Path]:
+        """
+        Claim a shard, returns the claim file or None if it is not claimable
+        or another worker was faster.
+        """
+        # state and next attempt from the same listing, if another worker
+        # claimed the shard since, creating the attempt file fails
+        attempts = self._attempts(shard)
+        if self._state(shard, attempts) not in ("pending", "stale", "retry"):
+            return None
+        attempt = attempts[-1] + 1 if attempts else 1
+        claim = self.claims_dir / shard / str(attempt)
+        claim.parent.mkdir(exist_ok=True)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "claimed": time.time()}, f)
+        return claim
+
+    def run_shard(self, shard: str, claim: Path):
+        """
+        Run the task of a claimed shard and write its output, the claim is
+        touched every third of the lease while the task runs.
+        """
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_seconds / 3):
+                os.utime(claim)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            with timer(f"shard.{self.task}") as measurement:
+                output = resolve_task(self.task)(**self.params, **self.shards[shard])
+                measurement.items = len(output)
+            tmp_path = self.outputs_dir / f"{shard}.parquet.{claim.name}.part"
+            output.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.output_path(shard))
+        finally:
+            stop.set()
+            thread.join()
+
+    def work(
+        self,
+        worker_id: Optional[str] = None,
+        max_shards: Optional[int] = None,
+        wait: bool = True,
+        poll_seconds: float = 5,
+    ) -> int:
+        """
+        Claim and run shards until all are done or failed.
+
+        Parameters
+        ----------
+        worker_id : Optional[str]
+            Name of the worker in the claims (default: host:pid).
+        max_shards : Optional[int]
+            Stop after this number of shards.
+        wait : bool
+            Wait for shards running on other workers, which are reclaimed if
+            they become stale, instead of returning when nothing is claimable.
+        poll_seconds : float
+            Seconds between scans for claimable shards while waiting.
+
+        Returns
+        -------
+        int
+            Number of shards run by this worker.
+        """
+        worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        n_run = 0
+        while True:
+            states = {shard: self.shard_state(shard) for shard in self.shards}
+            claimable = [shard for shard, state in states.items() if state in ("pending", "stale", "retry")]
+            if not claimable and (not wait or "running" not in states.values()):
+                return n_run
+
+            # workers start at different shards to avoid contention
+            random.shuffle(claimable)
+            for shard in claimable:
+                claim = self.claim(shard, worker_id)
+                if claim is None:
+                    continue
+                try:
+                    self.run_shard(shard, claim)
+                except Exception:
+                    claim.with_name(f"{claim.name}.error").write_text(traceback.format_exc())
+                    print(f"Shard {shard} failed on attempt {claim.name}, see {claim}.error", flush=True)
+                n_run += 1
+                if max_shards is not None and n_run >= max_shards:
+                    return n_run
+            else:
+                if not claimable:
+                    time.sleep(poll_seconds)
+
+    def merge(self, outfile: Path) -> int:
+        """
+        Concatenate the outputs of all shards in shard order into a Parquet
+        (.parquet) or tab-separated file.
+
+        Returns
+        -------
+        int
+            Number of rows written.
+        """
+        missing = [shard for shard in self.shards if not self.output_path(shard).exists()]
+        if missing:
+            raise RuntimeError(f"{len(missing)} of {len(self.shards)} shards are not done: {self.status()}")
+
+        outfile = Path(outfile)
+        parts = [self.output_path(shard) for shard in self.shards]
+        schema = _merged_schema(parts)
+        tmp_path = outfile.with_name(outfile.name + ".part")
+
+        n_rows = 0
+        if outfile.suffix == ".parquet":
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for part in parts:
+                    table = _read_part(part, schema)
+                    writer.write_table(table)
+                    n_rows += table.num_rows
+        else:
+            with open(tmp_path, "w") as f:
+                for idx, part in enumerate(parts):
+                    part_df = _read_part(part, schema).to_pandas()
+                    part_df.to_csv(f, sep="\t", index=False, header=idx == 0)
+                    n_rows += len(part_df)
+        os.replace(tmp_path, outfile)
+        return n_rows
+
+
+def _merged_schema(parts: List[Path]) -> pa.Schema:
+    """
+    Union of the columns of the shard outputs. The types are taken from the
+    non-empty outputs, the column types of empty outputs are often only
+    placeholders (e.g. float64 for an empty column of strings).
+    """
+    files = [pq.ParquetFile(part) for part in parts]
+    filled = [f.schema_arrow for f in files if f.metadata.num_rows > 0]
+    schema = pa.unify_schemas(filled) if filled else pa.schema([])
+    for f in files:
+        for field in f.schema_arrow:
+            if field.name not in schema.names:
+                schema = schema.append(field)
+    return schema.remove_metadata()
+
+
+def _read_part(part: Path, schema: pa.Schema) -> pa.Table:
+    """
+    Shard output with the columns of the merged schema, columns a shard did
+    not produce (e.g. an empty shard) are filled with nulls.
+    """
+    table = pq.read_table(part)
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _work(job_dir: Path, worker_id: str, max_shards: Optional[int], wait: bool) -> int:
+    return ShardedJob(job_dir).work(worker_id, max_shards, wait)
+
+
+def _parse_param(assignment: str):
+    name, value = assignment.split("=", 1)
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return name, value
+
+
+def get_cli():
+    """
+    Command line interface for planning, working on, inspecting and merging sharded jobs
+    """
+    parser = argparse.ArgumentParser(
+        description="Sharded execution of large jobs through a work manifest on shared storage."
+    )
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    plan_parser = actions.add_parser("plan", help="Split a job into shards and write its manifest.")
+    plan_parser.add_argument(
+        "job_dir",
+        type=Path,
+        help="Job directory on storage shared by all workers."
+    )
+    plan_parser.add_argument(
+        "task",
+        help=f"Task: {', '.join(TASKS)} or module:function (called with paths=[...])."
+    )
+    plan_parser.add_argument(
+        "inputs",
+        nargs="+",
+        type=Path,
+        help="Predictions Parquet file (metrics) or input files (other tasks)."
+    )
+    plan_parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=None,
+        help="IDs (metrics, default: 5000) or files (other tasks, default: 1) per shard."
+    )
+    plan_parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="Task parameter as name=value, the value is parsed as JSON if possible."
+    )
+    plan_parser.add_argument(
+        "--lease",
+        type=float,
+        default=600,
+        help="Seconds without heartbeat after which a claimed shard is reclaimed."
+    )
+    plan_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Maximal number of attempts per shard."
+    )
+
+    work_parser = actions.add_parser("work", help="Claim and run shards until the job is done.")
+    work_parser.add_argument(
+        "job_dir",
+        type=Path,
+        help="Job directory."
+    )
+    work_parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of local worker processes."
+    )
+    work_parser.add_argument(
+        "--worker-id",
+        default=None,
+        help="Name of the worker in the claims (default: host:pid)."
+    )
+    work_parser.add_argument(
+        "--max-shards",
+        type=int,
+        default=None,
+        help="Number of shards after which each worker stops."
+    )
+    work_parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Return when no shard is claimable instead of waiting for running shards."
+    )
+
+    status_parser = actions.add_parser("status", help="Count the shards by state.")
+    status_parser.add_argument(
+        "job_dir",
+        type=Path,
+        help="Job directory."
+    )
+
+    merge_parser = actions.add_parser("merge", help="Concatenate the shard outputs.")
+    merge_parser.add_argument(
+        "job_dir",
+        type=Path,
+        help="Job directory."
+    )
+    merge_parser.add_argument(
+        "outfile",
+        type=Path,
+        help="Output file. (.parquet == Parquet format, other: tab-separated values)"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+
+    if args.action == "plan":
+        if args.task == "metrics":
+            shards = plan_id_ranges(args.inputs[0], args.shard_size or 5000)
+        else:
+            shards = plan_files(args.inputs, args.shard_size or 1)
+        job = plan(
+            args.job_dir, args.task, shards, dict(map(_parse_param, args.param)), args.lease, args.max_attempts
+        )
+        print(f"Planned {len(job.shards)} shards of {args.task} in {args.job_dir}")
+
+    elif args.action == "work":
+        if args.processes == 1:
+            n_run = ShardedJob(args.job_dir).work(args.worker_id, args.max_shards, not args.no_wait)
+        else:
+            worker_id = args.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+            with ProcessPoolExecutor(max_workers=args.processes) as executor:
+                n_run = sum(
+                    executor.map(
+                        _work,
+                        [args.job_dir] * args.processes,
+                        [f"{worker_id}/{idx}" for idx in range(args.processes)],
+                        [args.max_shards] * args.processes,
+                        [not args.no_wait] * args.processes,
+                    )
+                )
+        print(f"Ran {n_run} shards, status: {ShardedJob(args.job_dir).status()}")
+
+    elif args.action == "status":
+        print(json.dumps(ShardedJob(args.job_dir).status()))
+
+    elif args.action == "merge":
+        n_rows = ShardedJob(args.job_dir).merge(args.outfile)
+        print(f"Wrote {n_rows} rows to {args.outfile}")
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from pipeline import instrumentation
+from pipeline.instrumentation import Profile, SamplingProfiler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # perf_counter advanced by hand, so that timer durations are exact
+    now = [100.0]
+    monkeypatch.setattr(instrumentation.time, "perf_counter", lambda: now[0])
+    return now
+
+
+def recorded_profile(clock):
+    profile = Profile()
+    with profile.timer("read", nbytes=4_000_000) as measurement:
+        clock[0] += 2.0
+        measurement.items += 100
+    with profile.timer("read", items=50, nbytes=2_000_000):
+        clock[0] += 1.0
+    profile.count("cache.hits", 3)
+    profile.count("cache.misses")
+    profile.count("requests", 2.5)
+    profile.gauge("requests.in_flight", 2)
+    profile.gauge("requests.in_flight", 3)
+    profile.gauge("requests.in_flight", -4)
+    return profile
+
+
+def test_report_derives_throughput_hit_rates_and_gauges(clock):
+    report = recorded_profile(clock).report().set_index("name")
+
+    assert report.loc["elapsed_seconds", "kind"] == "run"
+    assert report.loc["elapsed_seconds", "value"] == pytest.approx(3.0)
+
+    read = report.loc["read"]
+    assert read["kind"] == "timer"
+    assert read["value"] == pytest.approx(3.0)
+    assert read["calls"] == 2
+    assert read["mean_ms"] == pytest.approx(1500.0)
+    assert read["min_ms"] == pytest.approx(1000.0)
+    assert read["max_ms"] == pytest.approx(2000.0)
+    assert read["items"] == 150
+    assert read["items_per_second"] == pytest.approx(50.0)
+    assert read["bytes"] == 6_000_000
+    assert read["mb_per_second"] == pytest.approx(2.0)
+
+    assert report.loc["cache.hits", "value"] == 3
+    assert report.loc["cache.misses", "value"] == 1
+    assert report.loc["requests", "value"] == 2.5
+    assert report.loc["cache.hit_rate", "kind"] == "rate"
+    assert report.loc["cache.hit_rate", "value"] == pytest.approx(0.75)
+    # requests has no hits/misses counters and no hit rate
+    assert "requests.hit_rate" not in report.index
+
+    assert report.loc["requests.in_flight", "kind"] == "gauge"
+    assert report.loc["requests.in_flight", "value"] == 5
+    assert report.loc["requests.in_flight", "current"] == 1
+
+
+def test_timer_without_duration_has_no_throughput(clock):
+    profile = Profile()
+    with profile.timer("instant", items=10):
+        pass
+
+    report = profile.report().set_index("name")
+
+    assert report.loc["instant", "items"] == 10
+    assert pd.isna(report.loc["instant", "items_per_second"])
+    assert pd.isna(report.loc["instant", "mb_per_second"])
+
+
+def test_write_report_as_json_and_csv(clock, tmp_path):
+    profile = recorded_profile(clock)
+    expected = profile.report()
+
+    profile.write_report(tmp_path / "report.json")
+    with open(tmp_path / "report.json") as f:
+        written = json.load(f)
+    assert written["started"] == profile.started
+    pd.testing.assert_frame_equal(pd.DataFrame(written["entries"]), expected)
+
+    profile.write_report(tmp_path / "report.csv")
+    written_csv = pd.read_csv(tmp_path / "report.csv")
+    assert written_csv.columns.tolist() == expected.columns.tolist()
+    assert written_csv["name"].tolist() == expected["name"].tolist()
+    pd.testing.assert_series_equal(written_csv["value"], expected["value"])
+
+
+def test_disabled_profile_records_nothing():
+    profile = Profile(enabled=False)
+
+    with profile.timer("read", items=5, nbytes=10) as measurement:
+        measurement.items += 1
+        measurement.nbytes += 1
+    profile.count("cache.hits")
+    profile.gauge("requests.in_flight", 1)
+
+    assert profile.timers == {} and profile.counters == {} and profile.gauges == {}
+    assert profile.report()["name"].tolist() == ["elapsed_seconds"]
+
+
+def test_timer_records_failing_blocks(clock):
+    profile = Profile()
+    with pytest.raises(ValueError):
+        with profile.timer("failing"):
+            clock[0] += 1.0
+            raise ValueError()
+    assert profile.timers["failing"].calls == 1
+    assert profile.timers["failing"].seconds == pytest.approx(1.0)
+
+
+def test_concurrent_counts_are_not_lost():
+    profile = Profile()
+
+    def work():
+        for _ in range(1000):
+            profile.count("cache.hits")
+            profile.gauge("requests.in_flight", 1)
+            profile.gauge("requests.in_flight", -1)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert profile.counters["cache.hits"] == 8000
+    assert profile.gauges["requests.in_flight"][0] == 0
+
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler_captures_busy_thread(tmp_path):
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_function, args=(stop,))
+    thread.start()
+    try:
+        with SamplingProfiler(interval=0.001) as profiler:
+            time.sleep(0.3)
+    finally:
+        stop.set()
+        thread.join()
+
+    busy_samples = sum(
+        samples for stack, samples in profiler.stacks.items() if "busy_function (test_instrumentation.py:" in stack
+    )
+    assert busy_samples > 10
+    # the sampling thread does not sample itself
+    assert not any("_sample (instrumentation.py:" in stack for stack in profiler.stacks)
+
+    profiler.write(tmp_path / "stacks.txt")
+    written = dict(line.rsplit(" ", 1) for line in (tmp_path / "stacks.txt").read_text().splitlines())
+    assert {stack: int(samples) for stack, samples in written.items()} == dict(profiler.stacks)
+    # collapsed from the outermost frame of the thread to the innermost
+    busy_stacks = [stack.split(";") for stack in written if "busy_function" in stack]
+    assert all(frames[0].startswith("_bootstrap (threading.py:") for frames in busy_stacks)
+    assert any(frames[-1].startswith("busy_function (test_instrumentation.py:") for frames in busy_stacks)
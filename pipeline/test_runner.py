@@ -0,0 +1,167 @@
+import importlib
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from metrics.get_metrics import add_gaussian_noise, swap_two
+from pipeline import runner
+from pipeline.runner import Pipeline, Stage, code_digest, swap_stage
+
+
+def write_modules(root, modules):
+    for name, source in modules.items():
+        path = root.joinpath(*name.split(".")).with_suffix(".py")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+
+
+def load_stage(root, monkeypatch):
+    monkeypatch.syspath_prepend(str(root))
+    for name in [name for name in sys.modules if name.startswith("stagepkg")]:
+        del sys.modules[name]
+    importlib.invalidate_caches()
+    return importlib.import_module("stagepkg.stages").stage
+
+
+def test_code_digest_covers_imported_project_modules(tmp_path, monkeypatch):
+    monkeypatch.setattr(runner, "PROJECT_ROOT", tmp_path)
+    write_modules(
+        tmp_path,
+        {
+            "stagepkg.__init__": "",
+            "stagepkg.stages": "def stage():\n    from stagepkg.helper import value\n    return value()\n",
+            "stagepkg.helper": "from . import deep\n\ndef value():\n    return deep.VALUE\n",
+            "stagepkg.deep": "import numpy\nVALUE = 1\n",
+            "stagepkg.unrelated": "VALUE = 1\n",
+        },
+    )
+    digest = code_digest(load_stage(tmp_path, monkeypatch))
+
+    write_modules(tmp_path, {"stagepkg.unrelated": "VALUE = 2\n"})
+    assert code_digest(load_stage(tmp_path, monkeypatch)) == digest
+
+    # a module imported by a module the stage imports
+    write_modules(tmp_path, {"stagepkg.deep": "import numpy\nVALUE = 2\n"})
+    assert code_digest(load_stage(tmp_path, monkeypatch)) != digest
+
+
+def test_key_depends_on_version(tmp_path):
+    def keys(version):
+        stages = [
+            Stage("a", swap_stage, version=version),
+            Stage("b", swap_stage, ["a"]),
+        ]
+        pipeline = Pipeline(stages, tmp_path)
+        return pipeline.key("a"), pipeline.key("b")
+
+    assert keys("") == keys("")
+    assert keys("")[0] != keys("2")[0]
+    assert keys("")[1] != keys("2")[1]
+
+
+def test_swap_stage_uses_its_own_generator():
+    digest = pd.DataFrame({"peptide": [f"LLIL{'A' * idx}ILLK" for idx in range(200)]})
+    expected = swap_stage(digest, seed=7)
+
+    random.seed(0)
+    global_state = random.getstate()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(lambda _: swap_stage(digest, seed=7), range(8)))
+    assert random.getstate() == global_state
+
+    for output in outputs:
+        pd.testing.assert_frame_equal(output, expected)
+    assert not swap_stage(digest, seed=8).equals(expected)
+
+
+def test_randomizations_draw_from_the_given_generator():
+    np.random.seed(0)
+    global_state = np.random.get_state()[1].copy()
+    intensities = np.linspace(0, 1, 20)
+
+    noisy = add_gaussian_noise(intensities, std_dev=0.1, rng=np.random.default_rng(3))
+    swapped = swap_two(intensities.copy(), np.random.default_rng(3))
+
+    assert np.array_equal(np.random.get_state()[1], global_state)
+    assert np.array_equal(noisy, add_gaussian_noise(intensities, std_dev=0.1, rng=np.random.default_rng(3)))
+    assert np.array_equal(swapped, swap_two(intensities.copy(), np.random.default_rng(3)))
+
+
+CALLS = []
+
+
+def source_stage(value):
+    CALLS.append(("source", time.perf_counter(), time.perf_counter()))
+    return pd.DataFrame({"value": [value]})
+
+
+def slow_stage(source, name, seconds=0.3):
+    start = time.perf_counter()
+    time.sleep(seconds)
+    CALLS.append((name, start, time.perf_counter()))
+    return source.assign(value=source["value"] + 1)
+
+
+def sum_stage(left, right, factor=1):
+    CALLS.append(("sum", time.perf_counter(), time.perf_counter()))
+    return pd.DataFrame({"value": (left["value"] + right["value"]) * factor})
+
+
+def toy_pipeline(cache_dir, factor=1):
+    stages = [
+        Stage("source", source_stage, params={"value": 1}),
+        Stage("left", slow_stage, ["source"], {"name": "left"}),
+        Stage("right", slow_stage, ["source"], {"name": "right"}),
+        Stage("sum", sum_stage, ["left", "right"], {"factor": factor}),
+    ]
+    return Pipeline(stages, cache_dir, workers=2)
+
+
+def run_toy(cache_dir, factor=1, **run_params):
+    CALLS.clear()
+    outputs = toy_pipeline(cache_dir, factor).run(**run_params)
+    return outputs, {name: (start, stop) for name, start, stop in CALLS}
+
+
+def test_run_executes_and_caches_stages(tmp_path):
+    outputs, calls = run_toy(tmp_path)
+    assert calls.keys() == {"source", "left", "right", "sum"}
+    assert outputs["sum"]["value"].tolist() == [4]
+    # the independent stages left and right overlap in time
+    assert calls["left"][0] < calls["right"][1] and calls["right"][0] < calls["left"][1]
+    assert calls["sum"][0] >= max(calls["left"][1], calls["right"][1])
+
+    outputs, calls = run_toy(tmp_path)
+    assert calls == {}
+    assert outputs.keys() == {"source", "left", "right", "sum"}
+    assert outputs["sum"]["value"].tolist() == [4]
+
+    # a changed parameter of the last stage only reruns it
+    outputs, calls = run_toy(tmp_path, factor=3)
+    assert calls.keys() == {"sum"}
+    assert outputs["sum"]["value"].tolist() == [12]
+
+
+def test_run_loads_cached_targets(tmp_path):
+    run_toy(tmp_path)
+
+    outputs, calls = run_toy(tmp_path, targets=["left"])
+
+    assert calls == {}
+    assert outputs.keys() == {"left"}
+    assert outputs["left"]["value"].tolist() == [2]
+
+
+def test_forced_stages_rerun_their_dependents(tmp_path):
+    run_toy(tmp_path)
+
+    outputs, calls = run_toy(tmp_path, force=["left"])
+    assert calls.keys() == {"left", "sum"}
+    assert outputs["sum"]["value"].tolist() == [4]
+
+    outputs, calls = run_toy(tmp_path, targets=["right"], force=["source"])
+    assert calls.keys() == {"source", "right"}
@@ -0,0 +1,138 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pytest
+
+from pipeline.sharding import ShardedJob, plan
+
+
+def path_task(paths, seconds=0.0, fail_on=None):
+    time.sleep(seconds)
+    if fail_on is not None and fail_on in paths:
+        raise ValueError(f"failing on {fail_on}")
+    return pd.DataFrame({"path": paths, "pid": os.getpid()})
+
+
+def columns_task(n_rows, with_score):
+    output = pd.DataFrame({"pair": [f"pair_{n_rows}_{idx}" for idx in range(n_rows)]})
+    if with_score:
+        output["score"] = 0.5
+    return output
+
+
+def claim_all(job_dir, worker_id, start):
+    job = ShardedJob(job_dir)
+    time.sleep(max(0.0, start - time.time()))
+    # the second pass retries the shards other workers claimed during the first
+    return [shard for _ in range(2) for shard in job.shards if job.claim(shard, worker_id) is not None]
+
+
+def work(job_dir, worker_id, wait=True):
+    return ShardedJob(job_dir).work(worker_id, wait=wait, poll_seconds=0.05)
+
+
+def run_workers(function, n_workers, *args):
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(function, *args[:1], f"worker_{idx}", *args[1:]) for idx in range(n_workers)]
+        return [future.result() for future in futures]
+
+
+def path_shards(n_shards):
+    return [{"paths": [f"file_{idx}"]} for idx in range(n_shards)]
+
+
+def test_concurrent_claims_get_each_shard_once(tmp_path):
+    job = plan(tmp_path / "job", "pipeline.test_sharding:path_task", path_shards(40))
+
+    claimed = run_workers(claim_all, 16, job.job_dir, time.time() + 1.0)
+
+    all_claimed = sorted(shard for shards in claimed for shard in shards)
+    assert all_claimed == sorted(job.shards)
+    assert all(os.listdir(job.claims_dir / shard) == ["1"] for shard in job.shards)
+
+
+def test_workers_run_every_shard_once_and_merge_in_shard_order(tmp_path):
+    job = plan(tmp_path / "job", "pipeline.test_sharding:path_task", path_shards(12), params={"seconds": 0.05})
+
+    n_run = run_workers(work, 4, job.job_dir)
+
+    assert sum(n_run) == 12
+    assert job.status()["done"] == 12
+    assert all(os.listdir(job.claims_dir / shard) == ["1"] for shard in job.shards)
+
+    assert job.merge(tmp_path / "merged.parquet") == 12
+    merged = pd.read_parquet(tmp_path / "merged.parquet")
+    assert merged["path"].tolist() == [f"file_{idx}" for idx in range(12)]
+    assert merged["pid"].nunique() > 1
+
+    assert job.merge(tmp_path / "merged.tsv") == 12
+    assert pd.read_csv(tmp_path / "merged.tsv", sep="\t")["path"].tolist() == merged["path"].tolist()
+
+
+def test_stale_claim_is_reclaimed(tmp_path):
+    job = plan(tmp_path / "job", "pipeline.test_sharding:path_task", path_shards(3), lease_seconds=1.0)
+
+    # a worker crashed after claiming shard 000001, its heartbeat stopped two leases ago
+    crashed = job.claim("000001", "crashed")
+    os.utime(crashed, (time.time() - 2.0, time.time() - 2.0))
+    assert job.shard_state("000001") == "stale"
+
+    run_workers(work, 2, job.job_dir)
+
+    assert job.status()["done"] == 3
+    assert sorted(os.listdir(job.claims_dir / "000001")) == ["1", "2"]
+
+
+def test_heartbeat_keeps_running_shard_claimed(tmp_path):
+    job = plan(
+        tmp_path / "job", "pipeline.test_sharding:path_task", path_shards(2), params={"seconds": 3.0}, lease_seconds=1.5
+    )
+
+    run_workers(work, 3, job.job_dir)
+
+    assert job.status()["done"] == 2
+    assert all(os.listdir(job.claims_dir / shard) == ["1"] for shard in job.shards)
+
+
+def test_failing_shard_stops_after_max_attempts(tmp_path):
+    job = plan(
+        tmp_path / "job",
+        "pipeline.test_sharding:path_task",
+        path_shards(4),
+        params={"fail_on": "file_2"},
+        max_attempts=3,
+    )
+
+    run_workers(work, 3, job.job_dir)
+
+    assert job.status() == {"done": 3, "running": 0, "pending": 0, "stale": 0, "retry": 0, "failed": 1}
+    assert sorted(os.listdir(job.claims_dir / "000002")) == ["1", "1.error", "2", "2.error", "3", "3.error"]
+    assert "failing on file_2" in (job.claims_dir / "000002" / "3.error").read_text()
+    assert job.claim("000002", "late_worker") is None
+    with pytest.raises(RuntimeError):
+        job.merge(tmp_path / "merged.parquet")
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".tsv"])
+def test_merge_fills_missing_columns(tmp_path, suffix):
+    shards = [
+        {"n_rows": 2, "with_score": True},
+        {"n_rows": 0, "with_score": False},
+        {"n_rows": 3, "with_score": False},
+        {"n_rows": 1, "with_score": True},
+    ]
+    job = plan(tmp_path / "job", "pipeline.test_sharding:columns_task", shards)
+    job.work("worker", wait=False)
+
+    outfile = tmp_path / f"merged{suffix}"
+    assert job.merge(outfile) == 6
+
+    if suffix == ".parquet":
+        merged = pd.read_parquet(outfile)
+    else:
+        merged = pd.read_csv(outfile, sep="\t")
+    assert merged.columns.tolist() == ["pair", "score"]
+    assert merged["pair"].tolist() == ["pair_2_0", "pair_2_1", "pair_3_0", "pair_3_1", "pair_3_2", "pair_1_0"]
+    assert merged["score"].isna().tolist() == [False, False, True, True, True, False]
@@ -0,0 +1,455 @@
+"""
+I vs L rescoring of experimental PSMs.
+
+For every PSM with an I or L the sibling sequence with one I/L swapped is
+generated (seq_utils.peptide.switch_random_il), fragment intensities of both
+sequences are predicted (make_predictions.intensity_predictions) and compared
+to the fragments annotated in the experimental spectrum. I/L siblings are
+isobaric, so the experimental spectrum is annotated once and both predictions
+are aligned to it by their encoded ions (seq_utils.fragments). The PSMs are
+processed in chunks, and spectral angle and Pearson correlation are computed
+for a whole chunk at once; other metrics of metrics.metrics are computed per PSM.
+
+Run from the project root with:
+    python -m rescoring.il_rescoring msms.txt spectrum_store rescored.parquet
+"""
+
+import argparse
+import random
+import re
+from pathlib import Path
+from typing import Callable, ClassVar, Dict, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import metrics.metrics as M
+from metrics.evaluation import DISTANCE_METRICS
+from make_predictions.intensity_predictions import IntensityPredictor, PredictedSpectra
+from pipeline.instrumentation import timer
+from seq_utils.fragments import AnnotatedPeaks, annotate_spectra
+from seq_utils.peptide import get_proforma_bracketed, has_il_outside_brackets, switch_random_il
+from spectra.store import SpectrumStore
+
+
+MAXQUANT_MODIFICATION_PATTERN = r"\([^()]*\)|\([^()]*\([^()]*\)[^()]*\)"
+"""
+Modifications in MaxQuant's "Modified sequence", e.g. _(ac)AM(ox)K_.
+"""
+
+MAXQUANT_MODIFICATIONS = {
+    "(ox)": "UNIMOD:35",
+    "(ac)": "UNIMOD:1",
+    "(oxidation (m))": "UNIMOD:35",
+    "(acetyl (protein n-term))": "UNIMOD:1",
+}
+"""
+MaxQuant modifications (lower case) and their ProForma names.
+"""
+
+_BRACKETS = re.compile(r"\[[^\]]*\]-?")
+
+
+def _union_stats(keys_1, values_1, keys_2, values_2, n: int) -> Dict[str, np.ndarray]:
+    """
+    Per group sums over the union of two sparse vectors given as sorted keys
+    (group << 32 | ion code) and values, missing entries count as zero.
+    """
+    groups_1, groups_2 = keys_1 >> 32, keys_2 >> 32
+    positions = np.minimum(np.searchsorted(keys_1, keys_2), max(len(keys_1) - 1, 0))
+    matched = (keys_1[positions] == keys_2) if len(keys_1) else np.zeros(len(keys_2), dtype=bool)
+
+    return {
+        "n": (
+            np.bincount(groups_1, minlength=n)
+            + np.bincount(groups_2, minlength=n)
+            - np.bincount(groups_2[matched], minlength=n)
+        ),
+        "x": np.bincount(groups_1, weights=values_1, minlength=n),
+        "y": np.bincount(groups_2, weights=values_2, minlength=n),
+        "xx": np.bincount(groups_1, weights=values_1 ** 2, minlength=n),
+        "yy": np.bincount(groups_2, weights=values_2 ** 2, minlength=n),
+        "xy": np.bincount(groups_2[matched], weights=values_1[positions[matched]] * values_2[matched], minlength=n),
+    }
+
+
+def _spectral_angle(stats: Dict[str, np.ndarray]) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return stats["xy"] / np.sqrt(stats["xx"] * stats["yy"])
+
+
+def _pearson_correlation(stats: Dict[str, np.ndarray]) -> np.ndarray:
+    n = stats["n"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (n * stats["xy"] - stats["x"] * stats["y"]) / np.sqrt(
+            (n * stats["xx"] - stats["x"] ** 2) * (n * stats["yy"] - stats["y"] ** 2)
+        )
+
+
+class ILRescorer:
+    """
+    Decide between I and L for PSMs by comparing their experimental spectra
+    with the predicted spectra of the identified sequence and its I/L sibling.
+    """
+
+    VECTORIZED_METRICS: ClassVar[Dict[str, Callable]] = {
+        "spectral_angle": _spectral_angle,
+        "dot_product": _spectral_angle,
+        "pearson_correlation": _pearson_correlation,
+    }
+    """
+    Metrics computed for a chunk of PSMs at once, same definitions as in metrics.metrics.
+    """
+
+    LOWER_IS_BETTER: ClassVar[Set[str]] = DISTANCE_METRICS
+    """
+    Distance metrics, for all others a higher score is better.
+    """
+
+    def __init__(
+        self,
+        store: SpectrumStore,
+        predictor: IntensityPredictor,
+        metrics: Optional[List[str]] = None,
+        tolerance: float = 20.0,
+        unit: str = "ppm",
+        chunk_size: int = 50000,
+        seed: int = 42,
+    ):
+        """
+        Parameters
+        ----------
+        store : SpectrumStore
+            Experimental spectra.
+        predictor : IntensityPredictor
+            Intensity predictions of both siblings.
+        metrics : Optional[List[str]]
+            Metrics of metrics.metrics to score with, the first one decides
+            between the siblings. Defaults to spectral_angle and pearson_correlation.
+        tolerance, unit
+            Fragment tolerance of the spectrum annotation.
+        chunk_size : int
+            Number of PSMs scored at once.
+        seed : int
+            Seed of the generator choosing the swapped I/L, one generator
+            draws for all chunks.
+        """
+        self.store = store
+        self.predictor = predictor
+        self.metrics = metrics or ["spectral_angle", "pearson_correlation"]
+        for metric in self.metrics:
+            if metric not in self.VECTORIZED_METRICS and not callable(getattr(M, metric, None)):
+                raise ValueError(f"Unknown metric: {metric}")
+        self.tolerance = tolerance
+        self.unit = unit
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    @staticmethod
+    def read_psms(psm_file: Path) -> pd.DataFrame:
+        """
+        Read a MaxQuant msms.txt/evidence.txt or a ProForma PSM table with the
+        columns peptide, raw_file, scan_number and charge.
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns peptide (ProForma), raw_file, scan_number and charge.
+        """
+        psms_df = pd.read_csv(psm_file, sep="\t")
+        if "Modified sequence" not in psms_df.columns:
+            return psms_df[["peptide", "raw_file", "scan_number", "charge"]]
+
+        scan_column = "Scan number" if "Scan number" in psms_df.columns else "MS/MS scan number"
+        psms_df = psms_df[psms_df[scan_column].notna()]
+        # convert every distinct modified sequence once
+        modified_sequences = psms_df["Modified sequence"].unique()
+        proforma = dict(
+            zip(
+                modified_sequences,
+                (
+                    get_proforma_bracketed(
+                        sequence,
+                        before_aa=False,
+                        pattern=MAXQUANT_MODIFICATION_PATTERN,
+                        modification_dict=MAXQUANT_MODIFICATIONS,
+                    )
+                    for sequence in modified_sequences
+                ),
+            )
+        )
+        return pd.DataFrame(
+            {
+                "peptide": psms_df["Modified sequence"].map(proforma).to_numpy(),
+                "raw_file": psms_df["Raw file"].to_numpy(),
+                "scan_number": psms_df[scan_column].to_numpy(dtype=np.int64),
+                "charge": psms_df["Charge"].to_numpy(dtype=np.int64),
+            }
+        )
+
+    def siblings(self, peptides: np.ndarray) -> pd.DataFrame:
+        """
+        Sibling of each peptide with one I/L outside of modifications swapped,
+        the swapped residue's (1-based) position and the residue in the peptide.
+        """
+        siblings = np.array([switch_random_il(peptide, self.rng) for peptide in peptides], dtype=object)
+        positions = np.zeros(len(peptides), dtype=np.int64)
+        residues = np.empty(len(peptides), dtype=object)
+        for idx, (peptide, sibling) in enumerate(zip(peptides, siblings)):
+            pos = next(i for i, (a, b) in enumerate(zip(peptide, sibling)) if a != b)
+            positions[idx] = len(_BRACKETS.sub("", peptide[:pos])) + 1
+            residues[idx] = peptide[pos]
+        return pd.DataFrame({"sibling": siblings, "swap_position": positions, "residue": residues})
+
+    def score(self, annotated: AnnotatedPeaks, predicted: PredictedSpectra, n: int) -> Dict[str, np.ndarray]:
+        """
+        Score n PSMs against one predicted spectrum each.
+        """
+        observed_keys = (annotated.spectrum_index.astype(np.int64) << 32) | annotated.codes
+        order = np.argsort(observed_keys)
+        observed_keys = observed_keys[order]
+        observed_intensity = annotated.intensity[order].astype(np.float64)
+        observed_mz = annotated.mz[order]
+
+        predicted_psms = np.repeat(np.arange(n, dtype=np.int64), np.diff(predicted.offsets))
+        predicted_keys = (predicted_psms << 32) | predicted.codes
+        order = np.argsort(predicted_keys)
+        predicted_keys = predicted_keys[order]
+        predicted_intensity = predicted.intensity[order].astype(np.float64)
+        predicted_mz = predicted.mz[order]
+
+        with timer("alignment", items=n):
+            stats = _union_stats(observed_keys, observed_intensity, predicted_keys, predicted_intensity, n)
+        scores = {}
+        for metric in self.metrics:
+            if metric in self.VECTORIZED_METRICS:
+                with timer(f"metric.{metric}", items=n):
+                    scores[metric] = self.VECTORIZED_METRICS[metric](stats)
+
+        other_metrics = [metric for metric in self.metrics if metric not in self.VECTORIZED_METRICS]
+        if other_metrics:
+            # dense vectors over the union of observed and predicted ions of each PSM
+            union_keys, inverse = np.unique(np.concatenate((observed_keys, predicted_keys)), return_inverse=True)
+            observed_vector = np.zeros(len(union_keys))
+            predicted_vector = np.zeros(len(union_keys))
+            observed_vector[inverse[:len(observed_keys)]] = observed_intensity
+            predicted_vector[inverse[len(observed_keys):]] = predicted_intensity
+            mz = np.zeros(len(union_keys))
+            mz[inverse[len(observed_keys):]] = predicted_mz
+            mz[inverse[:len(observed_keys)]] = observed_mz
+            bounds = np.searchsorted(union_keys >> 32, np.arange(n + 1))
+
+            for metric in other_metrics:
+                metric_function = getattr(M, metric)
+                values = np.full(n, np.nan)
+                with timer(f"metric.{metric}", items=n):
+                    for idx in range(n):
+                        start, stop = bounds[idx], bounds[idx + 1]
+                        observed = observed_vector[start:stop]
+                        if stop == start or observed.max() <= 0:
+                            continue
+                        try:
+                            values[idx] = metric_function(
+                                intensity1=observed / observed.max(),
+                                intensity2=predicted_vector[start:stop],
+                                mz1=mz[start:stop],
+                                mz2=mz[start:stop],
+                            )
+                        except ValueError:
+                            continue
+                scores[metric] = values
+
+        return scores
+
+    def rescore_chunk(self, psms_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Rescore a chunk of PSMs, see rescore.
+        """
+        n = len(psms_df)
+        peptides = psms_df["peptide"].to_numpy()
+        charges = psms_df["charge"].to_numpy(dtype=np.int64)
+        siblings_df = self.siblings(peptides)
+
+        rows = self.store.rows(psms_df["raw_file"], psms_df["scan_number"])
+        found = rows >= 0
+        spectra = [self.store.spectrum(row) if row >= 0 else ((), ()) for row in rows]
+        with timer("annotation", items=n):
+            annotated = annotate_spectra(
+                peptides,
+                charges,
+                [mz for mz, _ in spectra],
+                [intensity for _, intensity in spectra],
+                tolerance=self.tolerance,
+                unit=self.unit,
+            )
+
+        predicted = self.predictor.predict(
+            np.concatenate((peptides, siblings_df["sibling"].to_numpy())), np.concatenate((charges, charges))
+        )
+        halves = [
+            PredictedSpectra(
+                predicted.codes[predicted.offsets[start]:predicted.offsets[start + n]],
+                predicted.mz[predicted.offsets[start]:predicted.offsets[start + n]],
+                predicted.intensity[predicted.offsets[start]:predicted.offsets[start + n]],
+                predicted.offsets[start:start + n + 1] - predicted.offsets[start],
+            )
+            for start in (0, n)
+        ]
+        peptide_scores = self.score(annotated, halves[0], n)
+        sibling_scores = self.score(annotated, halves[1], n)
+
+        result_df = pd.DataFrame(
+            {
+                "raw_file": psms_df["raw_file"].to_numpy(),
+                "scan_number": psms_df["scan_number"].to_numpy(),
+                "charge": charges,
+                "peptide": peptides,
+                "sibling": siblings_df["sibling"].to_numpy(),
+                "swap_position": siblings_df["swap_position"].to_numpy(),
+                "n_annotated": np.bincount(annotated.spectrum_index.astype(np.int64), minlength=n),
+            }
+        )
+        for metric in self.metrics:
+            result_df[metric] = peptide_scores[metric]
+            result_df[f"{metric}_sibling"] = sibling_scores[metric]
+
+        decisive = self.metrics[0]
+        difference = peptide_scores[decisive] - sibling_scores[decisive]
+        if decisive in self.LOWER_IS_BETTER:
+            difference = -difference
+        prefer_peptide = difference >= 0
+        decided = found & ~np.isnan(difference)
+
+        residue = siblings_df["residue"].to_numpy()
+        swapped_residue = np.where(residue == "I", "L", "I")
+        result_df["preferred_sequence"] = np.where(
+            decided, np.where(prefer_peptide, peptides, siblings_df["sibling"].to_numpy()), None
+        )
+        result_df["preferred_residue"] = np.where(decided, np.where(prefer_peptide, residue, swapped_residue), None)
+        result_df["margin"] = np.where(decided, np.abs(difference), np.nan)
+        return result_df
+
+    def rescore(self, psms_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Rescore all PSMs with an I or L outside of modifications.
+
+        Returns
+        -------
+        pd.DataFrame
+            Per PSM the sibling, swapped position, number of annotated peaks,
+            the scores of both sequences (metric and metric_sibling), the
+            preferred sequence and residue at the swapped position and the
+            margin of the decisive metric in favour of the preferred sequence.
+            PSMs without spectrum or scores have no preferred sequence.
+        """
+        has_il = np.fromiter(
+            (has_il_outside_brackets(peptide) for peptide in psms_df["peptide"]), dtype=bool, count=len(psms_df)
+        )
+        psms_df = psms_df[has_il].reset_index(drop=True)
+
+        results = [
+            self.rescore_chunk(psms_df.iloc[start:start + self.chunk_size])
+            for start in tqdm(range(0, len(psms_df), self.chunk_size), desc="Rescoring PSMs", unit="chunk")
+        ]
+        return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def get_cli():
+    """
+    Command line interface for ILRescorer
+    """
+    parser = argparse.ArgumentParser(
+        description="Decide between I and L per PSM by rescoring against the predictions of both siblings."
+    )
+    parser.add_argument(
+        "psm_file",
+        type=Path,
+        help="MaxQuant msms.txt/evidence.txt or tab-separated table with peptide (ProForma), "
+             "raw_file, scan_number and charge columns."
+    )
+    parser.add_argument(
+        "store_dir",
+        type=Path,
+        help="Spectrum store of the experimental spectra (python -m spectra.store)."
+    )
+    parser.add_argument(
+        "outfile",
+        type=Path,
+        help="Output file. (.parquet == Parquet format, other: tab-separated values)"
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        default=["spectral_angle", "pearson_correlation"],
+        help="Metrics of metrics.metrics, the first one decides between the siblings."
+    )
+    parser.add_argument(
+        "--model",
+        default="Prosit_2024_intensity_PTMs_gl",
+        help="Koina intensity model."
+    )
+    parser.add_argument(
+        "--collision-energy",
+        type=float,
+        default=28,
+        help="Collision energy passed to the model."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=None,
+        help="Directory caching predictions between runs."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=20.0,
+        help="Fragment tolerance in ppm."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=50000,
+        help="Number of PSMs scored at once."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent prediction requests."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Seed of the random choice of the swapped I/L."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    if not SpectrumStore.is_store(args.store_dir):
+        raise SystemExit(f"{args.store_dir} is not a spectrum store, convert the spectra with spectra.store first")
+
+    rescorer = ILRescorer(
+        SpectrumStore(args.store_dir),
+        IntensityPredictor(
+            model=args.model,
+            collision_energy=args.collision_energy,
+            cache_dir=args.cache_dir,
+            workers=args.workers,
+        ),
+        metrics=args.metrics,
+        tolerance=args.tolerance,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+    rescored_df = rescorer.rescore(rescorer.read_psms(args.psm_file))
+    if args.outfile.suffix == ".parquet":
+        rescored_df.to_parquet(args.outfile, index=False)
+    else:
+        rescored_df.to_csv(args.outfile, index=False, sep="\t")
+    print(f"Rescored {len(rescored_df)} PSMs, {rescored_df['preferred_sequence'].notna().sum()} decided")
@@ -0,0 +1,159 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("koinapy")
+
+import metrics.metrics as M  # noqa: E402
+from make_predictions.intensity_predictions import PredictedSpectra  # noqa: E402
+from rescoring.il_rescoring import ILRescorer  # noqa: E402
+from seq_utils.fragments import annotate_spectra, fragment_ions  # noqa: E402
+from spectra.store import convert_spectra  # noqa: E402
+
+
+PEPTIDES = np.array([f"LIL{'A' * (idx % 5)}ILK" for idx in range(300)], dtype=object)
+
+
+def siblings_in_chunks(seed, chunk_size):
+    rescorer = ILRescorer(store=None, predictor=None, seed=seed)
+    return np.concatenate(
+        [rescorer.siblings(PEPTIDES[start:start + chunk_size])["sibling"] for start in range(0, len(PEPTIDES), chunk_size)]
+    )
+
+
+def test_siblings_draw_from_one_generator_across_chunks():
+    random.seed(0)
+    global_state = random.getstate()
+
+    siblings = siblings_in_chunks(seed=42, chunk_size=100)
+
+    assert random.getstate() == global_state
+    # the chunks continue the same random sequence instead of restarting it
+    assert np.array_equal(siblings, siblings_in_chunks(seed=42, chunk_size=300))
+    assert not np.array_equal(siblings[:100], siblings[100:200])
+    assert not np.array_equal(siblings, siblings_in_chunks(seed=43, chunk_size=100))
+
+
+def test_siblings_swap_one_il():
+    siblings_df = ILRescorer(store=None, predictor=None).siblings(np.array(["PEPTLDEK", "M[Oxidation]ILK"], dtype=object))
+
+    assert siblings_df["sibling"].tolist() == ["PEPTIDEK", "M[Oxidation]IIK"]
+    assert siblings_df["swap_position"].tolist() == [5, 3]
+    assert siblings_df["residue"].tolist() == ["L", "L"]
+
+
+class FakePredictor:
+    """
+    Predicts fixed b/y intensities per sequence.
+    """
+
+    def __init__(self, intensities):
+        self.intensities = intensities
+
+    def predict(self, peptides, charges):
+        spectra = [self.spectrum(peptide) for peptide in peptides]
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum([len(codes) for codes, _, _ in spectra], out=offsets[1:])
+        return PredictedSpectra(
+            np.concatenate([codes for codes, _, _ in spectra]),
+            np.concatenate([mz for _, mz, _ in spectra]),
+            np.concatenate([intensity for _, _, intensity in spectra]).astype(np.float32),
+            offsets,
+        )
+
+    def spectrum(self, peptide):
+        ions = fragment_ions([peptide], [1])
+        return ions.codes, ions.mz, self.intensities(peptide, ions.codes)
+
+
+def fake_intensities(peptide, codes):
+    rng = np.random.default_rng(sum(map(ord, peptide)) * 1000 + len(peptide))
+    # few dominant fragments, as in real spectra
+    return rng.uniform(0.0, 1.0, len(codes)) ** 4 + 0.01
+
+
+def write_mgf(path, spectra):
+    with open(path, "w") as f:
+        for scan_number, (mz, intensity) in spectra.items():
+            f.write(f"BEGIN IONS\nTITLE=scan {scan_number}\nSCANS={scan_number}\nPEPMASS=500.0\nCHARGE=2+\n")
+            f.write(f"RTINSECONDS={60.0 * scan_number}\n")
+            for mz_value, intensity_value in sorted(zip(mz, intensity)):
+                f.write(f"{mz_value:.6f} {intensity_value:.4f}\n")
+            f.write("END IONS\n")
+
+
+def observed_spectrum(predictor, sequence, noise_rng):
+    # the predicted spectrum of a sequence without its weakest peak, plus noise peaks
+    _, mz, intensity = predictor.spectrum(sequence)
+    kept = intensity > intensity.min()
+    return (
+        np.concatenate((mz[kept], noise_rng.uniform(150, 900, 10))),
+        np.concatenate((1000 * intensity[kept], noise_rng.uniform(1, 30, 10))),
+    )
+
+
+@pytest.fixture
+def rescorer(tmp_path):
+    predictor = FakePredictor(fake_intensities)
+    noise_rng = np.random.default_rng(0)
+    write_mgf(
+        tmp_path / "run.mgf",
+        {
+            1: observed_spectrum(predictor, "PEPTIDEK", noise_rng),
+            2: observed_spectrum(predictor, "AGLESVDK", noise_rng),
+            3: observed_spectrum(predictor, "SAMPLER", noise_rng),
+        },
+    )
+    store = convert_spectra([tmp_path / "run.mgf"], tmp_path / "store", workers=1)
+    return ILRescorer(store, predictor, metrics=["spectral_angle", "pearson_correlation", "mara_similarity"])
+
+
+def test_rescore_chunk_matches_metrics_on_aligned_peaks(rescorer):
+    psms_df = pd.DataFrame(
+        {
+            # the spectrum of scan 2 is the one of the sibling AGLESVDK, of scan 4 there is none
+            "peptide": ["PEPTIDEK", "AGIESVDK", "SAMPLER", "PEPTIDEK"],
+            "raw_file": ["run"] * 4,
+            "scan_number": [1, 2, 3, 4],
+            "charge": [2, 2, 2, 2],
+        }
+    )
+
+    result_df = rescorer.rescore_chunk(psms_df)
+
+    assert result_df["sibling"].tolist() == ["PEPTLDEK", "AGLESVDK", "SAMPIER", "PEPTLDEK"]
+    assert result_df["preferred_sequence"].iloc[:3].tolist() == ["PEPTIDEK", "AGLESVDK", "SAMPLER"]
+    assert result_df["preferred_residue"].iloc[:3].tolist() == ["I", "L", "L"]
+    assert result_df.iloc[3][["preferred_sequence", "preferred_residue", "margin"]].isna().all()
+
+    spectra = [rescorer.store.get("run", scan) or ((), ()) for scan in psms_df["scan_number"]]
+    annotated = annotate_spectra(
+        psms_df["peptide"].to_numpy(), [2] * 4, [mz for mz, _ in spectra], [intensity for _, intensity in spectra]
+    )
+    assert result_df["n_annotated"].tolist() == np.bincount(annotated.spectrum_index, minlength=4).tolist()
+
+    for idx, row in result_df.iloc[:3].iterrows():
+        selected = annotated.spectrum_index == idx
+        observed = dict(zip(annotated.codes[selected], annotated.intensity[selected]))
+        for column, sequence in (("", row["peptide"]), ("_sibling", row["sibling"])):
+            codes, mz, intensity = rescorer.predictor.spectrum(sequence)
+            predicted = dict(zip(codes, intensity.astype(np.float32).astype(np.float64)))
+            union = sorted(observed.keys() | predicted.keys())
+            observed_vector = np.array([observed.get(code, 0.0) for code in union])
+            predicted_vector = np.array([predicted.get(code, 0.0) for code in union])
+            for metric in rescorer.metrics:
+                expected = getattr(M, metric)(
+                    intensity1=observed_vector / observed_vector.max(), intensity2=predicted_vector
+                )
+                assert row[metric + column] == pytest.approx(expected, rel=1e-9), (idx, metric + column)
+
+        # the spectrum was made from the preferred sequence's prediction
+        preferred_column = "" if row["preferred_sequence"] == row["peptide"] else "_sibling"
+        other_column = "_sibling" if preferred_column == "" else ""
+        assert row["spectral_angle" + preferred_column] > 0.9
+        assert row["margin"] == pytest.approx(
+            row["spectral_angle" + preferred_column] - row["spectral_angle" + other_column]
+        )
+        assert row["margin"] > 0.2
@@ -0,0 +1,366 @@
+"""
+Theoretical fragment ions for batches of ProForma peptides and annotation of
+experimental spectra by tolerance matching.
+
+Ions are encoded as integers (see encode_ions) so that annotated peaks and
+predicted spectra can be joined without parsing annotation strings.
+"""
+
+import re
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from seq_utils.mass import PROTON, WATER, residue_masses
+
+
+ION_TYPES: Tuple[str, ...] = ("b", "y", "a", "w")
+"""
+Supported ion types, their position is used as the ion type code.
+"""
+
+CO = 27.994915
+Z_DOT_FROM_Y = 16.018724
+"""
+Mass difference between a y ion and the corresponding z+1 (z-dot) ion.
+"""
+
+W_ION_SIDE_CHAIN_LOSS = {
+    "I": 29.039125,
+    "L": 43.054775,
+}
+"""
+Partial side chain losses from z-dot ions that form w ions. Only the
+residues which discriminate I from L are considered.
+"""
+
+_ANNOTATION = re.compile(r"^([a-z])(\d+)\+(\d+)$")
+
+
+def encode_ions(ion_type, ion_number, charge) -> np.ndarray:
+    """
+    Encode ion type code, ion number and charge into one integer per ion.
+    """
+    return (
+        (np.asarray(ion_type, dtype=np.int64) << 16)
+        | (np.asarray(ion_number, dtype=np.int64) << 8)
+        | np.asarray(charge, dtype=np.int64)
+    )
+
+
+def decode_ions(codes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Inverse of encode_ions.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    return codes >> 16, (codes >> 8) & 0xFF, codes & 0xFF
+
+
+def parse_annotations(annotations: Iterable[str]) -> np.ndarray:
+    """
+    Encode prediction annotations like "y3+1" (as returned by Koina, also as
+    bytes). Each distinct annotation is parsed once; unknown annotations get code -1.
+    """
+    inverse, unique = pd.factorize(np.asarray(annotations, dtype=object))
+
+    unique_codes = np.full(len(unique), -1, dtype=np.int64)
+    for idx, annotation in enumerate(unique):
+        if isinstance(annotation, bytes):
+            annotation = annotation.decode("utf-8")
+        match = _ANNOTATION.match(annotation)
+        if match is None or match.group(1) not in ION_TYPES:
+            continue
+        unique_codes[idx] = encode_ions(
+            ION_TYPES.index(match.group(1)), int(match.group(2)), int(match.group(3))
+        )
+
+    # missing annotations are factorized to -1
+    return np.where(inverse >= 0, unique_codes[inverse], -1)
+
+
+def ion_labels(codes) -> List[str]:
+    """
+    Annotation strings (e.g. "y3+1") of encoded ions.
+    """
+    ion_type, ion_number, charge = decode_ions(codes)
+    return [f"{ION_TYPES[t]}{n}+{z}" for t, n, z in zip(ion_type, ion_number, charge)]
+
+
+class FragmentIons(NamedTuple):
+    """
+    Theoretical fragment ions of a batch of peptides, one entry per ion.
+    """
+
+    peptide_index: np.ndarray
+    ion_type: np.ndarray
+    ion_number: np.ndarray
+    charge: np.ndarray
+    mz: np.ndarray
+
+    @property
+    def codes(self) -> np.ndarray:
+        return encode_ions(self.ion_type, self.ion_number, self.charge)
+
+
+class AnnotatedPeaks(NamedTuple):
+    """
+    Experimental peaks matched to theoretical fragment ions, one entry per match.
+    """
+
+    spectrum_index: np.ndarray
+    ion_type: np.ndarray
+    ion_number: np.ndarray
+    charge: np.ndarray
+    mz: np.ndarray
+    theoretical_mz: np.ndarray
+    intensity: np.ndarray
+
+    @property
+    def codes(self) -> np.ndarray:
+        return encode_ions(self.ion_type, self.ion_number, self.charge)
+
+
+def _residue_matrix(peptides: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Residue masses of all peptides padded with zeros into one matrix.
+    """
+    masses = [residue_masses(p) for p in peptides]
+    lengths = np.fromiter((len(m) for m in masses), dtype=np.int64, count=len(masses))
+
+    matrix = np.zeros((len(masses), lengths.max(initial=0)), dtype=np.float64)
+    if len(masses):
+        matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = np.concatenate(masses)
+    return matrix, lengths
+
+
+def _stripped_residues(peptides: Sequence[str], width: int) -> np.ndarray:
+    """
+    Unmodified one-letter residues of all peptides padded into one matrix.
+    """
+    residues = np.full((len(peptides), width), "", dtype="<U1")
+    for idx, peptide in enumerate(peptides):
+        stripped = re.sub(r"\[[^\]]*\]-?|-\[[^\]]*\]|/\d+$", "", peptide)
+        residues[idx, : len(stripped)] = list(stripped)
+    return residues
+
+
+def fragment_ions(
+    peptides: Sequence[str],
+    max_charges: Optional[Sequence[int]] = None,
+    ion_types: Iterable[str] = ("b", "y"),
+    max_fragment_charge: int = 3,
+) -> FragmentIons:
+    """
+    Compute the fragment m/z of a batch of peptides.
+
+    Parameters
+    ----------
+    peptides : Sequence[str]
+        ProForma sequences.
+    max_charges : Sequence[int], optional
+        Precursor charge of each peptide, fragments are computed up to
+        min(precursor charge, max_fragment_charge). Defaults to max_fragment_charge.
+    ion_types : Iterable[str]
+        Subset of ION_TYPES.
+    max_fragment_charge : int
+        Highest fragment charge.
+
+    Returns
+    -------
+    FragmentIons
+        Fragments ordered by peptide.
+    """
+    ion_types = list(ion_types)
+    for ion_type in ion_types:
+        if ion_type not in ION_TYPES:
+            raise ValueError(f"Unknown ion type: {ion_type}")
+
+    matrix, lengths = _residue_matrix(peptides)
+    n_peptides, width = matrix.shape
+    if width < 2:
+        empty = np.array([], dtype=np.int64)
+        return FragmentIons(empty, empty, empty, empty, np.array([], dtype=np.float64))
+
+    if max_charges is None:
+        max_charges = np.full(n_peptides, max_fragment_charge)
+    max_charges = np.minimum(np.asarray(max_charges, dtype=np.int64), max_fragment_charge)
+
+    prefix = np.cumsum(matrix, axis=1)
+    total = prefix[:, -1:]
+    # column j holds the ions with number j + 1, i.e. covering j + 1 residues
+    numbers = np.arange(1, width)
+    valid = numbers[None, :] < lengths[:, None]
+
+    neutral = {}
+    if "b" in ion_types or "a" in ion_types:
+        b_neutral = prefix[:, :-1]
+        if "b" in ion_types:
+            neutral["b"] = b_neutral
+        if "a" in ion_types:
+            neutral["a"] = b_neutral - CO
+    if "y" in ion_types or "w" in ion_types:
+        # y_n covers the last n residues, i.e. everything after residue length - n - 1
+        cleavage = np.clip(lengths[:, None] - 1 - numbers[None, :], 0, width - 1)
+        y_neutral = total - np.take_along_axis(prefix, cleavage, axis=1) + WATER
+        if "y" in ion_types:
+            neutral["y"] = y_neutral
+        if "w" in ion_types:
+            residues = _stripped_residues(peptides, width)
+            # the residue at the N-terminus of y_n is residue length - n
+            cleaved = np.take_along_axis(
+                residues, np.clip(lengths[:, None] - numbers[None, :], 0, width - 1), axis=1
+            )
+            loss = np.zeros_like(y_neutral)
+            for aa, aa_loss in W_ION_SIDE_CHAIN_LOSS.items():
+                loss[cleaved == aa] = aa_loss
+            neutral["w"] = np.where(loss > 0, y_neutral - Z_DOT_FROM_Y - loss, np.nan)
+
+    peptide_index = []
+    ion_type_codes = []
+    ion_numbers = []
+    charges = []
+    mzs = []
+
+    for charge in range(1, max_fragment_charge + 1):
+        charge_valid = valid & (max_charges[:, None] >= charge)
+        for ion_type in ion_types:
+            mask = charge_valid & ~np.isnan(neutral[ion_type])
+            rows, cols = np.nonzero(mask)
+            peptide_index.append(rows)
+            ion_type_codes.append(np.full(len(rows), ION_TYPES.index(ion_type), dtype=np.int8))
+            ion_numbers.append(numbers[cols].astype(np.int16))
+            charges.append(np.full(len(rows), charge, dtype=np.int8))
+            mzs.append((neutral[ion_type][rows, cols] + charge * PROTON) / charge)
+
+    peptide_index = np.concatenate(peptide_index)
+    order = np.argsort(peptide_index, kind="stable")
+
+    return FragmentIons(
+        peptide_index=peptide_index[order],
+        ion_type=np.concatenate(ion_type_codes)[order],
+        ion_number=np.concatenate(ion_numbers)[order],
+        charge=np.concatenate(charges)[order],
+        mz=np.concatenate(mzs)[order],
+    )
+
+
+def annotate_spectra(
+    peptides: Sequence[str],
+    precursor_charges: Sequence[int],
+    mz_arrays: Sequence[np.ndarray],
+    intensity_arrays: Sequence[np.ndarray],
+    tolerance: float = 20.0,
+    unit: str = "ppm",
+    ion_types: Iterable[str] = ("b", "y"),
+    max_fragment_charge: int = 3,
+    batch_size: int = 10_000,
+) -> AnnotatedPeaks:
+    """
+    Annotate experimental spectra with the fragment ions of their peptides.
+
+    Every theoretical ion is matched to the most intense experimental peak
+    within the tolerance, so each ion appears at most once per spectrum.
+
+    Parameters
+    ----------
+    peptides : Sequence[str]
+        ProForma sequence of each spectrum.
+    precursor_charges : Sequence[int]
+        Precursor charge of each spectrum.
+    mz_arrays, intensity_arrays : Sequence[np.ndarray]
+        Peaks of each spectrum.
+    tolerance : float
+        Fragment mass tolerance.
+    unit : str
+        "ppm" or "Da".
+    batch_size : int
+        Number of spectra matched at once.
+
+    Returns
+    -------
+    AnnotatedPeaks
+        The matched peaks, spectrum_index refers to the position in the input.
+    """
+    if unit not in ("ppm", "Da"):
+        raise ValueError(f"Unknown tolerance unit: {unit}")
+
+    results = []
+    for start in range(0, len(peptides), batch_size):
+        stop = min(start + batch_size, len(peptides))
+        results.append(
+            _annotate_batch(
+                peptides[start:stop],
+                precursor_charges[start:stop],
+                mz_arrays[start:stop],
+                intensity_arrays[start:stop],
+                tolerance,
+                unit,
+                ion_types,
+                max_fragment_charge,
+                start,
+            )
+        )
+
+    if not results:
+        empty = np.array([])
+        return AnnotatedPeaks(*(empty for _ in AnnotatedPeaks._fields))
+
+    return AnnotatedPeaks(*(np.concatenate(field) for field in zip(*results)))
+
+
+def _annotate_batch(
+    peptides,
+    precursor_charges,
+    mz_arrays,
+    intensity_arrays,
+    tolerance,
+    unit,
+    ion_types,
+    max_fragment_charge,
+    index_offset,
+) -> AnnotatedPeaks:
+    ions = fragment_ions(peptides, precursor_charges, ion_types, max_fragment_charge)
+
+    peak_counts = np.fromiter((len(m) for m in mz_arrays), dtype=np.int64, count=len(mz_arrays))
+    peak_spectrum = np.repeat(np.arange(len(mz_arrays)), peak_counts)
+    peak_mz = np.concatenate([np.asarray(m, dtype=np.float64) for m in mz_arrays]) if len(mz_arrays) else np.array([])
+    peak_intensity = np.concatenate([np.asarray(i, dtype=np.float64) for i in intensity_arrays]) if len(mz_arrays) else np.array([])
+
+    # shift every spectrum into its own m/z range so that one sorted search covers the batch
+    span = np.ceil(max(peak_mz.max(initial=0.0), ions.mz.max(initial=0.0))) * 2 + 1
+    peak_key = peak_mz + peak_spectrum * span
+    peak_order = np.argsort(peak_key, kind="stable")
+    peak_key = peak_key[peak_order]
+
+    ion_key = ions.mz + ions.peptide_index * span
+    if unit == "ppm":
+        delta = ions.mz * tolerance * 1e-6
+    else:
+        delta = np.full(len(ions.mz), tolerance)
+    lower = np.searchsorted(peak_key, ion_key - delta, side="left")
+    upper = np.searchsorted(peak_key, ion_key + delta, side="right")
+
+    n_matches = upper - lower
+    ion_idx = np.repeat(np.arange(len(ion_key)), n_matches)
+    match_offsets = np.cumsum(n_matches) - n_matches
+    peak_idx = peak_order[lower[ion_idx] + np.arange(n_matches.sum()) - np.repeat(match_offsets, n_matches)]
+
+    # keep the most intense peak per ion
+    order = np.lexsort((-peak_intensity[peak_idx], ion_idx))
+    ion_idx = ion_idx[order]
+    peak_idx = peak_idx[order]
+    first = np.ones(len(ion_idx), dtype=bool)
+    first[1:] = ion_idx[1:] != ion_idx[:-1]
+    ion_idx = ion_idx[first]
+    peak_idx = peak_idx[first]
+
+    return AnnotatedPeaks(
+        spectrum_index=ions.peptide_index[ion_idx] + index_offset,
+        ion_type=ions.ion_type[ion_idx],
+        ion_number=ions.ion_number[ion_idx],
+        charge=ions.charge[ion_idx],
+        mz=peak_mz[peak_idx],
+        theoretical_mz=ions.mz[ion_idx],
+        intensity=peak_intensity[peak_idx],
+    )
@@ -0,0 +1,175 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+PROTON = 1.007276
+WATER = 18.010565
+
+RESIDUE_MASSES: Dict[str, float] = {
+    "G": 57.021464,
+    "A": 71.037114,
+    "S": 87.032028,
+    "P": 97.052764,
+    "V": 99.068414,
+    "T": 101.047679,
+    "C": 103.009185,
+    "L": 113.084064,
+    "I": 113.084064,
+    "N": 114.042927,
+    "D": 115.026943,
+    "Q": 128.058578,
+    "K": 128.094963,
+    "E": 129.042593,
+    "M": 131.040485,
+    "H": 137.058912,
+    "F": 147.068414,
+    "U": 150.953636,
+    "R": 156.101111,
+    "Y": 163.063329,
+    "W": 186.079313,
+    "O": 237.147727,
+}
+"""
+Monoisotopic residue masses.
+"""
+
+MODIFICATION_MASSES: Dict[str, float] = {
+    "Carbamidomethyl": 57.021464,
+    "Oxidation": 15.994915,
+    "Acetyl": 42.010565,
+    "Phospho": 79.966331,
+    "Deamidated": 0.984016,
+    "Gln->pyro-Glu": -17.026549,
+    "Glu->pyro-Glu": -18.010565,
+    "UNIMOD:1": 42.010565,
+    "UNIMOD:4": 57.021464,
+    "UNIMOD:7": 0.984016,
+    "UNIMOD:21": 79.966331,
+    "UNIMOD:27": -18.010565,
+    "UNIMOD:28": -17.026549,
+    "UNIMOD:35": 15.994915,
+}
+"""
+Monoisotopic mass shifts of the modifications by name (case-insensitive).
+Mass shifts given as numbers (e.g. [+15.9949]) are used as they are.
+"""
+
+_MODIFICATION_MASSES_LOWER = {k.lower(): v for k, v in MODIFICATION_MASSES.items()}
+
+_PROFORMA_TOKEN = re.compile(r"([A-Z])((?:\[[^\]]*\])*)")
+_PROFORMA_MOD = re.compile(r"\[([^\]]*)\]")
+
+
+def modification_mass(modification: str) -> float:
+    """
+    Mass shift of a modification given by name, UNIMOD accession or number.
+
+    Parameters
+    ----------
+    modification : str
+        The modification without brackets (e.g. "Oxidation", "UNIMOD:35" or "+15.9949").
+
+    Returns
+    -------
+    float
+        The monoisotopic mass shift.
+    """
+    mass = _MODIFICATION_MASSES_LOWER.get(modification.lower())
+    if mass is not None:
+        return mass
+    try:
+        return float(modification)
+    except ValueError:
+        raise ValueError(f"Unknown modification: {modification}") from None
+
+
+def split_proforma(peptide: str) -> Tuple[str, List[str], str]:
+    """
+    Split a ProForma sequence into its terminal modifications and residue tokens.
+
+    Parameters
+    ----------
+    peptide : str
+        A ProForma sequence, optionally with charge (e.g. "[Acetyl]-PEM[Oxidation]K/2").
+
+    Returns
+    -------
+    tuple
+        N-terminal modification ("" if none), residue tokens including their
+        modifications (e.g. ["P", "E", "M[Oxidation]", "K"]) and C-terminal
+        modification ("" if none).
+    """
+    peptide = peptide.split("/", 1)[0]
+    if "[" not in peptide:
+        return "", list(peptide), ""
+
+    n_term = ""
+    c_term = ""
+
+    if peptide.startswith("["):
+        end = peptide.index("]-")
+        n_term = peptide[1:end]
+        peptide = peptide[end + 2:]
+    if peptide.endswith("]") and "-[" in peptide:
+        start = peptide.rindex("-[")
+        c_term = peptide[start + 2:-1]
+        peptide = peptide[:start]
+
+    tokens = [m.group(0) for m in _PROFORMA_TOKEN.finditer(peptide)]
+    return n_term, tokens, c_term
+
+
+def token_mass(token: str) -> float:
+    """
+    Mass of a residue token including its modifications (e.g. "M[Oxidation]").
+    """
+    mass = RESIDUE_MASSES[token[0]]
+    for mod in _PROFORMA_MOD.findall(token):
+        mass += modification_mass(mod)
+    return mass
+
+
+@lru_cache(maxsize=1_000_000)
+def residue_masses(peptide: str) -> np.ndarray:
+    """
+    Masses of all residues of a ProForma sequence. Terminal modifications are
+    added to the first and last residue. The result is cached and must not be
+    modified.
+
+    Parameters
+    ----------
+    peptide : str
+        A ProForma sequence.
+
+    Returns
+    -------
+    np.ndarray
+        Residue masses in sequence order.
+    """
+    n_term, tokens, c_term = split_proforma(peptide)
+    masses = np.array([token_mass(t) for t in tokens], dtype=np.float64)
+    if n_term:
+        masses[0] += modification_mass(n_term)
+    if c_term:
+        masses[-1] += modification_mass(c_term)
+    masses.flags.writeable = False
+    return masses
+
+
+def peptide_mass(peptide: str) -> float:
+    """
+    Monoisotopic (neutral) mass of a ProForma sequence.
+    """
+    if "[" not in peptide and "/" not in peptide:
+        return sum(RESIDUE_MASSES[aa] for aa in peptide) + WATER
+    return float(residue_masses(peptide).sum()) + WATER
+
+
+def peptide_masses(peptides) -> np.ndarray:
+    """
+    Monoisotopic (neutral) masses of many ProForma sequences.
+    """
+    return np.fromiter((peptide_mass(p) for p in peptides), dtype=np.float64, count=len(peptides))
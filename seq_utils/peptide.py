@@ -19,10 +19,11 @@ def remove_ux_containing(peptides: list) -> list:
 def switch_first_il(peptide):
     return re.sub(r"[IL]", lambda x: "L" if x.group() == "I" else "I", peptide, count=1)
 
-def switch_random_il(peptide):
+def switch_random_il(peptide, rng=None):
     """
     Randomly swap an occurrence of I or L, ignoring any I or L inside square brackets.
     If only a single occurrence is found outside brackets, it will be switched.
+    The occurrence is drawn from rng (a random.Random), or the random module if not given.
     """
     # Find all spans corresponding to brackets
     bracket_spans = [m.span() for m in re.finditer(r"\[[^\]]*\]", peptide)]
@@ -49,7 +50,7 @@ def switch_random_il(peptide):
         pos = positions[0]
     else:
         # Randomly select one occurrence excluding the first
-        pos = random.choice(positions[1:])
+        pos = (rng or random).choice(positions[1:])
 
     # Perform the swap
     swapped_char = "L" if peptide[pos] == "I" else "I"
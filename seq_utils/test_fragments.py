@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+from pyteomics import mass
+
+from seq_utils.fragments import (
+    ION_TYPES,
+    W_ION_SIDE_CHAIN_LOSS,
+    annotate_spectra,
+    decode_ions,
+    encode_ions,
+    fragment_ions,
+    ion_labels,
+    parse_annotations,
+)
+from seq_utils.mass import MODIFICATION_MASSES
+
+
+# ProForma peptide, the same peptide with one-letter residues for pyteomics and their masses
+PEPTIDES = [
+    ("PEPTIDEK", "PEPTIDEK", {}),
+    ("LESLIEK", "LESLIEK", {}),
+    (
+        "PEM[Oxidation]C[Carbamidomethyl]LTK",
+        "PEmcLTK",
+        {
+            "m": mass.std_aa_mass["M"] + MODIFICATION_MASSES["Oxidation"],
+            "c": mass.std_aa_mass["C"] + MODIFICATION_MASSES["Carbamidomethyl"],
+        },
+    ),
+    (
+        "[Acetyl]-AGS[Phospho]IR",
+        "aGsIR",
+        {
+            "a": mass.std_aa_mass["A"] + MODIFICATION_MASSES["Acetyl"],
+            "s": mass.std_aa_mass["S"] + MODIFICATION_MASSES["Phospho"],
+        },
+    ),
+]
+
+
+def expected_ions(sequence, aa_mass, max_charge, ion_types):
+    aa_mass = {**mass.std_aa_mass, **aa_mass}
+    expected = {}
+    for charge in range(1, max_charge + 1):
+        for number in range(1, len(sequence)):
+            prefix, suffix = sequence[:number], sequence[-number:]
+            for ion_type in ion_types:
+                if ion_type == "w":
+                    if suffix[0].upper() not in W_ION_SIDE_CHAIN_LOSS:
+                        continue
+                    mz = mass.fast_mass(suffix, "z-dot", charge, aa_mass=aa_mass)
+                    mz -= W_ION_SIDE_CHAIN_LOSS[suffix[0].upper()] / charge
+                else:
+                    mz = mass.fast_mass(prefix if ion_type in "ab" else suffix, ion_type, charge, aa_mass=aa_mass)
+                expected[f"{ion_type}{number}+{charge}"] = mz
+    return expected
+
+
+@pytest.mark.parametrize("max_charge", [1, 2])
+def test_fragment_ions_match_pyteomics(max_charge):
+    peptides = [peptide for peptide, _, _ in PEPTIDES]
+
+    ions = fragment_ions(peptides, [max_charge] * len(peptides), ION_TYPES)
+
+    assert np.all(np.diff(ions.peptide_index) >= 0)
+    for idx, (_, sequence, aa_mass) in enumerate(PEPTIDES):
+        selected = ions.peptide_index == idx
+        computed = dict(zip(ion_labels(ions.codes[selected]), ions.mz[selected]))
+        expected = expected_ions(sequence, aa_mass, max_charge, ION_TYPES)
+        assert computed.keys() == expected.keys()
+        for label, mz in expected.items():
+            assert computed[label] == pytest.approx(mz, abs=1e-5), label
+
+
+def test_fragment_charges_are_limited_by_the_precursor():
+    ions = fragment_ions(["PEPTIDEK", "PEPTIDEK", "PEPTIDEK"], [1, 2, 5], max_fragment_charge=3)
+
+    max_charges = [ions.charge[ions.peptide_index == idx].max() for idx in range(3)]
+    assert max_charges == [1, 2, 3]
+    assert all(len(field) == 0 for field in fragment_ions(["K"]))
+
+
+def test_unknown_ion_type():
+    with pytest.raises(ValueError):
+        fragment_ions(["PEPTIDEK"], ion_types=("b", "c"))
+
+
+def test_encode_decode_and_parse_annotations():
+    ion_type = np.array([0, 1, 2, 3])
+    ion_number = np.array([1, 12, 255, 3])
+    charge = np.array([1, 2, 3, 1])
+
+    codes = encode_ions(ion_type, ion_number, charge)
+
+    assert [part.tolist() for part in decode_ions(codes)] == [ion_type.tolist(), ion_number.tolist(), charge.tolist()]
+    labels = ion_labels(codes)
+    assert labels == ["b1+1", "y12+2", "a255+3", "w3+1"]
+    assert parse_annotations(labels).tolist() == codes.tolist()
+    assert parse_annotations([b"y12+2", "x1+1", "y12", None, "b1+1"]).tolist() == [codes[1], -1, -1, -1, codes[0]]
+
+
+@pytest.mark.parametrize("unit, tolerance, shift", [("ppm", 10.0, 9e-6), ("Da", 0.02, 0.019)])
+def test_annotate_spectra_within_tolerance(unit, tolerance, shift):
+    peptides = ["PEPTIDEK", "LESLIEK"]
+    ions = fragment_ions(peptides, [2, 2])
+    labels = np.array(ion_labels(ions.codes))
+
+    def shifted(mz, factor):
+        return mz * (1 + factor * shift) if unit == "ppm" else mz + factor * shift
+
+    mz_arrays, intensity_arrays, expected = [], [], []
+    for idx in range(len(peptides)):
+        theoretical = ions.mz[ions.peptide_index == idx]
+        idx_labels = labels[ions.peptide_index == idx]
+        # peaks of the first three ions just inside the tolerance, of the next three just outside,
+        # and two peaks for the seventh of which the more intense one is annotated
+        mz = np.concatenate([
+            shifted(theoretical[:3], 1),
+            shifted(theoretical[3:6], 2.5),
+            [shifted(theoretical[6], -1), shifted(theoretical[6], 0.5)],
+        ])
+        intensity = np.concatenate([np.full(6, 1.0), [0.5, 2.0]])
+        order = np.argsort(mz)
+        mz_arrays.append(mz[order])
+        intensity_arrays.append(intensity[order])
+        expected.append({label: (shifted(value, 1), 1.0) for label, value in zip(idx_labels[:3], theoretical[:3])})
+        expected[-1][idx_labels[6]] = (shifted(theoretical[6], 0.5), 2.0)
+
+    annotated = annotate_spectra(
+        peptides, [2, 2], mz_arrays, intensity_arrays, tolerance=tolerance, unit=unit, batch_size=1
+    )
+
+    for idx in range(len(peptides)):
+        selected = annotated.spectrum_index == idx
+        found = {
+            label: (mz, intensity)
+            for label, mz, intensity in zip(
+                ion_labels(annotated.codes[selected]), annotated.mz[selected], annotated.intensity[selected]
+            )
+        }
+        assert found.keys() == expected[idx].keys()
+        for label, (mz, intensity) in expected[idx].items():
+            assert found[label] == (pytest.approx(mz), intensity)
+    theoretical = {
+        (index, label): mz for index, label, mz in zip(ions.peptide_index, ion_labels(ions.codes), ions.mz)
+    }
+    assert annotated.theoretical_mz.tolist() == [
+        theoretical[index, label] for index, label in zip(annotated.spectrum_index, ion_labels(annotated.codes))
+    ]
+
+
+def test_annotate_spectra_rejects_unknown_unit():
+    with pytest.raises(ValueError):
+        annotate_spectra(["PEPTIDEK"], [2], [np.array([100.0])], [np.array([1.0])], unit="mmu")
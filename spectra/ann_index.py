@@ -0,0 +1,618 @@
+"""
+Approximate nearest neighbour index of spectra.
+
+Spectra are represented by their sparse binned vectors (see
+spectra.precursor_sweep.binned_vectors) and hashed into n_tables tables by
+locality sensitive signatures of band_size components each:
+
+    cosine   random hyperplane bits (SimHash), two spectra share the key of
+             a table with probability (1 - angle / pi) ** band_size
+    jaccard  MinHashes of the binarized peaks (metrics.metrics.binarize), two
+             spectra share a key with probability jaccard ** band_size
+
+The hyperplanes and hash functions are derived from the bin numbers by a 64
+bit mixing function, so no projection matrix is stored and the signatures of
+later queries match those of the index. Every table is an array of keys in
+sorted order with the rows of the spectra, so a lookup is a binary search.
+Spectra sharing a key with a query in any of the queried tables are
+candidates, which are rescored exactly with the binned cosine (the spectral
+angle of metrics.metrics on the binned vectors) or any other metric of
+metrics.metrics. Querying fewer tables is faster at a lower recall, larger
+band sizes give fewer candidates per table.
+
+An index is a directory of .npy files opened memory-mapped, like the spectrum
+store. Build an index of a spectrum store and write all pairs of similar
+spectra from the project root with:
+    python -m spectra.ann_index store_dir index_dir pairs.parquet --min-score 0.8
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import ClassVar, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import metrics.metrics as M
+from pipeline.instrumentation import timer
+from spectra.precursor_sweep import binned_vectors, pair_cosine
+from spectra.store import SpectrumStore
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """
+    SplitMix64 finalizer, a bijective hash of 64 bit integers.
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _salt(seed: int, function: int) -> np.uint64:
+    return _mix(np.array([seed], dtype=np.uint64) * _GOLDEN + np.uint64(function))[0]
+
+
+def _present(bins: np.ndarray, weights: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Bins with an intensity above threshold times the most intense bin.
+    """
+    maxima = weights.max(axis=1, keepdims=True)
+    relative = np.divide(weights, maxima, out=np.zeros_like(weights), where=maxima > 0)
+    return M.binarize(relative, threshold).astype(bool) & (bins >= 0)
+
+
+def signatures(
+    bins: np.ndarray,
+    weights: np.ndarray,
+    method: str = "cosine",
+    n_tables: int = 32,
+    band_size: int = 16,
+    seed: int = 42,
+    threshold: float = 0.01,
+) -> np.ndarray:
+    """
+    Table keys of binned vectors.
+
+    Returns
+    -------
+    np.ndarray
+        Keys of shape (n_spectra, n_tables).
+    """
+    hashed_bins = np.where(bins >= 0, bins, 0).astype(np.uint64)
+    keys = np.zeros((len(bins), n_tables), dtype=np.uint64)
+
+    if method == "cosine":
+        if band_size > 64:
+            raise ValueError("Cosine signatures have at most 64 bits per table")
+        for table in range(n_tables):
+            # the bits of the hash of a bin are its coordinates (+-1) on the band_size hyperplanes
+            hashes = _mix(hashed_bins ^ _salt(seed, table))
+            for bit in range(band_size):
+                signs = ((hashes >> np.uint64(bit)) & np.uint64(1)).astype(np.float32) * 2 - 1
+                above = (weights * signs).sum(axis=1) > 0
+                keys[:, table] |= above.astype(np.uint64) << np.uint64(bit)
+
+    elif method == "jaccard":
+        absent = ~_present(bins, weights, threshold)
+        for table in range(n_tables):
+            key = np.zeros(len(bins), dtype=np.uint64)
+            for function in range(table * band_size, (table + 1) * band_size):
+                hashes = _mix(hashed_bins ^ _salt(seed, function))
+                hashes[absent] = np.iinfo(np.uint64).max
+                key = _mix(key ^ hashes.min(axis=1))
+            keys[:, table] = key
+
+    else:
+        raise ValueError(f"Unknown method {method}, use cosine or jaccard")
+
+    return keys
+
+
+def _expand(starts: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Index of the range and position of every element of the ranges
+    [start, start + count).
+    """
+    ranges = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(ranges)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return ranges, starts[ranges] + offsets
+
+
+def _expand_chunks(
+    starts: np.ndarray, counts: np.ndarray, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    _expand of consecutive groups of ranges with about chunk_size elements
+    each (at least one range per group).
+    """
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        last = max(first + 1, int(np.searchsorted(ends, ends[first] - counts[first] + chunk_size, side="right")))
+        ranges, positions = _expand(starts[first:last], counts[first:last])
+        yield ranges + first, positions
+        first = last
+
+
+def _merge_codes(codes: np.ndarray, chunks: List[np.ndarray]) -> np.ndarray:
+    """
+    Sorted distinct codes of the sorted distinct codes and the pair codes of
+    one table, the codes of a table are distinct.
+    """
+    if not chunks:
+        return codes
+    table_codes = np.sort(np.concatenate(chunks))
+    positions = np.searchsorted(codes, table_codes)
+    if len(codes) == 0:
+        return table_codes
+    new = codes[np.minimum(positions, len(codes) - 1)] != table_codes
+    return np.insert(codes, positions[new], table_codes[new])
+
+
+class SpectrumIndex:
+    """
+    Read access to an approximate nearest neighbour index.
+    """
+
+    DEFAULT_BAND_SIZES: ClassVar[Dict[str, int]] = {"cosine": 16, "jaccard": 4}
+    """
+    Components per table key if the band size is not given.
+    """
+
+    def __init__(self, path: Path, mmap_mode: Optional[str] = "r"):
+        """
+        Parameters
+        ----------
+        path : Path
+            Directory of the index.
+        mmap_mode : Optional[str]
+            Memory map mode passed to np.load, None loads the arrays into memory.
+        """
+        self.path = Path(path)
+        with open(self.path / "index.json") as f:
+            self.params = json.load(f)
+        for name in ("bins", "weights", "keys", "rows"):
+            setattr(self, name, np.load(self.path / f"{name}.npy", mmap_mode=mmap_mode))
+
+    @staticmethod
+    def is_index(path: Path) -> bool:
+        return Path(path).joinpath("index.json").exists()
+
+    def __len__(self) -> int:
+        return self.keys.shape[1]
+
+    @property
+    def n_tables(self) -> int:
+        return self.params["n_tables"]
+
+    def signatures(self, bins: np.ndarray, weights: np.ndarray, tables: Optional[int] = None) -> np.ndarray:
+        """
+        Keys of the first tables (default: all) of binned vectors.
+        """
+        with timer("ann_signatures", items=len(bins)):
+            return signatures(
+                bins,
+                weights,
+                self.params["method"],
+                self.n_tables if tables is None else tables,
+                self.params["band_size"],
+                self.params["seed"],
+                self.params["threshold"],
+            )
+
+    def candidates(
+        self,
+        bins: np.ndarray,
+        weights: np.ndarray,
+        tables: Optional[int] = None,
+        max_bucket_size: Optional[int] = None,
+        chunk_size: int = 1000000,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Candidate neighbours of query vectors: index rows sharing a key with
+        the query in any of the first tables (default: all tables). The
+        candidates of a table are expanded about chunk_size at a time.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Query index and row of each distinct candidate pair.
+        """
+        tables = self.n_tables if tables is None else min(tables, self.n_tables)
+        query_keys = self.signatures(bins, weights, tables)
+        queries = np.flatnonzero((weights > 0).any(axis=1))
+
+        # duplicates are only found across tables, they are removed table by table
+        codes = np.array([], dtype=np.int64)
+        for table in range(tables):
+            keys = query_keys[queries, table]
+            starts = np.searchsorted(self.keys[table], keys, side="left")
+            counts = np.searchsorted(self.keys[table], keys, side="right") - starts
+            if max_bucket_size is not None:
+                counts = np.minimum(counts, max_bucket_size)
+            table_codes = [
+                (queries[ranges].astype(np.int64) << 32) | np.asarray(self.rows[table][positions])
+                for ranges, positions in _expand_chunks(starts, counts, chunk_size)
+            ]
+            codes = _merge_codes(codes, table_codes)
+        return codes >> 32, codes & 0xFFFFFFFF
+
+    def score(
+        self,
+        bins: np.ndarray,
+        weights: np.ndarray,
+        rows: np.ndarray,
+        metric: str = "spectral_angle",
+    ) -> np.ndarray:
+        """
+        Exact scores of query vectors against index rows, pair by pair.
+        """
+        with timer("ann_rescoring", items=len(rows)):
+            return score_pairs(bins, weights, self.bins[rows], self.weights[rows], metric, self.params["bin_width"])
+
+    def query(
+        self,
+        bins: np.ndarray,
+        weights: np.ndarray,
+        k: int = 10,
+        tables: Optional[int] = None,
+        min_score: Optional[float] = None,
+        metric: str = "spectral_angle",
+        max_bucket_size: Optional[int] = None,
+        chunk_size: int = 10000,
+    ) -> pd.DataFrame:
+        """
+        The k best scoring index rows of each query vector.
+
+        Parameters
+        ----------
+        bins, weights : np.ndarray
+            Binned vectors of the queries, with the bin width and top_k of the index.
+        k : int
+            Number of neighbours per query.
+        tables : Optional[int]
+            Number of tables queried (default: all), fewer tables are faster at lower recall.
+        min_score : Optional[float]
+            Minimal exact score of a neighbour.
+        metric : str
+            Metric of metrics.metrics to rescore candidates with, higher is better.
+        max_bucket_size : Optional[int]
+            Maximal number of candidates per query and table.
+        chunk_size : int
+            Number of queries processed at once.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per neighbour with the columns query, row and score,
+            ordered by query and descending score.
+        """
+        results = []
+        for start in tqdm(range(0, len(bins), chunk_size), desc="Querying index"):
+            chunk_bins = bins[start:start + chunk_size]
+            chunk_weights = weights[start:start + chunk_size]
+            queries, rows = self.candidates(chunk_bins, chunk_weights, tables, max_bucket_size)
+            scores = self.score(chunk_bins[queries], chunk_weights[queries], rows, metric)
+            result_df = pd.DataFrame({"query": queries + start, "row": rows, "score": scores})
+            if min_score is not None:
+                result_df = result_df[result_df["score"] >= min_score]
+            result_df = result_df.sort_values(["query", "score"], ascending=[True, False], kind="stable")
+            results.append(result_df.groupby("query", sort=False).head(k))
+        return (
+            pd.concat(results, ignore_index=True) if results
+            else pd.DataFrame({"query": [], "row": [], "score": []})
+        )
+
+    def similar_pairs(
+        self,
+        tables: Optional[int] = None,
+        min_score: float = 0.7,
+        metric: str = "spectral_angle",
+        max_bucket_size: int = 1000,
+        chunk_size: int = 1000000,
+    ) -> pd.DataFrame:
+        """
+        All pairs of indexed spectra sharing a key in any of the first tables
+        (default: all) with an exact score of at least min_score. Of larger
+        buckets, every spectrum is only paired with the max_bucket_size
+        following spectra of the bucket. Candidate pairs are expanded and
+        scored about chunk_size at a time.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per pair with the columns row_1, row_2 (row_1 < row_2) and score.
+        """
+        tables = self.n_tables if tables is None else min(tables, self.n_tables)
+        # duplicates are only found across tables, they are removed table by table
+        codes = np.array([], dtype=np.int64)
+        for table in range(tables):
+            keys = np.asarray(self.keys[table])
+            rows = np.asarray(self.rows[table], dtype=np.int64)
+            bucket_ends = np.searchsorted(keys, keys, side="right")
+            counts = np.minimum(bucket_ends - np.arange(len(keys)) - 1, max_bucket_size)
+            table_codes = []
+            for firsts, seconds in _expand_chunks(np.arange(len(keys)) + 1, counts, chunk_size):
+                rows_1, rows_2 = rows[firsts], rows[seconds]
+                table_codes.append((np.minimum(rows_1, rows_2) << 32) | np.maximum(rows_1, rows_2))
+            codes = _merge_codes(codes, table_codes)
+
+        results = []
+        for start in tqdm(range(0, len(codes), chunk_size), desc="Scoring candidate pairs"):
+            rows_1 = codes[start:start + chunk_size] >> 32
+            rows_2 = codes[start:start + chunk_size] & 0xFFFFFFFF
+            scores = self.score(self.bins[rows_1], self.weights[rows_1], rows_2, metric)
+            keep = scores >= min_score
+            results.append(pd.DataFrame({"row_1": rows_1[keep], "row_2": rows_2[keep], "score": scores[keep]}))
+        return (
+            pd.concat(results, ignore_index=True) if results
+            else pd.DataFrame({"row_1": [], "row_2": [], "score": []})
+        )
+
+
+def score_pairs(
+    bins_1: np.ndarray,
+    weights_1: np.ndarray,
+    bins_2: np.ndarray,
+    weights_2: np.ndarray,
+    metric: str = "spectral_angle",
+    bin_width: float = 0.02,
+    chunk_size: int = 16384,
+) -> np.ndarray:
+    """
+    Scores of pairs of binned vectors. The spectral angle is computed for
+    all pairs at once (cosine of the binned vectors), other metrics of
+    metrics.metrics on the dense vectors over the union of the bins of each
+    pair, with the bin centers as m/z.
+    """
+    if metric == "spectral_angle":
+        return np.concatenate(
+            [
+                pair_cosine(
+                    bins_1[start:start + chunk_size],
+                    weights_1[start:start + chunk_size],
+                    bins_2[start:start + chunk_size],
+                    weights_2[start:start + chunk_size],
+                )
+                for start in range(0, len(bins_1), chunk_size)
+            ]
+        ) if len(bins_1) else np.array([], dtype=np.float32)
+
+    metric_function = getattr(M, metric)
+    scores = np.full(len(bins_1), np.nan)
+    for idx in range(len(bins_1)):
+        valid_1, valid_2 = bins_1[idx] >= 0, bins_2[idx] >= 0
+        union, inverse = np.unique(np.concatenate((bins_1[idx][valid_1], bins_2[idx][valid_2])), return_inverse=True)
+        intensity_1 = np.zeros(len(union))
+        intensity_2 = np.zeros(len(union))
+        intensity_1[inverse[:valid_1.sum()]] = weights_1[idx][valid_1]
+        intensity_2[inverse[valid_1.sum():]] = weights_2[idx][valid_2]
+        mz = (union + 0.5) * bin_width
+        try:
+            scores[idx] = metric_function(intensity1=intensity_1, intensity2=intensity_2, mz1=mz, mz2=mz)
+        except ValueError:
+            continue
+    return scores
+
+
+def build_index(
+    bins: np.ndarray,
+    weights: np.ndarray,
+    path: Path,
+    method: str = "jaccard",
+    n_tables: int = 32,
+    band_size: Optional[int] = None,
+    seed: int = 42,
+    threshold: float = 0.01,
+    bin_width: float = 0.02,
+    chunk_size: int = 100000,
+) -> SpectrumIndex:
+    """
+    Build an index of binned vectors (see spectra.precursor_sweep.binned_vectors),
+    row i of the vectors is row i of the index. Empty vectors are not indexed.
+
+    Parameters
+    ----------
+    bins, weights : np.ndarray
+        Binned vectors of shape (n_spectra, top_k).
+    path : Path
+        Directory of the index.
+    method : str
+        "jaccard" (MinHash of the binarized peaks) or "cosine" (random
+        hyperplanes). MinHash keys of sparse top_k vectors rarely collide for
+        unrelated spectra, so they reach a higher recall with fewer candidates.
+    n_tables : int
+        Number of hash tables, more tables give a higher recall.
+    band_size : Optional[int]
+        Bits or MinHashes per table key (default: DEFAULT_BAND_SIZES).
+    seed : int
+        Seed of the hyperplanes and hash functions.
+    threshold : float
+        Relative intensity of binarized peaks, jaccard only.
+    bin_width : float
+        Bin width of the vectors in Da, for metrics using m/z.
+    chunk_size : int
+        Number of vectors hashed at once.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if band_size is None:
+        band_size = SpectrumIndex.DEFAULT_BAND_SIZES[method]
+    if len(bins) >= 1 << 31:
+        raise ValueError("An index holds at most 2**31 - 1 spectra")
+
+    bins = np.asarray(bins)
+    weights = np.asarray(weights, dtype=np.float32)
+    if method == "jaccard":
+        indexed = np.flatnonzero(_present(bins, weights, threshold).any(axis=1))
+    else:
+        indexed = np.flatnonzero((weights > 0).any(axis=1))
+
+    keys = np.lib.format.open_memmap(path / "keys.npy", mode="w+", dtype=np.uint64, shape=(n_tables, len(indexed)))
+    rows = np.lib.format.open_memmap(path / "rows.npy", mode="w+", dtype=np.int32, shape=(n_tables, len(indexed)))
+    with timer("ann_signatures", items=len(indexed)):
+        for start in tqdm(range(0, len(indexed), chunk_size), desc="Hashing spectra"):
+            chunk = indexed[start:start + chunk_size]
+            keys[:, start:start + len(chunk)] = signatures(
+                bins[chunk], weights[chunk], method, n_tables, band_size, seed, threshold
+            ).T
+    for table in range(n_tables):
+        order = np.argsort(keys[table], kind="stable")
+        keys[table] = keys[table][order]
+        rows[table] = indexed[order]
+    keys.flush()
+    rows.flush()
+
+    np.save(path / "bins.npy", bins)
+    np.save(path / "weights.npy", weights)
+    with open(path / "index.json", "w") as f:
+        json.dump(
+            {
+                "method": method,
+                "n_tables": n_tables,
+                "band_size": band_size,
+                "seed": seed,
+                "threshold": threshold,
+                "bin_width": bin_width,
+                "top_k": bins.shape[1],
+            },
+            f,
+        )
+    return SpectrumIndex(path)
+
+
+def get_cli():
+    """
+    Command line interface for build_index and SpectrumIndex
+    """
+    parser = argparse.ArgumentParser(
+        description="Find similar spectra with an approximate nearest neighbour index of a spectrum store."
+    )
+    parser.add_argument(
+        "store_dir",
+        type=Path,
+        help="Spectrum store of the indexed spectra (python -m spectra.store)."
+    )
+    parser.add_argument(
+        "index_dir",
+        type=Path,
+        help="Index directory, built from the store if it does not exist."
+    )
+    parser.add_argument(
+        "outfile",
+        type=Path,
+        help="Output file. (.parquet == Parquet format, other: tab-separated values)"
+    )
+    parser.add_argument(
+        "--query-store",
+        type=Path,
+        default=None,
+        help="Spectrum store of query spectra, their k best neighbours are written instead of all similar pairs."
+    )
+    parser.add_argument(
+        "--method",
+        choices=["cosine", "jaccard"],
+        default="jaccard",
+        help="Random hyperplane signatures (cosine) or MinHash of the binarized peaks (jaccard)."
+    )
+    parser.add_argument(
+        "--tables",
+        type=int,
+        default=32,
+        help="Number of hash tables of a new index."
+    )
+    parser.add_argument(
+        "--band-size",
+        type=int,
+        default=None,
+        help="Bits (cosine) or MinHashes (jaccard) per table key (default: 16 for cosine, 4 for jaccard)."
+    )
+    parser.add_argument(
+        "--query-tables",
+        type=int,
+        default=None,
+        help="Number of tables queried (default: all), fewer tables are faster at lower recall."
+    )
+    parser.add_argument(
+        "--max-bucket-size",
+        type=int,
+        default=1000,
+        help="Maximal number of candidates per spectrum and table."
+    )
+    parser.add_argument(
+        "--min-score",
+        type=float,
+        default=0.7,
+        help="Minimal exact score of a pair."
+    )
+    parser.add_argument(
+        "--metric",
+        default="spectral_angle",
+        help="Metric of metrics.metrics the candidates are rescored with."
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        default=10,
+        help="Number of neighbours per query spectrum."
+    )
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=0.02,
+        help="m/z bin width of the vectors in Da."
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=32,
+        help="Number of most intense bins per spectrum."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    store = SpectrumStore(args.store_dir)
+
+    if SpectrumIndex.is_index(args.index_dir):
+        index = SpectrumIndex(args.index_dir)
+    else:
+        bins, weights = binned_vectors(store, args.bin_width, args.top_k)
+        index = build_index(
+            bins, weights, args.index_dir, args.method, args.tables, args.band_size, bin_width=args.bin_width
+        )
+
+    files = np.asarray(store.files, dtype=object)
+    if args.query_store is None:
+        pairs_df = index.similar_pairs(args.query_tables, args.min_score, args.metric, args.max_bucket_size)
+        rows_1, rows_2 = pairs_df["row_1"].to_numpy(), pairs_df["row_2"].to_numpy()
+        query_store = store
+    else:
+        query_store = SpectrumStore(args.query_store)
+        bins, weights = binned_vectors(query_store, index.params["bin_width"], index.params["top_k"])
+        pairs_df = index.query(
+            bins, weights, args.k, args.query_tables, args.min_score, args.metric, args.max_bucket_size
+        )
+        rows_1, rows_2 = pairs_df["query"].to_numpy(), pairs_df["row"].to_numpy()
+
+    query_files = np.asarray(query_store.files, dtype=object)
+    result_df = pd.DataFrame(
+        {
+            "raw_file_1": query_files[query_store.file_codes[rows_1]],
+            "scan_number_1": query_store.scan_numbers[rows_1],
+            "raw_file_2": files[store.file_codes[rows_2]],
+            "scan_number_2": store.scan_numbers[rows_2],
+            "score": pairs_df["score"].to_numpy(),
+        }
+    )
+    if args.outfile.suffix == ".parquet":
+        result_df.to_parquet(args.outfile, index=False)
+    else:
+        result_df.to_csv(args.outfile, sep="\t", index=False)
+    print(f"Wrote {len(result_df)} pairs to {args.outfile}")
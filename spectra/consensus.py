@@ -0,0 +1,159 @@
+"""
+Consensus spectra from several spectra of the same peptide.
+
+Peaks of all spectra of a group are pooled, sorted by m/z and clustered:
+a cluster starts at a peak and takes all following peaks within the tolerance
+of it, so that no cluster is wider than the tolerance however densely many
+spectra fill the m/z axis. Each cluster becomes one consensus peak with the intensity
+weighted mean m/z, the mean normalized intensity over all spectra of the
+group (missing peaks count as zero) and the number of spectra supporting it.
+"""
+
+from typing import List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+
+class ConsensusSpectra(NamedTuple):
+    """
+    Consensus spectra of several groups, the peaks of group i are the slice
+    offsets[i]:offsets[i + 1].
+    """
+
+    mz: np.ndarray
+    intensity: np.ndarray
+    support: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def spectrum(self, group: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        start, stop = self.offsets[group], self.offsets[group + 1]
+        return self.mz[start:stop], self.intensity[start:stop], self.support[start:stop]
+
+
+def _cluster_starts(mz: np.ndarray, peak_group: np.ndarray, tolerance: float, unit: str) -> np.ndarray:
+    """
+    First peak of each cluster of peaks sorted by group and m/z. A cluster
+    starts with a peak and contains all peaks of the group within the
+    tolerance of it, the next cluster starts with the first peak beyond.
+
+    The chains of cluster starts are followed for all groups at once by
+    pointer doubling: after k rounds the starts of the first 2^k clusters
+    from every gap (or group boundary) are known.
+    """
+    n_peaks = len(mz)
+    limit = mz * (1 + tolerance * 1e-6) if unit == "ppm" else mz + tolerance
+
+    # no cluster spans a gap wider than the tolerance or a group boundary
+    segment_start = np.ones(n_peaks, dtype=bool)
+    segment_start[1:] = (mz[1:] > limit[:-1]) | (peak_group[1:] != peak_group[:-1])
+    segment_starts = np.flatnonzero(segment_start)
+    segment_stop = np.append(segment_starts[1:], n_peaks)[np.cumsum(segment_start) - 1]
+
+    # first peak beyond the tolerance of each peak, n_peaks past the end
+    span = 2 * (limit.max() + 1)
+    next_start = np.minimum(
+        np.searchsorted(mz + peak_group * span, limit + peak_group * span, side="right"),
+        segment_stop,
+    )
+    jump = np.append(next_start, n_peaks)
+
+    starts = segment_starts
+    while True:
+        reached = jump[starts]
+        extended = np.union1d(starts, reached[reached < n_peaks])
+        if len(extended) == len(starts):
+            break
+        starts = extended
+        jump = jump[jump]
+
+    new_cluster = np.zeros(n_peaks, dtype=bool)
+    new_cluster[starts] = True
+    return new_cluster
+
+
+def consensus_spectra(
+    groups: Sequence[Sequence[Tuple[np.ndarray, np.ndarray]]],
+    tolerance: float = 20.0,
+    unit: str = "ppm",
+    min_support: int = 1,
+) -> ConsensusSpectra:
+    """
+    Merge the spectra of each group into a consensus spectrum, all groups at once.
+
+    Parameters
+    ----------
+    groups : Sequence[Sequence[Tuple[np.ndarray, np.ndarray]]]
+        For each group the (m/z array, intensity array) of its spectra.
+    tolerance : float
+        Maximal m/z distance of the peaks of a cluster from its first peak.
+    unit : str
+        "ppm" or "Da".
+    min_support : int
+        Minimal number of spectra a consensus peak must be found in.
+
+    Returns
+    -------
+    ConsensusSpectra
+        Consensus peaks of all groups, sorted by m/z within each group.
+    """
+    if unit not in ("ppm", "Da"):
+        raise ValueError(f"Unknown tolerance unit: {unit}")
+
+    spectra: List[Tuple[np.ndarray, np.ndarray]] = [spectrum for group in groups for spectrum in group]
+    spectra_per_group = np.fromiter((len(group) for group in groups), dtype=np.int64, count=len(groups))
+    spectrum_group = np.repeat(np.arange(len(groups)), spectra_per_group)
+
+    peaks_per_spectrum = np.fromiter((len(mz) for mz, _ in spectra), dtype=np.int64, count=len(spectra))
+    if peaks_per_spectrum.sum() == 0:
+        empty = np.array([], dtype=np.float64)
+        return ConsensusSpectra(empty, empty, np.array([], dtype=np.int64), np.zeros(len(groups) + 1, dtype=np.int64))
+
+    peak_spectrum = np.repeat(np.arange(len(spectra)), peaks_per_spectrum)
+    peak_group = spectrum_group[peak_spectrum]
+    mz = np.concatenate([np.asarray(mz, dtype=np.float64) for mz, _ in spectra])
+    intensity = np.concatenate([np.asarray(intensity, dtype=np.float64) for _, intensity in spectra])
+
+    # normalize every spectrum to its base peak
+    base_peaks = np.zeros(len(spectra))
+    np.maximum.at(base_peaks, peak_spectrum, intensity)
+    intensity = intensity / np.where(base_peaks > 0, base_peaks, 1.0)[peak_spectrum]
+
+    order = np.lexsort((mz, peak_group))
+    mz, intensity, peak_spectrum, peak_group = mz[order], intensity[order], peak_spectrum[order], peak_group[order]
+
+    new_cluster = _cluster_starts(mz, peak_group, tolerance, unit)
+    cluster = np.cumsum(new_cluster) - 1
+    n_clusters = cluster[-1] + 1
+
+    cluster_group = peak_group[new_cluster]
+    cluster_intensity = np.bincount(cluster, weights=intensity, minlength=n_clusters)
+    cluster_mz = np.bincount(cluster, weights=mz * intensity, minlength=n_clusters)
+    cluster_mz = np.divide(
+        cluster_mz,
+        cluster_intensity,
+        out=np.bincount(cluster, weights=mz, minlength=n_clusters) / np.bincount(cluster, minlength=n_clusters),
+        where=cluster_intensity > 0,
+    )
+
+    # count each spectrum once per cluster
+    cluster_spectrum = np.sort(cluster.astype(np.int64) * len(spectra) + peak_spectrum)
+    first_in_cluster = np.ones(len(cluster_spectrum), dtype=bool)
+    first_in_cluster[1:] = cluster_spectrum[1:] != cluster_spectrum[:-1]
+    support = np.bincount(cluster_spectrum[first_in_cluster] // len(spectra), minlength=n_clusters)
+
+    cluster_intensity /= spectra_per_group[cluster_group]
+
+    keep = support >= min_support
+    cluster_group = cluster_group[keep]
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cluster_group, minlength=len(groups)), out=offsets[1:])
+
+    return ConsensusSpectra(
+        mz=cluster_mz[keep],
+        intensity=cluster_intensity[keep],
+        support=support[keep],
+        offsets=offsets,
+    )
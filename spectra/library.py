@@ -0,0 +1,268 @@
+"""
+Memory-mapped spectral library of predicted spectra.
+
+A library is one binary file:
+
+    header    magic, version, number of entries and the offset and length of
+              every section
+    slots     open addressing hash table (entry index or -1)
+    hashes    64 bit BLAKE2b hash of each entry's key "peptide/charge/CE"
+    keys      UTF-8 keys, delimited by key_offsets
+    charges, collision_energies
+    peaks     m/z, intensity and encoded annotation (seq_utils.fragments) of
+              all entries, delimited by peak_offsets
+
+Opening a library maps the file and creates views of the sections, so it
+takes constant time and all processes reading the same library share its
+pages. A lookup hashes the key and probes the table, so it is constant time
+as well.
+
+Build a library from the output of obtain_predictions_pairs (CSV or Parquet)
+from the project root with:
+    python -m spectra.library predictions.speclib predictions.csv ...
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import ClassVar, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from seq_utils.fragments import parse_annotations
+
+
+MAGIC = b"SPECLIB\0"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIQ")
+_SECTION = struct.Struct("<QQ")
+_ALIGNMENT = 64
+
+
+def library_key(peptide: str, charge: int, collision_energy: float) -> bytes:
+    return f"{peptide}/{int(charge)}/{float(collision_energy):g}".encode()
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SpectralLibrary:
+    """
+    Read access to a spectral library file.
+    """
+
+    SECTIONS: ClassVar[Dict[str, type]] = {
+        "slots": np.int64,
+        "hashes": np.uint64,
+        "key_offsets": np.int64,
+        "keys": np.uint8,
+        "charges": np.int8,
+        "collision_energies": np.float32,
+        "peak_offsets": np.int64,
+        "mz": np.float64,
+        "intensity": np.float32,
+        "codes": np.int32,
+    }
+    """
+    Sections of the file in order and their types.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Parameters
+        ----------
+        path : Path
+            Library file.
+        """
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_sections, self.n_entries = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a spectral library")
+        if version != VERSION or n_sections != len(self.SECTIONS):
+            raise ValueError(f"Unsupported spectral library version {version} of {self.path}")
+
+        for idx, (name, dtype) in enumerate(self.SECTIONS.items()):
+            offset, count = _SECTION.unpack_from(self._mmap, _HEADER.size + idx * _SECTION.size)
+            setattr(self, name, np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset))
+        self._mask = int(len(self.slots) - 1)
+
+    def __len__(self) -> int:
+        return self.n_entries
+
+    def __reduce__(self):
+        # worker processes map the file themselves instead of receiving a copy
+        return (self.__class__, (self.path,))
+
+    def key(self, entry: int) -> bytes:
+        return self.keys[self.key_offsets[entry]:self.key_offsets[entry + 1]].tobytes()
+
+    def find(self, peptide: str, charge: int, collision_energy: float) -> int:
+        """
+        Entry index of a spectrum, -1 if it is not in the library.
+        """
+        key = library_key(peptide, charge, collision_energy)
+        hash_value = key_hash(key)
+        slot = hash_value & self._mask
+        while True:
+            entry = self.slots[slot]
+            if entry < 0:
+                return -1
+            if self.hashes[entry] == hash_value and self.key(entry) == key:
+                return int(entry)
+            slot = (slot + 1) & self._mask
+
+    def spectrum(self, entry: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        m/z, intensity and annotation codes of an entry, as views of the mapped file.
+        """
+        start, stop = self.peak_offsets[entry], self.peak_offsets[entry + 1]
+        return self.mz[start:stop], self.intensity[start:stop], self.codes[start:stop]
+
+    def get(
+        self, peptide: str, charge: int, collision_energy: float
+    ) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        m/z, intensity and annotation codes of a spectrum, None if it is not in the library.
+        """
+        entry = self.find(peptide, charge, collision_energy)
+        return None if entry < 0 else self.spectrum(entry)
+
+    def __contains__(self, key: Tuple[str, int, float]) -> bool:
+        return self.find(*key) >= 0
+
+    def __iter__(self) -> Iterator[Tuple[str, int, float]]:
+        for entry in range(self.n_entries):
+            peptide, charge, collision_energy = self.key(entry).decode().rsplit("/", 2)
+            yield peptide, int(charge), float(collision_energy)
+
+
+def _hash_table(hashes: np.ndarray) -> np.ndarray:
+    """
+    Open addressing table with linear probing, at most half full. All
+    entries are inserted at once in rounds: every pending entry tries its
+    current slot, the first entry per free slot wins and the others move on.
+    """
+    n_slots = 1 << max(int(2 * len(hashes) - 1).bit_length(), 1)
+    mask = np.uint64(n_slots - 1)
+    slots = np.full(n_slots, -1, dtype=np.int64)
+
+    pending = np.arange(len(hashes), dtype=np.int64)
+    positions = (hashes & mask).astype(np.int64)
+    while len(pending) > 0:
+        free = slots[positions] < 0
+        _, first = np.unique(positions[free], return_index=True)
+        winners = np.flatnonzero(free)[first]
+        slots[positions[winners]] = pending[winners]
+
+        placed = np.zeros(len(pending), dtype=bool)
+        placed[winners] = True
+        pending = pending[~placed]
+        positions = (positions[~placed] + 1) & (n_slots - 1)
+    return slots
+
+
+def write_library(predictions_df: pd.DataFrame, path: Path) -> SpectralLibrary:
+    """
+    Write the predictions of obtain_predictions_pairs (one row per fragment
+    with peptide_sequences, precursor_charges, collision_energies, mz,
+    intensities and annotation) to a library file. Fragments with unknown
+    annotations or intensities <= 0 are left out, spectra reported more than
+    once are kept once.
+    """
+    path = Path(path)
+    predictions_df = predictions_df.assign(code=parse_annotations(predictions_df["annotation"]))
+
+    key_columns = ["peptide_sequences", "precursor_charges", "collision_energies"]
+    entries = predictions_df.groupby(key_columns, sort=False).ngroup().to_numpy(dtype=np.int64)
+    keys = [library_key(*row) for row in predictions_df[key_columns].drop_duplicates().itertuples(index=False)]
+
+    valid = ((predictions_df["code"] >= 0) & (predictions_df["intensities"] > 0)).to_numpy()
+    fragments_df = predictions_df[valid]
+    fragment_entries = entries[valid]
+    codes = fragments_df["code"].to_numpy(dtype=np.int64)
+    # one fragment per ion and entry, ordered by entry and m/z
+    mz = fragments_df["mz"].to_numpy(dtype=np.float64)
+    order = np.lexsort((mz, fragment_entries))
+    fragment_entries, codes, mz = fragment_entries[order], codes[order], mz[order]
+    intensity = fragments_df["intensities"].to_numpy(dtype=np.float32)[order]
+    _, unique = np.unique((fragment_entries << 32) | codes, return_index=True)
+    unique.sort()
+    fragment_entries, codes, mz, intensity = fragment_entries[unique], codes[unique], mz[unique], intensity[unique]
+
+    peak_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(fragment_entries, minlength=len(keys)), out=peak_offsets[1:])
+    key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum([len(key) for key in keys], out=key_offsets[1:])
+    hashes = np.fromiter((key_hash(key) for key in keys), dtype=np.uint64, count=len(keys))
+    parsed = [key.decode().rsplit("/", 2) for key in keys]
+
+    sections = {
+        "slots": _hash_table(hashes),
+        "hashes": hashes,
+        "key_offsets": key_offsets,
+        "keys": np.frombuffer(b"".join(keys), dtype=np.uint8),
+        "charges": np.array([int(charge) for _, charge, _ in parsed], dtype=np.int8),
+        "collision_energies": np.array([float(ce) for _, _, ce in parsed], dtype=np.float32),
+        "peak_offsets": peak_offsets,
+        "mz": mz,
+        "intensity": intensity,
+        "codes": codes.astype(np.int32),
+    }
+
+    tmp_path = path.with_name(path.name + ".part")
+    with open(tmp_path, "wb") as f:
+        offset = _HEADER.size + len(sections) * _SECTION.size
+        section_table = []
+        for name, dtype in SpectralLibrary.SECTIONS.items():
+            offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+            section_table.append((offset, len(sections[name])))
+            offset += np.asarray(sections[name], dtype=dtype).nbytes
+
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sections), len(keys)))
+        for section_offset, count in section_table:
+            f.write(_SECTION.pack(section_offset, count))
+        for (section_offset, _), (name, dtype) in zip(section_table, SpectralLibrary.SECTIONS.items()):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(np.ascontiguousarray(sections[name], dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+    return SpectralLibrary(path)
+
+
+def get_cli():
+    """
+    Command line interface for write_library
+    """
+    parser = argparse.ArgumentParser(
+        description="Build a memory-mapped spectral library from intensity predictions."
+    )
+    parser.add_argument(
+        "library",
+        type=Path,
+        help="Output library file."
+    )
+    parser.add_argument(
+        "predictions",
+        nargs="+",
+        type=Path,
+        help="Predictions as written from obtain_predictions_pairs, CSV or Parquet."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    predictions_df = pd.concat(
+        [pd.read_parquet(p) if p.suffix == ".parquet" else pd.read_csv(p) for p in args.predictions],
+        ignore_index=True,
+    )
+    library = write_library(predictions_df, args.library)
+    print(f"Wrote {len(library)} spectra with {len(library.mz)} peaks to {args.library}")
@@ -0,0 +1,354 @@
+"""
+Candidate sibling spectra without identifications.
+
+All MS2 spectra of a spectrum store are sorted by charge and precursor m/z.
+A sweep over the sorted spectra pairs each spectrum with all following
+spectra of the same charge within the precursor tolerance. The spectra are
+also binned by retention time with the width of the retention time window,
+and each spectrum is only paired with the spectra of its own and the two
+neighbouring bins, so the precursor window is a binary search per spectrum
+and bin and the join is O(n log n) plus the number of candidates within
+(about) the retention time window. Candidates from different runs within
+the retention time window are then scored by the cosine of their binned,
+top-k peak vectors. As I/L siblings are exactly isobaric, this finds pairs
+the search engine collapsed or missed.
+
+Run from the project root on a store (see spectra.store) with:
+    python -m spectra.precursor_sweep store_dir candidates.parquet
+"""
+
+import argparse
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from pipeline.instrumentation import timer
+from spectra.store import SpectrumStore
+
+
+def binned_vectors(
+    store: SpectrumStore,
+    bin_width: float = 0.02,
+    top_k: int = 32,
+    chunk_size: int = 100000,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sparse binned peak vectors of all spectra of a store. Intensities are
+    summed per m/z bin, square root transformed, the top_k bins of each
+    spectrum are kept and the vector is scaled to unit length.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Bins (-1 for padding) and weights of shape (n_spectra, top_k).
+    """
+    bins = np.full((len(store), top_k), -1, dtype=np.int64)
+    weights = np.zeros((len(store), top_k), dtype=np.float32)
+
+    for start in tqdm(range(0, len(store), chunk_size), desc="Binning spectra"):
+        stop = min(start + chunk_size, len(store))
+        # the peaks of consecutive rows are contiguous in the store
+        peak_start, peak_stop = store.offsets[start], store.offsets[stop]
+        if peak_start == peak_stop:
+            continue
+        peak_rows = np.repeat(np.arange(start, stop), np.diff(store.offsets[start:stop + 1]))
+        peak_bins = (np.asarray(store.mz[peak_start:peak_stop]) / bin_width).astype(np.int64)
+        intensity = np.asarray(store.intensity[peak_start:peak_stop], dtype=np.float64)
+
+        # sum the intensities per (spectrum, bin)
+        order = np.lexsort((peak_bins, peak_rows))
+        peak_rows, peak_bins, intensity = peak_rows[order], peak_bins[order], intensity[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (peak_rows[1:] != peak_rows[:-1]) | (peak_bins[1:] != peak_bins[:-1])
+        starts = np.flatnonzero(first)
+        peak_rows, peak_bins = peak_rows[starts], peak_bins[starts]
+        intensity = np.sqrt(np.add.reduceat(intensity, starts))
+
+        # keep the top_k bins of each spectrum
+        order = np.lexsort((-intensity, peak_rows))
+        peak_rows, peak_bins, intensity = peak_rows[order], peak_bins[order], intensity[order]
+        row_starts = np.searchsorted(peak_rows, peak_rows, side="left")
+        rank = np.arange(len(peak_rows)) - row_starts
+        top = rank < top_k
+        bins[peak_rows[top], rank[top]] = peak_bins[top]
+        weights[peak_rows[top], rank[top]] = intensity[top]
+
+    norms = np.linalg.norm(weights, axis=1, keepdims=True)
+    np.divide(weights, norms, out=weights, where=norms > 0)
+    return bins, weights
+
+
+def pair_cosine(
+    bins_1: np.ndarray,
+    weights_1: np.ndarray,
+    bins_2: np.ndarray,
+    weights_2: np.ndarray,
+    max_elements: int = 16 << 20,
+) -> np.ndarray:
+    """
+    Cosine between pairs of binned vectors, given row by row. The bins of
+    each pair are compared all against all, in chunks of pairs with at most
+    max_elements (pairs, top_k, top_k) comparisons.
+    """
+    top_k = max(bins_1.shape[1], 1)
+    chunk_size = max(1, max_elements // (top_k * top_k))
+    cosine = np.zeros(len(bins_1), dtype=np.result_type(weights_1, weights_2))
+    for start in range(0, len(bins_1), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        matches = (bins_1[chunk, :, None] == bins_2[chunk, None, :]) & (bins_1[chunk, :, None] >= 0)
+        products = weights_1[chunk, :, None] * weights_2[chunk, None, :]
+        cosine[chunk] = np.where(matches, products, 0).sum(axis=(1, 2))
+    return cosine
+
+
+def binned_cosine(bins: np.ndarray, weights: np.ndarray, rows_1: np.ndarray, rows_2: np.ndarray) -> np.ndarray:
+    """
+    Cosine between the binned vectors of the given pairs of rows.
+    """
+    return pair_cosine(bins[rows_1], weights[rows_1], bins[rows_2], weights[rows_2])
+
+
+def _expand_ranges(
+    starts: np.ndarray, counts: np.ndarray, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield the ranges [starts[i], starts[i] + counts[i]) of all i in chunks of
+    at most chunk_size positions, as (i, position) arrays. Ranges are split
+    across chunks, so a single large range does not exceed the chunk size.
+    """
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) else 0
+    for begin in range(0, total, chunk_size):
+        flat = np.arange(begin, min(begin + chunk_size, total))
+        entries = np.searchsorted(ends, flat, side="right")
+        yield entries, starts[entries] + flat - (ends[entries] - counts[entries])
+
+
+def sweep_candidates(
+    store: SpectrumStore,
+    tolerance: float = 10.0,
+    rt_window: Optional[float] = 2.0,
+    cross_run: bool = True,
+    chunk_size: int = 100000,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Sweep over the spectra sorted by charge and precursor m/z and yield chunks
+    of candidate pairs of rows.
+
+    Parameters
+    ----------
+    store : SpectrumStore
+        Spectrum store.
+    tolerance : float
+        Precursor m/z tolerance in ppm.
+    rt_window : Optional[float]
+        Maximal retention time difference in minutes, None for no limit.
+        Spectra without retention time are left out if given.
+    cross_run : bool
+        Only pair spectra of different runs.
+    chunk_size : int
+        Maximal number of candidate pairs expanded at once, before the exact
+        retention time and run filters.
+
+    Yields
+    ------
+    Tuple[np.ndarray, np.ndarray]
+        Rows of the first and second spectrum of each candidate pair.
+    """
+    charges = np.asarray(store.precursor_charge)
+    precursor_mz = np.asarray(store.precursor_mz)
+    file_codes = np.asarray(store.file_codes)
+    retention_times = np.asarray(store.retention_time)
+
+    # spectra without charge or precursor cannot be matched
+    is_valid = (charges > 0) & ~np.isnan(precursor_mz)
+    if rt_window is not None:
+        is_valid &= ~np.isnan(retention_times)
+    valid = np.flatnonzero(is_valid)
+    order = valid[np.lexsort((precursor_mz[valid], charges[valid]))]
+    sorted_charges = charges[order]
+    sorted_mz = precursor_mz[order]
+
+    for charge in np.unique(sorted_charges):
+        charge_start, charge_stop = np.searchsorted(sorted_charges, [charge, charge + 1])
+        mz = sorted_mz[charge_start:charge_stop]
+        rows = order[charge_start:charge_stop]
+        n = len(rows)
+        # rank of the first spectrum beyond the precursor window of each spectrum
+        window_stops = np.searchsorted(mz, mz * (1 + tolerance * 1e-6), side="right")
+
+        # partners within the retention time window are in the same or a neighbouring bin
+        if rt_window is None:
+            rt_bins = np.zeros(n, dtype=np.int64)
+            bin_offsets = [0]
+        else:
+            rt = retention_times[rows]
+            rt_bins = np.floor(rt / rt_window) if rt_window > 0 else np.unique(rt, return_inverse=True)[1]
+            rt_bins = (rt_bins - rt_bins.min()).astype(np.int64)
+            bin_offsets = [-1, 0, 1]
+
+        # spectra sorted by bin and rank, keys bin * n + rank; a window is the
+        # range of ranks (rank, window stop) within the bin of the partners
+        bin_order = np.lexsort((np.arange(n), rt_bins))
+        keys = rt_bins[bin_order] * n + bin_order
+        ranks = np.arange(n)
+        starts, counts, firsts = [], [], []
+        for offset in bin_offsets:
+            partner_bins = rt_bins + offset
+            bin_starts = np.searchsorted(keys, partner_bins * n + ranks, side="right")
+            bin_stops = np.searchsorted(keys, partner_bins * n + window_stops, side="left")
+            has_partners = np.flatnonzero(bin_stops > bin_starts)
+            starts.append(bin_starts[has_partners])
+            counts.append(bin_stops[has_partners] - bin_starts[has_partners])
+            firsts.append(has_partners)
+        starts, counts, firsts = np.concatenate(starts), np.concatenate(counts), np.concatenate(firsts)
+
+        for entries, positions in _expand_ranges(starts, counts, chunk_size):
+            rows_1, rows_2 = rows[firsts[entries]], rows[bin_order[positions]]
+            keep = np.ones(len(rows_1), dtype=bool)
+            if cross_run:
+                keep &= file_codes[rows_1] != file_codes[rows_2]
+            if rt_window is not None:
+                keep &= np.abs(retention_times[rows_1] - retention_times[rows_2]) <= rt_window
+            yield rows_1[keep], rows_2[keep]
+
+
+def find_sibling_spectra(
+    store: SpectrumStore,
+    tolerance: float = 10.0,
+    rt_window: Optional[float] = 2.0,
+    min_cosine: float = 0.7,
+    bin_width: float = 0.02,
+    top_k: int = 32,
+    cross_run: bool = True,
+    chunk_size: int = 100000,
+) -> pd.DataFrame:
+    """
+    Find pairs of spectra with the same charge and precursor m/z within the
+    tolerance, retention times within the window and a binned cosine of at
+    least min_cosine. See sweep_candidates and binned_vectors for the parameters.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per pair with the raw file, scan number, precursor m/z and
+        retention time of both spectra, their charge, precursor m/z
+        difference in ppm and binned cosine.
+    """
+    with timer("spectrum_binning", items=len(store)):
+        bins, weights = binned_vectors(store, bin_width, top_k, chunk_size)
+
+    pairs_1, pairs_2, cosines = [], [], []
+    n_candidates = 0
+    for rows_1, rows_2 in tqdm(
+        sweep_candidates(store, tolerance, rt_window, cross_run, chunk_size), desc="Sweeping precursors"
+    ):
+        n_candidates += len(rows_1)
+        with timer("candidate_scoring", items=len(rows_1)):
+            cosine = binned_cosine(bins, weights, rows_1, rows_2)
+        keep = cosine >= min_cosine
+        pairs_1.append(rows_1[keep])
+        pairs_2.append(rows_2[keep])
+        cosines.append(cosine[keep])
+    tqdm.write(f"Scored {n_candidates} candidate pairs")
+
+    rows_1 = np.concatenate(pairs_1) if pairs_1 else np.array([], dtype=np.int64)
+    rows_2 = np.concatenate(pairs_2) if pairs_2 else np.array([], dtype=np.int64)
+    files = np.asarray(store.files, dtype=object)
+    precursor_mz_1 = store.precursor_mz[rows_1]
+    precursor_mz_2 = store.precursor_mz[rows_2]
+
+    return pd.DataFrame(
+        {
+            "raw_file_1": files[store.file_codes[rows_1]],
+            "scan_number_1": store.scan_numbers[rows_1],
+            "raw_file_2": files[store.file_codes[rows_2]],
+            "scan_number_2": store.scan_numbers[rows_2],
+            "charge": store.precursor_charge[rows_1],
+            "precursor_mz_1": precursor_mz_1,
+            "precursor_mz_2": precursor_mz_2,
+            "ppm": (precursor_mz_2 - precursor_mz_1) / precursor_mz_1 * 1e6,
+            "retention_time_1": store.retention_time[rows_1],
+            "retention_time_2": store.retention_time[rows_2],
+            "cosine": np.concatenate(cosines) if cosines else np.array([], dtype=np.float32),
+        }
+    )
+
+
+def get_cli():
+    """
+    Command line interface for find_sibling_spectra
+    """
+    parser = argparse.ArgumentParser(
+        description="Find candidate sibling spectra by precursor m/z, retention time and binned cosine."
+    )
+    parser.add_argument(
+        "store_dir",
+        type=Path,
+        help="Spectrum store converted from the mzML files (python -m spectra.store)."
+    )
+    parser.add_argument(
+        "outfile",
+        type=Path,
+        help="Output file. (.parquet == Parquet format, other: tab-separated values)"
+    )
+    parser.add_argument(
+        "--ppm",
+        type=float,
+        default=10.0,
+        help="Precursor m/z tolerance in ppm."
+    )
+    parser.add_argument(
+        "--rt-window",
+        type=float,
+        default=2.0,
+        help="Maximal retention time difference in minutes, negative for no limit."
+    )
+    parser.add_argument(
+        "--min-cosine",
+        type=float,
+        default=0.7,
+        help="Minimal binned cosine of a candidate pair."
+    )
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=0.02,
+        help="m/z bin width of the binned cosine in Da."
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=32,
+        help="Number of most intense bins per spectrum used for the cosine."
+    )
+    parser.add_argument(
+        "--within-run",
+        action="store_true",
+        help="Also pair spectra of the same run."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    if not SpectrumStore.is_store(args.store_dir):
+        raise SystemExit(f"{args.store_dir} is not a spectrum store, convert the mzML files with spectra.store first")
+
+    siblings_df = find_sibling_spectra(
+        SpectrumStore(args.store_dir),
+        tolerance=args.ppm,
+        rt_window=args.rt_window if args.rt_window >= 0 else None,
+        min_cosine=args.min_cosine,
+        bin_width=args.bin_width,
+        top_k=args.top_k,
+        cross_run=not args.within_run,
+    )
+    if args.outfile.suffix == ".parquet":
+        siblings_df.to_parquet(args.outfile, index=False)
+    else:
+        siblings_df.to_csv(args.outfile, index=False, sep="\t")
+    print(f"Found {len(siblings_df)} candidate sibling spectra pairs")
@@ -0,0 +1,354 @@
+"""
+Columnar spectrum store.
+
+mzML and MGF files are converted once into flat NumPy arrays: the peaks of all
+spectra are packed into one m/z and one intensity array, an offsets table
+marks where each spectrum starts and a sorted (file, scan) key table maps scans
+to rows. All arrays are saved as .npy files and opened memory-mapped, so
+looking up a scan is a binary search plus a slice of the mapped arrays, and
+several processes share the same pages.
+
+Convert files from the project root with:
+    python -m spectra.store store_dir run1.mzML run2.mzML ...
+"""
+
+import argparse
+import json
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import ClassVar, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pyteomics.mgf
+import pyteomics.mzml
+from tqdm import tqdm
+
+from pipeline.instrumentation import timer
+
+
+_SCAN_NUMBER = re.compile(r"scan=(\d+)")
+
+
+def _mzml_record(spectrum: Dict) -> Tuple:
+    """
+    Scan number, precursor m/z, charge, retention time (minutes) and peaks
+    of a spectrum read by pyteomics.
+    """
+    match = _SCAN_NUMBER.search(spectrum["id"])
+    scan_number = int(match.group(1)) if match else spectrum["index"]
+
+    precursor_mz = np.nan
+    charge = 0
+    precursors = spectrum.get("precursorList", {}).get("precursor", [])
+    if precursors:
+        selected_ion = precursors[0]["selectedIonList"]["selectedIon"][0]
+        precursor_mz = selected_ion.get("selected ion m/z", np.nan)
+        charge = int(selected_ion.get("charge state", 0))
+
+    scans = spectrum.get("scanList", {}).get("scan", [])
+    retention_time = scans[0].get("scan start time", np.nan) if scans else np.nan
+
+    return (
+        scan_number,
+        precursor_mz,
+        charge,
+        retention_time,
+        spectrum["m/z array"],
+        spectrum["intensity array"],
+    )
+
+
+def _mzml_spectra(path: Path, scan_numbers: Optional[Iterable[int]] = None):
+    """
+    Yield scan number, precursor m/z, charge, retention time (minutes) and
+    peaks of the MS2 spectra of an mzML file. Only the given scans are read,
+    in ascending order through the index of the file, if scan_numbers is given.
+    """
+    if scan_numbers is None:
+        with pyteomics.mzml.MzML(str(path), use_index=False, decode_binary=True) as reader:
+            for spectrum in reader:
+                if spectrum.get("ms level") == 2:
+                    yield _mzml_record(spectrum)
+        return
+
+    with pyteomics.mzml.MzML(str(path), use_index=True, decode_binary=True) as reader:
+        for scan_number in sorted(set(scan_numbers)):
+            try:
+                spectrum = reader.get_by_id(f"controllerType=0 controllerNumber=1 scan={scan_number}")
+            except KeyError:
+                continue
+            if spectrum.get("ms level") == 2:
+                yield _mzml_record(spectrum)
+
+
+def _mgf_spectra(path: Path, scan_numbers: Optional[Iterable[int]] = None):
+    """
+    Same as _mzml_spectra for MGF files, all spectra are considered MS2.
+    """
+    selected = None if scan_numbers is None else set(scan_numbers)
+    with pyteomics.mgf.MGF(str(path)) as reader:
+        for index, spectrum in enumerate(reader):
+            params = spectrum.get("params", {})
+            try:
+                scan_number = int(params.get("scans", index))
+            except ValueError:
+                scan_number = index
+            if selected is not None and scan_number not in selected:
+                continue
+
+            pepmass = params.get("pepmass", (np.nan,))
+            charges = params.get("charge") or [0]
+            retention_time = params.get("rtinseconds", np.nan) / 60
+
+            yield (
+                scan_number,
+                pepmass[0],
+                int(charges[0]),
+                retention_time,
+                spectrum["m/z array"],
+                spectrum["intensity array"],
+            )
+
+
+def read_spectra(path: Path, scan_numbers: Optional[Iterable[int]] = None):
+    """
+    Yield scan number, precursor m/z, charge, retention time (minutes) and
+    peaks of the MS2 spectra of an mzML or MGF file, only of the given scans
+    if scan_numbers is given.
+    """
+    path = Path(path)
+    reader = _mgf_spectra if path.suffix.lower() == ".mgf" else _mzml_spectra
+    return reader(path, scan_numbers)
+
+
+def _convert_file(path: Path, part_dir: Path, selected_scans: Optional[List[int]] = None) -> Tuple[int, int]:
+    """
+    Convert one mzML or MGF file, or only its selected scans, into the arrays of a store part.
+
+    Returns
+    -------
+    Tuple[int, int]
+        Number of spectra and peaks.
+    """
+    scan_numbers, precursor_mzs, charges, retention_times = [], [], [], []
+    mzs, intensities = [], []
+    for scan_number, precursor_mz, charge, retention_time, mz, intensity in read_spectra(path, selected_scans):
+        scan_numbers.append(scan_number)
+        precursor_mzs.append(precursor_mz)
+        charges.append(charge)
+        retention_times.append(retention_time)
+        mzs.append(np.asarray(mz, dtype=np.float64))
+        intensities.append(np.asarray(intensity, dtype=np.float32))
+
+    peak_counts = np.fromiter((len(mz) for mz in mzs), dtype=np.int64, count=len(mzs))
+
+    part_dir.mkdir(parents=True, exist_ok=True)
+    np.save(part_dir / "scan_numbers.npy", np.asarray(scan_numbers, dtype=np.int32))
+    np.save(part_dir / "precursor_mz.npy", np.asarray(precursor_mzs, dtype=np.float64))
+    np.save(part_dir / "precursor_charge.npy", np.asarray(charges, dtype=np.int8))
+    np.save(part_dir / "retention_time.npy", np.asarray(retention_times, dtype=np.float32))
+    np.save(part_dir / "peak_counts.npy", peak_counts)
+    np.save(part_dir / "mz.npy", np.concatenate(mzs) if mzs else np.array([], dtype=np.float64))
+    np.save(part_dir / "intensity.npy", np.concatenate(intensities) if intensities else np.array([], dtype=np.float32))
+
+    return len(scan_numbers), int(peak_counts.sum())
+
+
+class SpectrumStore:
+    """
+    Read access to a converted spectrum store.
+    """
+
+    SPECTRUM_ARRAYS: ClassVar[Dict[str, type]] = {
+        "file_codes": np.int32,
+        "scan_numbers": np.int32,
+        "precursor_mz": np.float64,
+        "precursor_charge": np.int8,
+        "retention_time": np.float32,
+    }
+    """
+    Per-spectrum arrays and their types.
+    """
+
+    PEAK_ARRAYS: ClassVar[Dict[str, type]] = {
+        "mz": np.float64,
+        "intensity": np.float32,
+    }
+    """
+    Per-peak arrays and their types.
+    """
+
+    def __init__(self, path: Path, mmap_mode: Optional[str] = "r"):
+        """
+        Parameters
+        ----------
+        path : Path
+            Directory of the store.
+        mmap_mode : Optional[str]
+            Memory map mode passed to np.load, None loads the arrays into memory.
+        """
+        self.path = Path(path)
+        with open(self.path / "files.json") as f:
+            self.files: List[str] = json.load(f)
+        self.file_codes_by_name = {name: code for code, name in enumerate(self.files)}
+
+        for name in (*self.SPECTRUM_ARRAYS, *self.PEAK_ARRAYS, "offsets", "lookup_keys", "lookup_rows"):
+            setattr(self, name, np.load(self.path / f"{name}.npy", mmap_mode=mmap_mode))
+
+    @staticmethod
+    def is_store(path: Path) -> bool:
+        return Path(path).joinpath("files.json").exists()
+
+    def __len__(self) -> int:
+        return len(self.scan_numbers)
+
+    @staticmethod
+    def lookup_key(file_codes, scan_numbers) -> np.ndarray:
+        return (np.asarray(file_codes, dtype=np.int64) << 32) | np.asarray(scan_numbers, dtype=np.int64)
+
+    def rows(self, files: Iterable[str], scan_numbers: Iterable[int]) -> np.ndarray:
+        """
+        Rows of the given scans, -1 for scans which are not in the store.
+        """
+        file_codes = np.fromiter((self.file_codes_by_name.get(f, -1) for f in files), dtype=np.int64)
+        keys = self.lookup_key(file_codes, np.fromiter(scan_numbers, dtype=np.int64))
+
+        if len(self.lookup_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.lookup_keys, keys), len(self.lookup_keys) - 1)
+        found = (file_codes >= 0) & (self.lookup_keys[positions] == keys)
+        return np.where(found, self.lookup_rows[positions], -1)
+
+    def row(self, file: str, scan_number: int) -> int:
+        return int(self.rows([file], [scan_number])[0])
+
+    def spectrum(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        m/z and intensity array of a row, as views of the mapped arrays.
+        """
+        start, stop = self.offsets[row], self.offsets[row + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    def get(self, file: str, scan_number: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        m/z and intensity array of a scan, None if the scan is not in the store.
+        """
+        row = self.row(file, scan_number)
+        return None if row < 0 else self.spectrum(row)
+
+
+def convert_spectra(
+    paths: List[Path],
+    store_dir: Path,
+    workers: Optional[int] = None,
+    scan_numbers: Optional[List[Iterable[int]]] = None,
+) -> SpectrumStore:
+    """
+    Convert mzML and MGF files into a spectrum store, one file per worker process.
+
+    Spectra are identified by the file name without extension and the scan
+    number. The store is written next to the part files of the workers, which
+    are removed afterwards. If scan_numbers is given, only these scans of
+    each file are converted, mzML files are read through their index.
+    """
+    store_dir = Path(store_dir)
+    parts_dir = store_dir / "parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = [Path(p) for p in paths]
+    files = [p.stem for p in paths]
+    if len(set(files)) != len(files):
+        raise ValueError("Spectrum files must have unique names")
+
+    with timer("spectrum_conversion", nbytes=sum(p.stat().st_size for p in paths)) as measurement:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sizes = list(
+                tqdm(
+                    executor.map(
+                        _convert_file,
+                        paths,
+                        [parts_dir / str(i) for i in range(len(paths))],
+                        [None] * len(paths) if scan_numbers is None else [sorted(set(s)) for s in scan_numbers],
+                    ),
+                    total=len(paths),
+                    desc="Converting spectrum files",
+                )
+            )
+        measurement.items = sum(n for n, _ in sizes)
+
+    n_spectra = sum(n for n, _ in sizes)
+    n_peaks = sum(n for _, n in sizes)
+
+    def open_output(name, dtype, size):
+        return np.lib.format.open_memmap(store_dir / f"{name}.npy", mode="w+", dtype=dtype, shape=(size,))
+
+    outputs = {name: open_output(name, dtype, n_spectra) for name, dtype in SpectrumStore.SPECTRUM_ARRAYS.items()}
+    outputs.update({name: open_output(name, dtype, n_peaks) for name, dtype in SpectrumStore.PEAK_ARRAYS.items()})
+    offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+
+    spectrum_start = 0
+    peak_start = 0
+    for file_code, (part_spectra, part_peaks) in enumerate(sizes):
+        part_dir = parts_dir / str(file_code)
+        spectrum_stop = spectrum_start + part_spectra
+        peak_stop = peak_start + part_peaks
+
+        outputs["file_codes"][spectrum_start:spectrum_stop] = file_code
+        for name in ("scan_numbers", "precursor_mz", "precursor_charge", "retention_time"):
+            outputs[name][spectrum_start:spectrum_stop] = np.load(part_dir / f"{name}.npy")
+        for name in SpectrumStore.PEAK_ARRAYS:
+            outputs[name][peak_start:peak_stop] = np.load(part_dir / f"{name}.npy")
+        offsets[spectrum_start + 1:spectrum_stop + 1] = peak_start + np.cumsum(np.load(part_dir / "peak_counts.npy"))
+
+        spectrum_start = spectrum_stop
+        peak_start = peak_stop
+
+    keys = SpectrumStore.lookup_key(outputs["file_codes"], outputs["scan_numbers"])
+    lookup_rows = np.argsort(keys, kind="stable")
+
+    for output in outputs.values():
+        output.flush()
+    np.save(store_dir / "offsets.npy", offsets)
+    np.save(store_dir / "lookup_keys.npy", keys[lookup_rows])
+    np.save(store_dir / "lookup_rows.npy", lookup_rows)
+    with open(store_dir / "files.json", "w") as f:
+        json.dump(files, f)
+
+    shutil.rmtree(parts_dir)
+    return SpectrumStore(store_dir)
+
+
+def get_cli():
+    """
+    Command line interface for convert_spectra
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert mzML/MGF files into a memory-mappable spectrum store."
+    )
+    parser.add_argument(
+        "store_dir",
+        type=Path,
+        help="Output directory of the store."
+    )
+    parser.add_argument(
+        "spectrum_files",
+        nargs="+",
+        type=Path,
+        help="mzML or MGF files."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of files converted in parallel (default: number of CPUs)."
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_cli().parse_args()
+    store = convert_spectra(args.spectrum_files, args.store_dir, args.workers)
+    print(f"Converted {len(store)} spectra from {len(store.files)} files")
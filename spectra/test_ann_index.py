@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from spectra import ann_index
+from spectra.ann_index import SpectrumIndex, _expand, _expand_chunks, build_index
+from spectra.precursor_sweep import pair_cosine
+
+
+@pytest.fixture
+def index(tmp_path):
+    rng = np.random.default_rng(0)
+    # groups of similar spectra, so that buckets hold several rows and tables agree on pairs
+    prototypes = rng.choice(5000, size=(40, 12))
+    bins = prototypes[rng.integers(0, 40, 400)].copy()
+    replaced = rng.random(bins.shape) < 0.2
+    bins[replaced] = rng.choice(5000, size=replaced.sum())
+    weights = rng.random(bins.shape).astype(np.float32)
+    weights[:5] = 0
+    return build_index(bins, weights, tmp_path / "index", n_tables=8, band_size=2), bins, weights
+
+
+def all_pair_codes(index, max_bucket_size):
+    codes = []
+    for table in range(index.n_tables):
+        keys = np.asarray(index.keys[table])
+        rows = np.asarray(index.rows[table], dtype=np.int64)
+        for idx in range(len(keys)):
+            end = min(np.searchsorted(keys, keys[idx], side="right"), idx + 1 + max_bucket_size)
+            for other in range(idx + 1, end):
+                codes.append((min(rows[idx], rows[other]) << 32) | max(rows[idx], rows[other]))
+    return np.unique(codes)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_expand_chunks(chunk_size):
+    starts = np.array([5, 0, 9, 3, 7])
+    counts = np.array([3, 0, 4, 1, 2])
+    ranges, positions = _expand(starts, counts)
+
+    chunks = list(_expand_chunks(starts, counts, chunk_size))
+
+    assert np.array_equal(np.concatenate([chunk[0] for chunk in chunks]), ranges)
+    assert np.array_equal(np.concatenate([chunk[1] for chunk in chunks]), positions)
+    assert all(len(chunk[0]) <= max(chunk_size, counts.max()) for chunk in chunks)
+
+
+def test_similar_pairs_are_distinct_candidates_of_all_tables(index, monkeypatch):
+    index, _, _ = index
+    expected = all_pair_codes(index, max_bucket_size=3)
+    assert len(expected) > 100
+
+    merge_sizes = []
+    merge_codes = ann_index._merge_codes
+
+    def recording_merge(codes, chunks):
+        merge_sizes.append(len(codes) + sum(len(chunk) for chunk in chunks))
+        return merge_codes(codes, chunks)
+
+    monkeypatch.setattr(ann_index, "_merge_codes", recording_merge)
+    pairs = index.similar_pairs(min_score=-1, max_bucket_size=3, chunk_size=50)
+
+    codes = (pairs["row_1"].to_numpy(np.int64) << 32) | pairs["row_2"].to_numpy(np.int64)
+    assert np.array_equal(codes, expected)
+    # the distinct pairs and the pairs of one table are combined, not the pairs of all tables
+    assert len(merge_sizes) == index.n_tables
+    assert max(merge_sizes) < len(expected) + len(expected) // 2
+
+
+def test_candidates_are_distinct(index):
+    index, bins, weights = index
+
+    queries, rows = index.candidates(bins[:50], weights[:50], chunk_size=20)
+
+    codes = (queries << 32) | rows
+    assert np.array_equal(codes, np.unique(codes))
+    assert set(queries) == set(range(5, 50))
+    # every indexed query shares all keys with itself
+    assert {(query, query) for query in range(5, 50)} <= set(zip(queries, rows))
+
+
+def near_duplicates(n_groups, top_k=16, n_changed=2, seed=1):
+    """
+    Pairs of binned vectors (rows 2i and 2i + 1) sharing all but n_changed bins.
+    """
+    rng = np.random.default_rng(seed)
+    bins = np.stack([rng.choice(200000, size=top_k, replace=False) for _ in range(n_groups)])
+    bins = np.repeat(bins, 2, axis=0)
+    bins[1::2, :n_changed] = rng.choice(np.arange(200000, 400000), size=(n_groups, n_changed))
+    weights = np.sqrt(rng.uniform(0.1, 1.0, bins.shape)).astype(np.float32)
+    weights /= np.linalg.norm(weights, axis=1, keepdims=True)
+    order = np.argsort(bins, axis=1)
+    return np.take_along_axis(bins, order, axis=1), np.take_along_axis(weights, order, axis=1)
+
+
+# the twins have a cosine of about 0.8, MinHash keys collide for them far more often than hyperplane bits
+@pytest.mark.parametrize("method, min_recall", [("jaccard", 0.99), ("cosine", 0.6)])
+def test_reopened_index_finds_near_duplicates(tmp_path, method, min_recall):
+    bins, weights = near_duplicates(1000)
+    build_index(bins, weights, tmp_path / "index", method=method)
+
+    index = SpectrumIndex(tmp_path / "index")
+    assert SpectrumIndex.is_index(tmp_path / "index")
+    assert len(index) == len(bins)
+    assert index.params["method"] == method
+    neighbours = index.query(bins, weights, k=2, chunk_size=700)
+
+    twins = np.arange(len(bins)) ^ 1
+    found = neighbours[neighbours["row"].to_numpy() == twins[neighbours["query"].to_numpy()]]
+    assert len(found) / len(bins) >= min_recall
+    # every vector is its own best neighbour, its twin the second best
+    best = neighbours.groupby("query").head(1)
+    assert (best["row"] == best["query"]).all()
+    assert np.allclose(best["score"], 1.0, atol=1e-5)
+
+    rows = neighbours["row"].to_numpy()
+    queries = neighbours["query"].to_numpy()
+    assert np.array_equal(neighbours["score"], pair_cosine(bins[queries], weights[queries], bins[rows], weights[rows]))
+
+    loaded = SpectrumIndex(tmp_path / "index", mmap_mode=None)
+    pd.testing.assert_frame_equal(loaded.query(bins, weights, k=2), index.query(bins, weights, k=2))
+
+
+def test_query_orders_cuts_and_filters_neighbours(tmp_path):
+    bins, weights = near_duplicates(200, n_changed=4)
+    # two more vectors with the bins of the first one and other weights
+    extra_weights = np.stack((weights[1], weights[0] ** 2))
+    extra_weights /= np.linalg.norm(extra_weights, axis=1, keepdims=True)
+    bins = np.concatenate((bins, bins[:1], bins[:1]))
+    weights = np.concatenate((weights, extra_weights))
+    index = build_index(bins, weights, tmp_path / "index")
+    index = SpectrumIndex(index.path)
+
+    all_neighbours = index.query(bins[:10], weights[:10], k=1000)
+    for query, group in all_neighbours.groupby("query"):
+        assert np.all(np.diff(group["score"].to_numpy()) <= 0)
+    assert np.all(np.diff(all_neighbours["query"].to_numpy()) >= 0)
+    assert all_neighbours.groupby("query").size()[0] >= 4
+
+    top_3 = index.query(bins[:10], weights[:10], k=3, chunk_size=3)
+    expected = all_neighbours.groupby("query").head(3).reset_index(drop=True)
+    pd.testing.assert_frame_equal(top_3, expected)
+
+    filtered = index.query(bins[:10], weights[:10], k=1000, min_score=0.9)
+    assert (filtered["score"] >= 0.9).all()
+    pd.testing.assert_frame_equal(
+        filtered, all_neighbours[all_neighbours["score"] >= 0.9].reset_index(drop=True)
+    )
+
+
+def test_similar_pairs_recall(tmp_path):
+    bins, weights = near_duplicates(1000)
+    index = build_index(bins, weights, tmp_path / "index")
+
+    pairs = index.similar_pairs(min_score=0.7)
+
+    twins = pairs[pairs["row_2"] == pairs["row_1"] + 1]
+    assert ((twins["row_1"] % 2) == 0).sum() >= 0.99 * 1000
+    assert (pairs["score"] >= 0.7).all()
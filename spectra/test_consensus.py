@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from spectra.consensus import _cluster_starts, consensus_spectra
+
+
+def noisy_spectra(rng, true_mz, n_spectra, n_noise, jitter_ppm=2.0):
+    spectra = []
+    for _ in range(n_spectra):
+        mz = np.concatenate([
+            true_mz * (1 + rng.normal(0, jitter_ppm * 1e-6, len(true_mz))),
+            rng.uniform(100, 2000, n_noise),
+        ])
+        intensity = np.concatenate([rng.uniform(0.5, 1.0, len(true_mz)), rng.uniform(0.0, 0.2, n_noise)])
+        order = np.argsort(mz)
+        spectra.append((mz[order], intensity[order]))
+    return spectra
+
+
+def greedy_starts(mz, peak_group, tolerance, unit):
+    starts = np.zeros(len(mz), dtype=bool)
+    limit = None
+    for idx, value in enumerate(mz):
+        if limit is None or value > limit or peak_group[idx] != peak_group[idx - 1]:
+            starts[idx] = True
+            limit = value * (1 + tolerance * 1e-6) if unit == "ppm" else value + tolerance
+    return starts
+
+
+@pytest.mark.parametrize("unit, tolerance", [("ppm", 20.0), ("Da", 0.02)])
+def test_cluster_starts_match_greedy_clustering(unit, tolerance):
+    rng = np.random.default_rng(1)
+    peak_group = np.repeat(np.arange(5), 2000)
+    mz = np.concatenate([np.sort(rng.uniform(100, 150, 2000)) for _ in range(5)])
+    expected = greedy_starts(mz, peak_group, tolerance, unit)
+    assert np.array_equal(_cluster_starts(mz, peak_group, tolerance, unit), expected)
+
+
+def test_consensus_merges_peaks_within_tolerance():
+    spectra = [
+        (np.array([100.0, 200.0]), np.array([1.0, 0.5])),
+        (np.array([100.001, 300.0]), np.array([1.0, 1.0])),
+    ]
+    consensus = consensus_spectra([spectra], tolerance=20)
+    mz, intensity, support = consensus.spectrum(0)
+    assert np.allclose(mz, [100.0005, 200.0, 300.0])
+    assert np.allclose(intensity, [1.0, 0.25, 0.5])
+    assert support.tolist() == [2, 1, 1]
+
+
+@pytest.mark.parametrize("n_spectra", [10, 3000])
+def test_noise_does_not_chain_true_peaks(n_spectra):
+    rng = np.random.default_rng(0)
+    true_mz = np.sort(rng.uniform(150, 1900, 40))
+    tolerance = 20.0
+    consensus = consensus_spectra([noisy_spectra(rng, true_mz, n_spectra, 150)], tolerance=tolerance)
+    mz, _, support = consensus.spectrum(0)
+
+    for value in true_mz:
+        nearby = np.flatnonzero(np.abs(mz - value) < 3 * tolerance * 1e-6 * value)
+        best = nearby[np.argmax(support[nearby])]
+        assert abs(mz[best] - value) / value * 1e6 < tolerance
+        assert support[best] >= n_spectra // 2
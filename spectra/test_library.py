@@ -0,0 +1,159 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from seq_utils.fragments import parse_annotations
+from spectra import library
+from spectra.library import SpectralLibrary, _hash_table, library_key, write_library
+
+
+def predictions(n_entries, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for idx in range(n_entries):
+        peptide = "".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), size=rng.integers(7, 20)))
+        for ion_number in range(1, rng.integers(2, 8)):
+            for ion_type in "by":
+                rows.append(
+                    {
+                        "peptide_sequences": peptide,
+                        "precursor_charges": 2 + idx % 2,
+                        "collision_energies": 25.0 + idx % 3,
+                        "mz": rng.uniform(100, 2000),
+                        "intensities": rng.uniform(0.01, 1.0),
+                        "annotation": f"{ion_type}{ion_number}+1",
+                    }
+                )
+    predictions_df = pd.DataFrame(rows)
+    # fragments of the entries are interleaved, as in a concatenation of prediction chunks
+    return predictions_df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def expected_spectra(predictions_df):
+    predictions_df = predictions_df.assign(code=parse_annotations(predictions_df["annotation"]))
+    predictions_df = predictions_df[(predictions_df["code"] >= 0) & (predictions_df["intensities"] > 0)]
+    predictions_df = predictions_df.drop_duplicates(
+        ["peptide_sequences", "precursor_charges", "collision_energies", "code"]
+    )
+    return {
+        library_key(*key): group.sort_values("mz")
+        for key, group in predictions_df.groupby(["peptide_sequences", "precursor_charges", "collision_energies"])
+    }
+
+
+def assert_library_matches(spec_library, predictions_df):
+    expected = expected_spectra(predictions_df)
+    assert len(spec_library) == len(expected)
+    for peptide, charge, collision_energy in spec_library:
+        key = library_key(peptide, charge, collision_energy)
+        entry = spec_library.find(peptide, charge, collision_energy)
+        assert spec_library.key(entry) == key
+
+        mz, intensity, codes = spec_library.spectrum(entry)
+        assert np.array_equal(mz, expected[key]["mz"].to_numpy())
+        assert np.array_equal(intensity, expected[key]["intensities"].to_numpy(dtype=np.float32))
+        assert np.array_equal(codes, expected[key]["code"].to_numpy(dtype=np.int32))
+        assert spec_library.charges[entry] == charge
+        assert spec_library.collision_energies[entry] == np.float32(collision_energy)
+
+
+@pytest.mark.parametrize("n_entries", [1, 2, 300])
+def test_every_key_is_found_at_its_entry(tmp_path, n_entries):
+    predictions_df = predictions(n_entries)
+
+    spec_library = write_library(predictions_df, tmp_path / "predictions.speclib")
+
+    assert_library_matches(spec_library, predictions_df)
+    keys = {library_key(*key) for key in spec_library}
+    assert len(keys) == n_entries
+    assert all(
+        spec_library.key(spec_library.find(*key)) == library_key(*key)
+        for key in predictions_df[["peptide_sequences", "precursor_charges", "collision_energies"]].itertuples(
+            index=False
+        )
+    )
+
+
+def test_missing_keys_are_not_found(tmp_path):
+    predictions_df = predictions(50)
+    spec_library = write_library(predictions_df, tmp_path / "predictions.speclib")
+    peptide, charge, collision_energy = next(iter(spec_library))
+
+    assert spec_library.find("PEPTIDEK", 2, 25.0) == -1
+    assert spec_library.find(peptide, charge + 2, collision_energy) == -1
+    assert spec_library.find(peptide, charge, collision_energy + 0.5) == -1
+    assert spec_library.get("PEPTIDEK", 2, 25.0) is None
+    assert ("PEPTIDEK", 2, 25.0) not in spec_library
+    assert (peptide, charge, collision_energy) in spec_library
+
+
+def test_colliding_hashes(tmp_path, monkeypatch):
+    # few distinct hashes, so that entries share hashes and slots and probe over the end of the table
+    key_hash = library.key_hash
+    monkeypatch.setattr(library, "key_hash", lambda key: (key_hash(key) % 5) * 7 + 3)
+    predictions_df = predictions(60)
+
+    spec_library = write_library(predictions_df, tmp_path / "predictions.speclib")
+
+    assert len(np.unique(spec_library.hashes)) == 5
+    assert_library_matches(spec_library, predictions_df)
+    assert spec_library.find("PEPTIDEK", 2, 25.0) == -1
+
+
+def test_hash_table_probes_to_the_next_free_slot():
+    hashes = np.array([3, 3, 11, 4, 7, 7, 15, 31], dtype=np.uint64)
+
+    slots = _hash_table(hashes)
+
+    assert len(slots) == 16
+    assert sorted(slots[slots >= 0]) == list(range(len(hashes)))
+    # 15 and 31 share the last slot, the second wraps around to the first
+    assert slots[15] == 6 and slots[0] == 7
+    # linear probing from each hash's home slot reaches the entry before any free slot
+    for entry, hash_value in enumerate(hashes):
+        slot = int(hash_value) & 15
+        while slots[slot] != entry:
+            assert slots[slot] >= 0
+            slot = (slot + 1) & 15
+
+
+def test_invalid_fragments_and_duplicates_are_left_out(tmp_path):
+    predictions_df = pd.DataFrame(
+        {
+            "peptide_sequences": ["PEPTIDEK"] * 5,
+            "precursor_charges": [2] * 5,
+            "collision_energies": [30.0] * 5,
+            "mz": [300.0, 200.0, 250.0, 400.0, 200.0],
+            "intensities": [0.5, 1.0, 0.0, 0.2, 1.0],
+            "annotation": ["y2+1", "b2+1", "b3+1", "x1+1", "b2+1"],
+        }
+    )
+
+    spec_library = write_library(predictions_df, tmp_path / "predictions.speclib")
+
+    mz, intensity, codes = spec_library.get("PEPTIDEK", 2, 30)
+    assert mz.tolist() == [200.0, 300.0]
+    assert intensity.tolist() == [1.0, 0.5]
+    assert codes.tolist() == parse_annotations(["b2+1", "y2+1"]).tolist()
+
+
+def test_pickled_library_reopens_the_file(tmp_path):
+    predictions_df = predictions(40)
+    spec_library = write_library(predictions_df, tmp_path / "predictions.speclib")
+
+    pickled = pickle.dumps(spec_library)
+    assert len(pickled) < 1000
+
+    unpickled = pickle.loads(pickled)
+    assert unpickled.path == spec_library.path
+    assert list(unpickled) == list(spec_library)
+    assert_library_matches(unpickled, predictions_df)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "predictions.speclib"
+    path.write_bytes(b"\0" * 256)
+    with pytest.raises(ValueError):
+        SpectralLibrary(path)
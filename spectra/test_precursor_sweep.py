@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from spectra import precursor_sweep
+from spectra.precursor_sweep import pair_cosine, sweep_candidates
+
+
+def random_store(n_spectra, seed=0):
+    rng = np.random.default_rng(seed)
+    precursor_mz = np.round(rng.uniform(400, 402, n_spectra), 3)
+    precursor_mz[rng.random(n_spectra) < 0.02] = np.nan
+    retention_time = rng.uniform(0, 60, n_spectra).astype(np.float32)
+    retention_time[rng.random(n_spectra) < 0.02] = np.nan
+    return SimpleNamespace(
+        precursor_charge=rng.integers(0, 4, n_spectra).astype(np.int8),
+        precursor_mz=precursor_mz,
+        file_codes=rng.integers(0, 3, n_spectra).astype(np.int32),
+        retention_time=retention_time,
+    )
+
+
+def brute_force_pairs(store, tolerance, rt_window, cross_run):
+    rows_1, rows_2 = np.triu_indices(len(store.precursor_mz), k=1)
+    mz_1, mz_2 = store.precursor_mz[rows_1], store.precursor_mz[rows_2]
+    low, high = np.minimum(mz_1, mz_2), np.maximum(mz_1, mz_2)
+    keep = (store.precursor_charge[rows_1] == store.precursor_charge[rows_2]) & (store.precursor_charge[rows_1] > 0)
+    keep &= high <= low * (1 + tolerance * 1e-6)
+    if cross_run:
+        keep &= store.file_codes[rows_1] != store.file_codes[rows_2]
+    if rt_window is not None:
+        keep &= np.abs(store.retention_time[rows_1] - store.retention_time[rows_2]) <= rt_window
+    return {frozenset(pair) for pair in zip(rows_1[keep], rows_2[keep])}
+
+
+@pytest.mark.parametrize("rt_window", [None, 0.0, 0.5, 5.0])
+@pytest.mark.parametrize("cross_run", [False, True])
+def test_sweep_finds_all_candidates_once(rt_window, cross_run):
+    store = random_store(1500)
+
+    chunks = list(sweep_candidates(store, tolerance=50.0, rt_window=rt_window, cross_run=cross_run, chunk_size=997))
+    pairs = [frozenset(pair) for rows_1, rows_2 in chunks for pair in zip(rows_1, rows_2)]
+
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == brute_force_pairs(store, 50.0, rt_window, cross_run)
+
+
+def test_sweep_expands_bounded_chunks(monkeypatch):
+    # one dense precursor window, all spectra are candidates of each other
+    n_spectra = 600
+    store = SimpleNamespace(
+        precursor_charge=np.full(n_spectra, 2, dtype=np.int8),
+        precursor_mz=np.full(n_spectra, 500.0),
+        file_codes=np.arange(n_spectra, dtype=np.int32) % 2,
+        retention_time=np.linspace(0, 100, n_spectra).astype(np.float32),
+    )
+
+    chunks = list(sweep_candidates(store, rt_window=None, cross_run=False, chunk_size=1000))
+
+    assert all(len(rows_1) <= 1000 for rows_1, _ in chunks)
+    assert sum(len(rows_1) for rows_1, _ in chunks) == n_spectra * (n_spectra - 1) // 2
+
+    # the retention time bins keep the expansion near the pairs within the window
+    expanded = []
+    original = precursor_sweep._expand_ranges
+
+    def expand_ranges(starts, counts, chunk_size):
+        expanded.append(int(counts.sum()))
+        return original(starts, counts, chunk_size)
+
+    monkeypatch.setattr(precursor_sweep, "_expand_ranges", expand_ranges)
+    n_found = sum(len(rows_1) for rows_1, _ in sweep_candidates(store, rt_window=1.0, cross_run=False))
+    assert n_found == len(brute_force_pairs(store, 10.0, 1.0, cross_run=False))
+    assert sum(expanded) <= 3 * n_found
+
+
+def test_pair_cosine_chunks():
+    rng = np.random.default_rng(1)
+    bins_1 = rng.integers(-1, 40, (257, 16))
+    bins_2 = rng.integers(-1, 40, (257, 16))
+    weights_1 = rng.random((257, 16)).astype(np.float32)
+    weights_2 = rng.random((257, 16)).astype(np.float32)
+
+    expected = np.array(
+        [
+            sum(w_1 * w_2 for b_1, w_1 in zip(bins_1[i], weights_1[i]) for b_2, w_2 in zip(bins_2[i], weights_2[i]) if b_1 == b_2 >= 0)
+            for i in range(len(bins_1))
+        ]
+    )
+    assert np.allclose(pair_cosine(bins_1, weights_1, bins_2, weights_2, max_elements=1000), expected, rtol=1e-5)
+    assert np.allclose(pair_cosine(bins_1, weights_1, bins_2, weights_2), expected, rtol=1e-5)